@@ -0,0 +1,63 @@
+#! /usr/bin/env python
+
+##############################################################################
+##  pyvolve: Python platform for simulating evolutionary sequences.
+##
+##  Written by Stephanie J. Spielman (stephanie.spielman@gmail.com) 
+##############################################################################
+## 
+## This script benchmarks the samplers which Evolver may use to draw new states along each branch.
+## 'cdf' and 'alias' sample each site independently, whereas 'multinomial' draws one multinomial per occupied parent state and then permutes each group of sites.
+## All three draw random numbers per site. For codons, 'alias' is the fastest, and 'multinomial' the slowest because it also sorts sites by parent state.
+## Usage: python sampler_benchmark.py [partition_size]
+##############################################################################
+
+import sys
+import time
+
+# Import pyvolve
+try:
+    from pyvolve import *
+except:
+    try:
+        sys.path.append("../src/")
+        from newick import *
+        from state_freqs import *
+        from model import *
+        from partition import *
+        from evolver import *
+    except:
+        raise AssertionError("\nWhere's pyvolve!!")
+
+
+size = 5000
+if len(sys.argv) > 1:
+    size = int(sys.argv[1])
+
+my_tree = read_tree(file = "trees/basic.tre")
+freqs = RandomFrequencies(by = 'codon')()
+my_model = Model({'state_freqs':freqs, 'kappa':2.75, 'omega':0.5}, "GY94")
+my_model.construct_model()
+
+
+##### Time the full simulation using each sampler #####
+print "Simulating", size, "codons along a", "10-taxon tree"
+for sampler in ['cdf', 'alias', 'multinomial']:
+    my_partition = Partition()
+    my_partition.size = size
+    my_partition.models = my_model
+    start = time.time()
+    Evolver(partitions = my_partition, tree = my_tree, seqfile = None, ratefile = None, infofile = None, sampler = sampler, seed = 1)()
+    print sampler, "\t", round(time.time() - start, 4), "seconds (includes matrix exponentiation)"
+
+
+##### Time the sampling step alone, for one transition matrix #####
+prob_matrix = my_model.compute_prob_matrix(0.1)
+parents = get_sampler('cdf').sample_freqs(freqs, size * 100)
+print "\nSampling", len(parents), "sites from a single 61x61 transition matrix"
+for sampler in ['cdf', 'alias', 'multinomial']:
+    my_sampler = get_sampler(sampler, np.random.RandomState(1))
+    table = my_sampler.prepare(prob_matrix)
+    start = time.time()
+    my_sampler.draw(table, parents)
+    print sampler, "\t", round(time.time() - start, 4), "seconds"
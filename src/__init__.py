@@ -19,6 +19,16 @@ The package consists of the following Python modules:
 
 * empirical_matrices
 
+* plan
+
+* replicates
+
+* sampler
+
+* storage
+
+* transition
+
 * evolver
 
 
@@ -27,6 +37,11 @@ __version__ = '0.1'
 from model import *
 from newick import *
 from evolver import *
+from plan import *
+from replicates import *
+from sampler import *
+from storage import *
+from transition import *
 from genetics import *
 from partition import *
 from state_freqs import *
@@ -10,28 +10,24 @@
 The module will evolve sequences along a phylogeny.
 '''
 
-import itertools
-from copy import deepcopy
+import copy
+import tempfile
 import numpy as np
-from scipy import linalg
-import random as rn
+from multiprocessing import Pool
+from multiprocessing.sharedctypes import RawArray
+from multiprocessing.pool import ThreadPool
 from model import *
 from newick import *
 from genetics import *
 from partition import *
+from plan import *
+from sampler import *
+from storage import *
+from transition import *
 ZERO      = 1e-8
-MOLECULES = Genetics()
-        
-        
-class Site():
-    '''
-        Defines the Site class, which holds information for each evolved site.
-        Currently the sequence, but this will be expanded.
-    '''
-    def __init__(self):
-        self.int_seq      = None # integer sequence at a site
-        #self.position     = None # location of site in full alignment size. <- eventually, this will be what gets shuffled.
-
+ROW_BLOCK = 2**20 # Largest number of per-site transition probabilities computed at once under continuous gamma rates (see Evolver._sample_sites)
+NUM_SUBTREES = 64 # Number of disjoint subtrees evolved in parallel (see Evolver._simulate_subtrees). Fixed, so that results do not depend on the number of processes.
+_worker_state = {} # Evolver and master seed used by worker processes (see _init_worker)
 
 
 class Evolver(object):
@@ -42,6 +38,7 @@ class Evolver(object):
             2. site_rates.txt 
                 - File providing rate information about each simulated column. Gives the partition and rate cateogy for each site in final simulated alignment.
                 - Tab-delimited file with fields, Site_Index    Partition_Index     Rate_Category . All indexing is from *1*.
+                - If any partition uses continuous gamma rates, a fourth field, Rate_Factor, gives the rate drawn for each such site (NA for sites of other partitions).
             3. site_rates_info.txt
                 - File providing the true site-rate heterogeneity values (either the rate scaling factor or dN and dS) for each rate category.
                 - Tab-delimited file with fields, Partition_Index    Model_Name    Rate_Category    Rate_Probability    Rate_Factor
@@ -54,6 +51,8 @@ class Evolver(object):
             Required keyword arguments include,
                 1. **tree** is the phylogeny (parsed with the ``newick.read_tree`` function) along which sequences are evolved
                 2. **partitions** is a list of Partition instances to evolve
+            
+            Alternatively, a plan compiled from the tree and partitions may be given instead of both (see the optional argument *plan*). Neither the tree nor the partitions are modified by Evolver.
     
             Optional keyword arguments include,
                 1. **seqfile** is a custom name for the output simulated alignment. Provide None or False to suppress file creation.
@@ -61,104 +60,108 @@ class Evolver(object):
                 3. **ratefile** is a custom name for the "site_rates.txt" file. Provide None or False to suppress file creation.
                 4. **infofile** is a custom name for the "site_rates_info.txt" file. Provide None or False to suppress file creation.
                 5. **write_anc** is a boolean argument (True or False) for whether ancestral sequences should be output along with the tip sequences. Default is False.
+                6. **sampler** is the strategy used to draw new states at the root and along branches. Either 'cdf' (inverse-CDF sampling, default), 'alias' (alias-table sampling, fastest for long codon partitions), 'multinomial' (one multinomial draw per occupied parent state), or an instance of a Sampler child class (see the ``sampler`` module). A copy of this instance then draws from this Evolver's random number generator, so that the instance itself is left unchanged and may be shared by several Evolvers.
+                7. **seed** is an integer used to seed a random number generator private to this Evolver, for reproducible simulations. Default is None, in which case numpy's global random state is used.
+                8. **cache** is the TransitionCache (see the ``transition`` module) in which transition matrices are stored for reuse. By default, a single cache is shared by all Evolver instances in a process, so that repeated simulations along the same tree compute each matrix only once. Provide None or False to disable caching.
+                9. **bl_tolerance** turns on approximate branch-length quantization. Each branch length is snapped to a logarithmic grid such that it changes by at most this relative tolerance (e.g. 1e-4), so that nearly identical branches share a single transition matrix. Default is None (no quantization).
+                10. **bl_grid** turns on approximate branch-length quantization with an absolute grid. Each branch length is rounded to the nearest multiple of this value, so that it changes by at most half a grid step. Branches shorter than half a grid step therefore become zero-length branches, along which no sites change. Default is None (no quantization). Only one of bl_tolerance and bl_grid may be given.
+                11. **branch_regimes** is a boolean argument (True or False) for whether to choose a sampling strategy for each branch from its transition probabilities. Default is False, in which case every site is sampled from its full transition matrix along every branch. If True,
+                    - along short branches, where no state's probability of changing exceeds *short_branch*, only sites which change are chosen and sampled. This is exact.
+                    - along saturated branches, where no transition probability differs from the stationary frequencies by more than *saturation_tol*, sites are drawn directly from the model's state frequencies. This is approximate, and only applies to time-reversible models.
+                12. **short_branch** is the largest probability of changing state for which a branch is considered short. Default is 0.1.
+                13. **saturation_tol** is the largest difference between transition probabilities and stationary frequencies for which a branch is considered saturated. Default is 1e-8.
+                14. **num_threads** is the number of threads used to compute all transition matrices needed along the tree before simulating. Default is 1. Since numpy and scipy release the GIL within their linear algebra routines, several threads can speed up set-up for large trees and codon models.
+                15. **plan** is a SimulationPlan (see the ``plan`` module) compiled from a tree and partitions. If given, the arguments tree, partitions, bl_tolerance and bl_grid are ignored, and the plan is not compiled again. The compiled plan is stored in the attribute *plan*, so that it may be shared by several Evolver instances.
+                16. **retain** determines which sequences are kept (in the attribute *evolved_seqs*) after simulating. Either 'all' (default) to keep sequences at all nodes, 'leaves' to keep only leaf sequences, or a list of internal node names whose sequences are kept in addition to the leaves' (the root is named 'root'). All other sequences are released as soon as all of their children have been evolved, so that memory use grows with tree depth rather than with the number of nodes. Only retained sequences are written when write_anc is True.
+                17. **storage** is either 'full' (default), in which case each retained sequence is stored in full, or 'delta', in which case each non-root node stores only the sites at which it differs from its parent. Full sequences are then rebuilt whenever they are accessed in *evolved_seqs* or *leaf_seqs* (which become read-only DeltaSequences dictionaries, see the ``storage`` module), or written. This greatly reduces the memory needed to keep all ancestral sequences (e.g. with write_anc) on large trees.
+                18. **chunk_size** turns on site-chunked simulation, for very long partitions. The tree is traversed once for each window of this many sites (of a single partition), and each window's retained sequences are written into a matrix stored in a temporary file on disk, so that memory use is set by the chunk size rather than by the total number of sites. Transition matrices are computed once and reused for all windows. Default is None (the full length is simulated at once). Cannot be combined with delta storage.
+                19. **subtree_processes** turns on parallel subtree evolution, for very large trees. The top of the tree is evolved first, until it splits into many (64) disjoint subtrees, which are then evolved by a pool of this many worker processes. Subtree root sequences and all retained sequences are stored in shared memory, so that no sequences are copied between processes. Each subtree draws from its own random number generator, seeded from this Evolver's generator, so that results do not depend on the number of processes. Default is None (no worker processes). Cannot be combined with delta storage or chunk_size.
+                20. **site_processes** turns on site-parallel simulation, for long alignments on small trees. Sites are split into windows, either whole partitions or, if chunk_size is also given, windows of at most chunk_size sites within each partition. Each window is evolved along the whole tree by one of a pool of this many worker processes, and written into a shared-memory matrix holding all retained sequences. Results do not depend on the number of processes, and are identical to those of site-chunked simulation with the same chunk_size and seed. Default is None (no worker processes). Cannot be combined with delta storage or subtree_processes.
+                21. **rng_mode** is either 'stream' (default), in which case all random numbers are drawn in turn from this Evolver's random number generator, or 'counter', in which case every block of sites at every node draws from its own generator, keyed on (seed, replicate, node, partition, block) (see ``sampler.counter_rng``). Rate categories are likewise shuffled with a generator keyed on (seed, replicate, number of nodes, partition, 0). Results then depend neither on the order in which nodes and sites are evolved nor on how they are batched or parallelized, so that all simulation modes (serial, chunk_size, site_processes, subtree_processes and simulate_replicates) give identical alignments for the same seed. Requires a seed.
+                22. **block_size** is the number of sites in each block of a partition with rng_mode 'counter'. Default is 4096. chunk_size must be a multiple of block_size.
+            
+            After simulating, the attribute *num_prob_matrices* gives the number of distinct transition matrices used along the tree (i.e. the number computed when none were already cached), and *quantization_error* gives the maximum absolute change to any branch length induced by quantization.
+            For partitions whose models use continuous gamma rates (see ``Model.construct_model``), the attribute *site_factors* gives the rate drawn for each site, as a list with one array (or None, for partitions with rate categories) per partition. Such sites are never shuffled, as their rates are already drawn independently.
+            With site heterogeneity, *evolved_seqs* and *leaf_seqs* are read-only dictionaries whose sites are shuffled when sequences are accessed or written (see the ``storage`` module).
         '''
         
                 
-        self.partitions = kwargs.get('partitions', None)
-        self.full_tree  = kwargs.get('tree', Tree())
         self.seqfile    = kwargs.get('seqfile', 'simulated_alignment.fasta')
         self.seqfmt     = kwargs.get('seqfmt', 'fasta').lower()
         self.write_anc  = kwargs.get('write_anc', False)
         self.ratefile   = kwargs.get('ratefile', 'site_rates.txt')
         self.infofile   = kwargs.get('infofile', 'site_rates_info.txt')
-                
-        # These dictionaries enable convenient post-processing of the simulated alignment. Otherwise we'd have to always loop over full tree, which would be very slow.
-        self.leaf_seqs = {} # Store final tip sequences only
-        self.evolved_seqs = {} # Stores sequences from all nodes, including internal and tips
+        self.seed       = kwargs.get('seed', None)
         
-        # Setup and sanity checks 
-        self._root_seq_length = 0
-        self._setup_partitions()
-        self._set_code()
-
-            
-
-
-    def _setup_partitions(self):
-        '''
-            Setup and various sanity checks. 
-        '''
-        # If partitions is not a list but indeed a Partition, turn into a list. If not a partition, assert.
-        if isinstance(self.partitions, Partition):
-            self.partitions = [self.partitions]
+        if self.seed is None:
+            self._rng = np.random
         else:
-            assert(type(self.partitions) is list), "\n\nYou must provide either a single Partition object or list of Partition objects to evolver."
-            for p in self.partitions:
-                assert(isinstance(p, Partition)), "\n\nYou must provide either a single Partition object or list of Partition objects to evolver." 
+            self._rng = np.random.RandomState(self.seed)
+        self._sampler = copy.copy( get_sampler( kwargs.get('sampler', 'cdf'), self._rng ) ) # A given Sampler instance may be shared by several Evolvers, so each draws from its own copy
+        self._sampler.rng = self._rng # The copy draws from this Evolver's generator, so that the seed controls every draw
         
-        for part in self.partitions:
+        self.cache = kwargs.get('cache', TRANSITION_CACHE)
+        if self.cache is None or self.cache is False:
+            self.cache = TransitionCache(maxsize = 0)
+        assert( isinstance(self.cache, TransitionCache) ), "\n\nThe cache argument must be a TransitionCache instance, or None/False to disable caching."
         
-            ############################### Set up branch heterogeneity, if specified ################################
-            # Yes branch heterogeneity -> sanity check the (hopefully) specified root_model, and yell if not assigned or assigned incorrectly.
-            if type(part.models) is not list:
-                part.models = [part.models]
+        self.num_prob_matrices  = 0
+        self._prob_matrices = {} # All transition matrices used along the tree, keyed as in the cache. Pinned for a whole simulation (see _precompute_prob_matrices).
+        self._sampling_tables = {} # Sampling table prepared for each transition matrix, keyed as in the cache. Kept, like _prob_matrices, for a whole simulation (see _obtain_sampling_table).
+        
+        self.branch_regimes = kwargs.get('branch_regimes', False)
+        self.short_branch   = kwargs.get('short_branch', 0.1)
+        self.saturation_tol = kwargs.get('saturation_tol', 1e-8)
+        assert( 0. <= self.short_branch < 1. ), "\n\nshort_branch must be a probability between 0 and 1."
+        assert( self.saturation_tol >= 0. ), "\n\nsaturation_tol must not be negative."
+        
+        self.num_threads = kwargs.get('num_threads', 1)
+        assert( type(self.num_threads) is int and self.num_threads >= 1 ), "\n\nnum_threads must be a positive integer."
                 
-            if part.branch_het():
-                for m in part.models:
-                    if m.name == part.root_model:
-                        self.full_tree.model_flag = m.name
-                        part._root_model = m
-                assert(self.full_tree.model_flag is not None), "\n\n Your root_model does not correspond to any of the Model()/CodonModel() objects provided to your Partition() objects."
-            else:
-                part._root_model = part.models[0] 
- 
-             ################ Sanity-check (branch-)site heterogeneity ################
-            if part.site_het():
-                part.shuffle = True
-                for model in part.models:
-                    assert( len(model.rate_probs) == len(part._root_model.rate_probs) ), "For branch-site models, the number of rate categories must remain constant over the tree in a given partition."
-
-   
-            ################ Setup partition size attribute based on rate heterogeneity ################
-            #  part.size will be a list of different rate-heterogeneity size chunks. If no rate heterogeneity, will simply be a list of length 1 containing full size.
-            full = int( part.size )
-            remaining = full
-            part.size = []
-            for i in range(part._root_model.num_classes() - 1):
-                section = int( part._root_model.rate_probs[i] * full )
-                part.size.append( section )
-                remaining -= section
-            part.size.append(remaining)  
-                                     
-            assert( sum(part.size) ==  full ), "\n\nImproperly divvied up rate heterogeneity."
-            self._root_seq_length += full
-
-        ################ Final check on size ################      
-        assert(self._root_seq_length > 0), "\n\nPartitions have no size!"
-    
-    
-    def _set_code(self):
-        ''' 
-            Assign genetic code.
-        '''    
-        dim = self.partitions[0].models[0].params['state_freqs'].shape[0] 
-        if dim == 4:
-            self._code = MOLECULES.nucleotides
-        elif dim == 20:
-            self._code = MOLECULES.amino_acids
-        elif dim == 61:
-            self._code = MOLECULES.codons
-        else:
-            raise AssertionError("This should never be reached.")
+        # These dictionaries enable convenient post-processing of the simulated alignment. Otherwise we'd have to always loop over full tree, which would be very slow.
+        # Each sequence is a list containing one numpy integer array of states per partition.
+        self.leaf_seqs = {} # Store final tip sequences only
+        self.evolved_seqs = {} # Stores sequences from all nodes, including internal and tips
+        self._site_rates = [] # One numpy integer array per partition giving the rate category of each site. Shared by all nodes.
+        self.site_factors = [] # One numpy array of per-site rates per partition with continuous gamma rates (otherwise None). Shared by all nodes.
+        
+        # Compile tree and partitions, with set-up and sanity checks 
+        self.plan = kwargs.get('plan', None)
+        if self.plan is None:
+            self.plan = SimulationPlan( kwargs.get('tree', Tree()), kwargs.get('partitions', None), bl_tolerance = kwargs.get('bl_tolerance', None), bl_grid = kwargs.get('bl_grid', None) )
+        assert( isinstance(self.plan, SimulationPlan) ), "\n\nThe plan argument must be a SimulationPlan instance."
+        self._retained = self._setup_retention( kwargs.get('retain', 'all') )
+        self.storage = kwargs.get('storage', 'full')
+        assert( self.storage in ('full', 'delta') ), "\n\nThe storage argument must be either 'full' or 'delta'."
+        self.chunk_size = kwargs.get('chunk_size', None)
+        assert( self.chunk_size is None or (int(self.chunk_size) == self.chunk_size and self.chunk_size > 0) ), "\n\nchunk_size must be a positive integer."
+        assert( self.chunk_size is None or self.storage == 'full' ), "\n\nSite-chunked simulation cannot be combined with delta storage."
+        self.subtree_processes = kwargs.get('subtree_processes', None)
+        assert( self.subtree_processes is None or (int(self.subtree_processes) == self.subtree_processes and self.subtree_processes > 0) ), "\n\nsubtree_processes must be a positive integer."
+        assert( self.subtree_processes is None or (self.storage == 'full' and self.chunk_size is None) ), "\n\nParallel subtree evolution cannot be combined with delta storage or chunk_size."
+        self.site_processes = kwargs.get('site_processes', None)
+        assert( self.site_processes is None or (int(self.site_processes) == self.site_processes and self.site_processes > 0) ), "\n\nsite_processes must be a positive integer."
+        assert( self.site_processes is None or (self.storage == 'full' and self.subtree_processes is None) ), "\n\nSite-parallel simulation cannot be combined with delta storage or subtree_processes."
+        self.rng_mode = kwargs.get('rng_mode', 'stream')
+        self.block_size = kwargs.get('block_size', 4096)
+        assert( self.rng_mode in ('stream', 'counter') ), "\n\nThe rng_mode argument must be either 'stream' or 'counter'."
+        assert( self.rng_mode == 'stream' or self.seed is not None ), "\n\nCounter-based random numbers require a seed."
+        assert( int(self.block_size) == self.block_size and self.block_size > 0 ), "\n\nblock_size must be a positive integer."
+        assert( self.rng_mode == 'stream' or self.chunk_size is None or self.chunk_size % self.block_size == 0 ), "\n\nWith counter-based random numbers, chunk_size must be a multiple of block_size."
+        self.quantization_error = self.plan.quantization_error
         
             
             
             
             
             
-    def __call__(self):
+    def __call__(self, **kwargs):
         '''
             Simulate sequences, perform any necessary post-processing, and save sequences and/or other info to appropriate files.
+            Evolver instances may be called any number of times, for instance to simulate replicates. Each call replaces the previously simulated sequences (and output files).
+            
+            Optional keyword arguments include,
+                1. **seed** is an integer used to re-seed this Evolver's random number generator (and sampler) before simulating. Default is None, in which case the generator simply continues from its current state.
         
             Examples:
                 .. code-block:: python
@@ -171,14 +174,27 @@ class Evolver(object):
 
                    >>> # Custom sequence file name and format, and suppress rate information
                    >>> evolve = Evolver(tree = my_tree, partitions = my_partition_list, seqfile = "my_seqs.phy", seqfmt = "phylip", ratefile = None, infofile = None)()
+                   
+                   >>> # Simulate two replicates from a single compiled plan
+                   >>> my_evolver = Evolver(tree = my_tree, partitions = my_partition_list, seqfile = None)
+                   >>> my_evolver(seed = 1)
+                   >>> my_evolver(seed = 2)
       
         '''
+        self._reseed( kwargs.get('seed', None) )
 
-        # Simulate recursively
-        self._sim_subtree(self.full_tree)
+        # Compute all needed transition matrices in bulk
+        self._precompute_prob_matrices()
 
-        # Shuffle sequences?
-        self._shuffle_sites()
+        # Simulate along the tree, and shuffle sites if needed
+        if self.chunk_size is not None or self.site_processes is not None:
+            self._simulate_windows()
+        elif self.subtree_processes is not None:
+            self._simulate_subtrees()
+            self._permute_sites()
+        else:
+            self._simulate()
+            self._permute_sites()
 
         # Save rate info        
         if self.ratefile:
@@ -193,6 +209,131 @@ class Evolver(object):
                 self._write_sequences(self.evolved_seqs)
             else:
                 self._write_sequences(self.leaf_seqs)
+
+
+
+    def simulate_replicates(self, num_replicates, **kwargs):
+        '''
+            Simulate several replicates at once, with a single traversal of the tree. Every branch evolves all replicates' sites together, so that each transition matrix is fetched once per branch and sampling is vectorized across replicates.
+            Nothing is written to file, and the *evolved_seqs* and *leaf_seqs* attributes are not modified.
+            
+            Returns a numpy integer array of shape (number of replicates, number of leaves, number of sites) giving the states of all leaf sequences (convert to characters with the plan's *code*). Leaves are ordered as in the plan's *leaves* attribute, and partitions are concatenated along the site axis.
+            
+            Required positional arguments include,
+                1. **num_replicates** is the number of replicates to simulate.
+            
+            Optional keyword arguments include,
+                1. **seed** is an integer used to re-seed this Evolver's random number generator before simulating, as for *__call__*.
+                2. **batch_size** is the largest number of replicates simulated in a single traversal. Default is None, in which case all replicates are simulated together.
+                3. **num_processes** turns on independent replicate streams. Each replicate k is then simulated on its own, with a random number generator seeded from (master seed, k), and replicates are spread over a pool of this many worker processes. The result for each replicate therefore depends only on the master seed and k, and not on the number of processes (or of replicates). The master seed is the seed argument, or else this Evolver's seed, one of which must be given. Default is None (a single random stream, vectorized across replicates).
+                4. **first_replicate** is the index k of the first replicate to simulate, with independent replicate streams (which are used, with a single process, unless num_processes is given). Simulating replicates [a, b) of a study therefore gives exactly the corresponding part of the whole study's replicates, for example to split a study across several machines (see the ``replicates`` module). Default is 0.
+        
+            Examples:
+                .. code-block:: python
+                   
+                   >>> my_evolver = Evolver(tree = my_tree, partitions = my_partition_list)
+                   >>> alignments = my_evolver.simulate_replicates(1000, seed = 1)
+                   >>> taxa = [my_evolver.plan.node_names[index] for index in my_evolver.plan.leaves]
+                   
+                   >>> # Reproducible replicates, over 8 processes
+                   >>> alignments = my_evolver.simulate_replicates(1000, seed = 1, num_processes = 8)
+        '''
+        batch_size = kwargs.get('batch_size', None)
+        num_processes = kwargs.get('num_processes', None)
+        first_replicate = kwargs.get('first_replicate', None)
+        assert( int(num_replicates) == num_replicates and num_replicates > 0 ), "\n\nnum_replicates must be a positive integer."
+        self._reseed( kwargs.get('seed', None) )
+        if num_processes is not None or first_replicate is not None:
+            return self._simulate_independent_replicates( range(first_replicate or 0, (first_replicate or 0) + num_replicates), self.seed, num_processes or 1 )
+        assert( batch_size is None or (int(batch_size) == batch_size and batch_size > 0) ), "\n\nbatch_size must be a positive integer."
+        if batch_size is None:
+            batch_size = num_replicates
+        self._precompute_prob_matrices()
+        
+        alignments = np.empty( [num_replicates, len(self.plan.leaves), self.plan.num_sites], dtype = SEQ_DTYPE )
+        for start in range(0, num_replicates, batch_size):
+            alignments[start : start + batch_size] = self._simulate_replicate_batch( range(start, min(start + batch_size, num_replicates)) )
+        return alignments
+
+
+
+    def _simulate_replicate_batch(self, indices):
+        '''
+            Simulate the replicates with the given indices in a single traversal of the tree. Returns an integer array of shape (number of replicates, number of leaves, number of sites).
+            Each replicate's sites are stacked along the site axis, with site rate categories shuffled independently for each replicate. Replicate indices are only used with counter-based random numbers.
+        '''
+        num_batch = len(indices)
+        keep = np.zeros( self.plan.num_nodes(), dtype = bool )
+        keep[ list(self.plan.leaves) ] = True
+        batch_rates = []
+        batch_blocks = None
+        if self.rng_mode == 'counter':
+            replicate_rates = [ self._counter_rates(k) for k in indices ]
+            batch_blocks = []
+        for p in range( len(self.plan.partitions) ):
+            part_plan = self.plan.partitions[p]
+            if self.rng_mode == 'counter':
+                part_rates = np.array( [ rates[p] for rates in replicate_rates ] )
+                batch_blocks.append( sum( [ self._counter_blocks(indices[r], 0, part_plan.size, r * part_plan.size) for r in range(num_batch) ], [] ) )
+            else:
+                part_rates = np.tile( part_plan.site_rates, (num_batch, 1) )
+                if part_plan.shuffle:
+                    part_rates = part_rates[ np.arange(num_batch)[:, None], np.argsort( self._rng.random_sample(part_rates.shape), axis = 1 ) ]
+            batch_rates.append( part_rates.ravel() )
+        layout = self._site_layout(batch_rates, batch_blocks)
+        node_seqs = self._simulate_nodes( layout, self._generate_root_seq(layout), keep )
+        
+        alignments = np.empty( [num_batch, len(self.plan.leaves), self.plan.num_sites], dtype = SEQ_DTYPE )
+        for l in range(len(self.plan.leaves)):
+            alignments[:, l] = np.concatenate( [ part_seq.reshape(num_batch, -1) for part_seq in node_seqs[ self.plan.leaves[l] ] ], axis = 1 )
+        return alignments
+
+
+
+    def _simulate_independent_replicates(self, indices, seed, num_processes):
+        '''
+            Simulate the replicates with the given indices, each with its own random number generator seeded from (seed, replicate index), over a pool of worker processes. See simulate_replicates.
+        '''
+        assert( seed is not None ), "\n\nIndependent replicate streams require a master seed."
+        assert( int(num_processes) == num_processes and num_processes > 0 ), "\n\nnum_processes must be a positive integer."
+        assert( min(indices) >= 0 ), "\n\nfirst_replicate must not be negative."
+        self._precompute_prob_matrices() # Matrices are computed once, and shared with worker processes
+        if num_processes == 1:
+            replicates = [ self._simulate_replicate(seed, k) for k in indices ]
+        else:
+            pool = Pool( num_processes, _init_worker, (self, seed) )
+            try:
+                replicates = pool.map( _simulate_replicate, indices, chunksize = max(1, len(indices) // (4 * num_processes)) )
+            finally:
+                pool.close()
+                pool.join()
+        return np.array(replicates, dtype = SEQ_DTYPE)
+
+
+
+    def _simulate_replicate(self, seed, k):
+        '''
+            Simulate replicate k with a random number generator seeded from (seed, k). Returns an integer array of shape (number of leaves, number of sites).
+            This Evolver's own random number generator is restored afterwards.
+        '''
+        previous = (self._rng, self._sampler.rng)
+        self._rng = np.random.RandomState([seed, k])
+        self._sampler.rng = self._rng
+        try:
+            return self._simulate_replicate_batch([k])[0]
+        finally:
+            self._rng, self._sampler.rng = previous
+
+
+
+    def _reseed(self, seed):
+        '''
+            Re-seed this Evolver's random number generator (and sampler), unless the seed is None.
+        '''
+        if seed is not None:
+            self.seed = seed
+            self._rng = np.random.RandomState(seed)
+            self._sampler.rng = self._rng
     #########################################################################################                      
                         
                         
@@ -200,46 +341,37 @@ class Evolver(object):
                         
                         
     ######################## FUNCTIONS TO PROCESS SIMULATED SEQUENCES #######################              
-    def _site_to_sequence(self, site):
+    def _site_to_sequence(self, int_seq):
         '''
-            Convert a single Site() object or list of Site() objects into a sequence string.
-            Argument *site* is either a Site() object or a list of them.
+            Convert an array of integer states into a sequence string.
+            Argument *int_seq* is a numpy integer array (or list) of states.
+            All states of a code have the same width, so the string is read directly from a fixed-width character array, without creating a Python object per site.
         '''
-        if type(site) is list:
-            sequence = ''
-            for s in site:
-                sequence += self._code[s.int_seq]
-        else:
-            sequence = self._code[site.int_seq]
-        return sequence
+        return np.array(self.plan.code)[ np.asarray(int_seq, dtype = SEQ_DTYPE) ].tostring()
 
 
 
 
-    def _shuffle_sites(self):
+    def _permute_sites(self):
         ''' 
-            Shuffle evolved sequences within partitions, if specified.
-            In particular, we shuffle sequences in the self.evolved_seqs dictionary, and then we copy over to the self.leaf_seqs dictionary.            
+            Shuffle sites within partitions with site heterogeneity, by drawing a single permutation per partition. Permutations are applied to the rate categories, and to evolved sequences only when they are accessed or written (the evolved_seqs and leaf_seqs dictionaries become read-only PermutedSequences or DeltaSequences, see the ``storage`` module).
+            With counter-based random numbers, rate categories are shuffled before simulating, so that sites are already in their final order.
         ''' 
-        start = 0
-        for part_index in range( len(self.partitions) ):            
-            part = self.partitions[part_index]
-            if part.shuffle:
-                size = sum( part.size )
-                part_pos = np.arange( size ) + start
-                np.random.shuffle(part_pos)     
-                for record in self.evolved_seqs:
-                    temp = []
-                    for pp in part_pos:
-                        temp.append( self.evolved_seqs[record][part_index][pp] )
-                    self.evolved_seqs[record][part_index][start:start + size] = temp
-
-        # Apply shuffling to self.leaf_seqs
-        for record in self.leaf_seqs:
-            self.leaf_seqs[record] = self.evolved_seqs[record]
-
-               
-                    
+        if self.rng_mode == 'counter':
+            return
+        permutations = []
+        for p in range( len(self.plan.partitions) ):
+            permutation = None
+            if self.plan.partitions[p].shuffle:
+                permutation = self._rng.permutation( self.plan.partitions[p].size )
+                self._site_rates[p] = self._site_rates[p][permutation]
+                if self.storage == 'delta':
+                    self.evolved_seqs.permute(p, permutation)
+            permutations.append(permutation)
+        if self.storage == 'full' and any( permutation is not None for permutation in permutations ):
+            self.evolved_seqs = PermutedSequences(self.evolved_seqs, permutations)
+            self.leaf_seqs = PermutedSequences(self.leaf_seqs, permutations)
+
 
 
     def _write_sequences(self, seqdict):
@@ -251,12 +383,8 @@ class Evolver(object):
         from Bio.Alphabet import generic_alphabet
         from Bio import SeqIO
 
-        alignment = [] 
-        for entry in seqdict:
-            merged_entry = list( itertools.chain.from_iterable( seqdict[entry] ) )
-            sequence = self._site_to_sequence( merged_entry )
-            seq_object = SeqRecord( Seq( sequence , generic_alphabet ), id = entry, description = "")
-            alignment.append(seq_object)
+        # Records are created one at a time as they are written. Sequences are also rebuilt (or permuted) one at a time, for DeltaSequences and PermutedSequences.
+        alignment = ( SeqRecord( Seq( self._site_to_sequence( np.concatenate(seq) ), generic_alphabet ), id = entry, description = "") for entry, seq in seqdict.iteritems() )
         try:
             print self.seqfile
             print self.seqfmt
@@ -270,16 +398,21 @@ class Evolver(object):
         '''
             Write ratefile, a tab-delimited file containing site-specific rate information. Considers leaf sequences only.
             Writes -   Site_Index    Partition_Index     Rate_Category
+            If any partition uses continuous gamma rates, also writes the rate drawn for each of its sites in a fourth column, Rate_Factor (NA for sites of other partitions).
             All indexing is from *1*.
         '''
-        refseq = self.leaf_seqs.values()[0]
+        continuous = any( part_factors is not None for part_factors in self.site_factors )
         with open(self.ratefile, 'w') as ratef:
             ratef.write("Site_Index\tPartition_Index\tRate_Category")
+            if continuous:
+                ratef.write("\tRate_Factor")
             site_index = 1
-            for p in range(len(refseq)):
-                part = refseq[p]
-                for i in range(len(part)):
-                    w = "\n" + str(site_index) + "\t" + str(p +  1) + "\t" + str(part[i].rate + 1)
+            for p in range(len(self._site_rates)):
+                part_factors = self.site_factors[p] if continuous else None
+                for i, rate in enumerate(self._site_rates[p]):
+                    w = "\n" + str(site_index) + "\t" + str(p +  1) + "\t" + str(rate + 1)
+                    if continuous:
+                        w += "\t" + ( "NA" if part_factors is None else str(part_factors[i]) )
                     ratef.write(w)
                     site_index += 1
         
@@ -292,15 +425,17 @@ class Evolver(object):
         '''
         with open(self.infofile, 'w') as infof:
             infof.write("Partition_Index\tModel_Name\tRate_Category\tRate_Probability\tRate_Factor")
-            for p in range( len(self.partitions) ):
-                part = self.partitions[p]  
-                prob_list = part._root_model.rate_probs      
+            for p in range( len(self.plan.partitions) ):
+                part_plan = self.plan.partitions[p]  
+                prob_list = part_plan.root_model.rate_probs      
                         
-                for m in part.models:
+                for m in part_plan.models:
                     for r in range(len(prob_list)):
                         outstr = "\n" + str(p+1) + "\t" + str(m.name) + "\t" + str(r+1) + "\t" + str(round(prob_list[r], 4)) + "\t"
                         if m.codon_model():
                             infof.write(outstr + str(round(m.params['beta'][r],4)) + "," + str(round(m.params['alpha'][r],4)) )
+                        elif m.continuous:
+                            infof.write(outstr + "gamma(" + str(round(m.alpha,4)) + ")" )
                         else:
                             infof.write(outstr + str(round(m.rate_factors[r],4)) )
                                 
@@ -311,167 +446,678 @@ class Evolver(object):
         
         
     ######################### FUNCTIONS INVOLVED IN SEQUENCE EVOLUTION ############################
-    def _obtain_model(self, part, flag):
-        '''
-            Obtain the appropriate Model()/CodonModel() for evolution along a particular branch.
+    def _generate_root_seq(self, layout):
+        ''' 
+            Generate a root sequence based on the stationary frequencies.
+            Return a complete root sequence, as a list containing a numpy integer array for each partition.
+            
+            Required positional arguments include,
+                1. **layout** gives the sites to simulate (see _site_layout).
         '''
-        my_model = None
-        if part.branch_het():
-            my_model = None
-            for m in part.models:
-                if m.name == flag:
-                    my_model = m
-                    break
-        else:
-            my_model = part.models[0]
-        assert( my_model is not None ), "\n\nCould not retrieve model a particular branch's evolution."
-        return my_model
+        
+        root_sequence = [ np.empty(part_size, dtype = SEQ_DTYPE) for (part_size, category_sites, part_rates, part_blocks, part_factors) in layout ] # This will contain an array of integer states for each partition's sequence
+        for parts in self.plan.root_fused:
+            
+            # Generate root_sequence from the root model's frequencies, at once for all partitions which share the root model. Each site's rate class is fixed by the layout.
+            freqs = self.plan.partitions[ parts[0] ].root_model.params['state_freqs']
+            if layout[ parts[0] ][3] is not None:
+                for p in parts:
+                    for (replicate, block, start, end) in layout[p][3]:
+                        root_sequence[p][start:end] = self._counter_sample( (replicate, 0, p, block), self._sampler.sample_freqs, freqs, end - start )
+                continue
+            sizes = [ layout[p][0] for p in parts ]
+            if sum(sizes) > 0:
+                states = self._sampler.sample_freqs( freqs, sum(sizes) )
+                for p, part_states in zip( parts, np.split(states, np.cumsum(sizes)[:-1]) ):
+                    root_sequence[p][:] = part_states
+        return root_sequence
 
 
     
-    
-    
-    def _generate_prob_from_unif(self, prob_array):
-        ''' 
-            Sample a sequence (nuc,aa,or codon), and return an integer for the sequence chosen from a uniform distribution.
-            Arugment *prob_array* is any list and/or numpy array of probabilities which sum to 1.
+    def _site_layout(self, site_rates = None, blocks = None):
         '''
-        
-        assert ( abs(np.sum(prob_array) - 1.) < ZERO), "Probabilities do not sum to 1. Cannot generate a new sequence."
-        r = rn.uniform(0,1)
-        i = 0
-        sum = prob_array[i]
-        while sum < r:
-            i += 1
-            sum += prob_array[i]
-        return i     
+            Return the layout of the sites to simulate, a list containing a tuple (number of sites, list of the sites in each rate category, rate category of each site, counter-based blocks, rate of each site) for each partition.
+            By default, all sites are simulated, and each rate category is a contiguous slice of its partition (see the plan module). With counter-based random numbers, rate categories are instead shuffled as for replicate 0 (see _counter_rates).
+            The rate of each site is None unless the partition uses continuous gamma rates, in which case rates are drawn (see _draw_site_factors).
+            
+            Optional keyword arguments include,
+                1. **site_rates** is a list giving, for each partition, an integer array of the rate category of each site to simulate (e.g. a window of sites, or the sites of several replicates).
+                2. **blocks** is a list giving, for each partition, the list of counter-based blocks (see _counter_blocks) covering the sites to simulate. Default is None, in which case random numbers are drawn from this Evolver's generator.
+        '''
+        if site_rates is None and self.rng_mode == 'counter':
+            site_rates = self._counter_rates(0)
+            blocks = [ self._counter_blocks(0, 0, part_plan.size) for part_plan in self.plan.partitions ]
+        layout = []
+        for p in range( len(self.plan.partitions) ):
+            part_plan = self.plan.partitions[p]
+            part_blocks = None if blocks is None else blocks[p]
+            if site_rates is None:
+                bounds = np.cumsum( (0,) + part_plan.sizes )
+                part_size, part_rates = part_plan.size, part_plan.site_rates
+                category_sites = [ slice(bounds[i], bounds[i+1]) for i in range(len(part_plan.sizes)) ]
+            elif len(part_plan.sizes) == 1:
+                part_size, part_rates = len(site_rates[p]), site_rates[p]
+                category_sites = [ slice(0, part_size) ]
+            else:
+                part_size, part_rates = len(site_rates[p]), site_rates[p]
+                category_sites = [ np.flatnonzero(part_rates == i) for i in range(len(part_plan.sizes)) ]
+            part_factors = self._draw_site_factors(p, part_size, part_blocks)
+            layout.append( (part_size, category_sites, part_rates, part_blocks, part_factors) )
+        return layout
+
+
 
-  
+    def _draw_site_factors(self, p, size, blocks = None):
+        '''
+            Return the rates of **size** sites of the p-th partition, drawn from its root model's continuous gamma distribution, or None if the partition uses rate categories.
+            With counter-based blocks (see _counter_blocks), each block's rates are drawn from a generator keyed on (seed, replicate, number of nodes + 1, partition, block).
+        '''
+        root_model = self.plan.partitions[p].root_model
+        if not root_model.continuous:
+            return None
+        if blocks is None:
+            return root_model.draw_site_rates(size, self._rng)
+        site_factors = np.empty(size)
+        for (replicate, block, start, end) in blocks:
+            site_factors[start:end] = root_model.draw_site_rates( end - start, counter_rng( (self.seed, replicate, self.plan.num_nodes() + 1, p, block) ) )
+        return site_factors
+
+
+
+    def _shuffled_rates(self):
+        '''
+            Return the rate category of each site of each partition, as a list of integer arrays. Categories are shuffled, with a single permutation per partition with site heterogeneity, so that windows of sites are simulated directly in their final order.
+            With counter-based random numbers, categories are shuffled as for replicate 0 (see _counter_rates).
+        '''
+        if self.rng_mode == 'counter':
+            return self._counter_rates(0)
+        site_rates = []
+        for part_plan in self.plan.partitions:
+            if part_plan.shuffle:
+                site_rates.append( self._rng.permutation(part_plan.site_rates) )
+            else:
+                site_rates.append(part_plan.site_rates)
+        return site_rates
+
+
+
+    def _counter_blocks(self, replicate, start, end, offset = 0):
+        '''
+            Return the counter-based blocks covering sites [start, end) of a partition, for a given replicate, when these sites are stored from position offset of the simulated arrays.
+            Each block is a tuple (replicate, block index, first position, last position + 1). Blocks hold block_size sites, counted from the start of the partition, and start must be a multiple of block_size.
+        '''
+        return [ (replicate, b, offset + b * self.block_size - start, offset + min(end, (b + 1) * self.block_size) - start) for b in range(start // self.block_size, (end + self.block_size - 1) // self.block_size) ]
+
+
+
+    def _counter_rates(self, replicate):
+        '''
+            Return the rate category of each site of each partition, for a given replicate with counter-based random numbers. Categories are shuffled with a generator keyed on (seed, replicate, number of nodes, partition, 0).
+        '''
+        site_rates = []
+        for p in range( len(self.plan.partitions) ):
+            part_plan = self.plan.partitions[p]
+            if part_plan.shuffle:
+                site_rates.append( counter_rng( (self.seed, replicate, self.plan.num_nodes(), p, 0) ).permutation(part_plan.site_rates) )
+            else:
+                site_rates.append(part_plan.site_rates)
+        return site_rates
+
+
+
+    def _counter_sample(self, key, function, *args):
+        '''
+            Call a sampling function, with the sampler drawing from a generator keyed on (seed,) + key. The sampler's own generator is restored afterwards.
+        '''
+        previous = self._sampler.rng
+        self._sampler.rng = counter_rng( (self.seed,) + tuple(key) )
+        try:
+            return function(*args)
+        finally:
+            self._sampler.rng = previous
+
+        
         
-    def _generate_root_seq(self):
+    def _setup_retention(self, retain):
+        '''
+            Return a boolean array indicating, for each node in the plan, whether its sequence is retained after simulating.
+        '''
+        retained = np.zeros( self.plan.num_nodes(), dtype = bool )
+        retained[ list(self.plan.leaves) ] = True
+        if retain == 'all':
+            retained[:] = True
+        elif retain != 'leaves':
+            assert( type(retain) in (list, tuple, set) ), "\n\nThe retain argument must be either 'all', 'leaves', or a list of internal node names."
+            indices = dict( (self.plan.node_names[i], i) for i in range(self.plan.num_nodes()) )
+            for name in retain:
+                assert( name in indices ), "\n\nNode " + str(name) + ", given in the retain argument, is not in the tree."
+                retained[ indices[name] ] = True
+        return retained
+
+
+
+    def _simulate(self):
         ''' 
-            Generate a root sequence based on the stationary frequencies.
-            Return a complete root sequence list of Site objects.
+            Simulate full-length sequences for all nodes, and store retained sequences in the evolved_seqs and leaf_seqs dictionaries.
         '''
+        layout = self._site_layout()
+        self._site_rates = [ part_rates for (part_size, category_sites, part_rates, part_blocks, part_factors) in layout ]
+        self.site_factors = [ part_factors for (part_size, category_sites, part_rates, part_blocks, part_factors) in layout ]
+        root_seq = self._generate_root_seq(layout)
+        store = None
+        if self.storage == 'delta':
+            store = DeltaSequences(self.plan, root_seq)
+        if store is not None:
+            node_seqs = self._simulate_nodes( layout, root_seq, np.zeros(self.plan.num_nodes(), dtype = bool), store )
+        else:
+            node_seqs = self._simulate_nodes( layout, root_seq, self._retained )
+
+        if store is not None:
+            self.evolved_seqs = store.view( [ self.plan.node_names[index] for index in np.nonzero(self._retained)[0] ] )
+            self.leaf_seqs = store.view( [ self.plan.node_names[index] for index in self.plan.leaves ] )
+            return
+        self.evolved_seqs = {}
+        for index in np.nonzero(self._retained)[0]:
+            self.evolved_seqs[ self.plan.node_names[index] ] = node_seqs[index]
+        self.leaf_seqs = {}
+        for index in self.plan.leaves:
+            self.leaf_seqs[ self.plan.node_names[index] ] = node_seqs[index]
+
+
+
+    def _simulate_windows(self):
+        '''
+            Simulate sequences one window of sites at a time, either in this process (site-chunked simulation) or in a pool of worker processes (site-parallel simulation). Each window holds at most chunk_size sites (by default, all sites) of a single partition, and is evolved with a random number generator seeded from (a seed drawn by this Evolver, window index), so that results depend neither on the number of processes nor on whether windows are simulated in parallel.
+            Retained sequences are written into a matrix, stored in a temporary file for site-chunked simulation or in shared memory for site-parallel simulation, and the evolved_seqs and leaf_seqs dictionaries then contain views into this matrix.
+            Likewise, continuous gamma rates are drawn for each window as it is simulated, and written into an array stored in the same way, of which site_factors then contains views.
+        '''
+        self._site_rates = self._shuffled_rates()
+        windows = [] # (partition index, first site, last site + 1)
+        for p in range( len(self.plan.partitions) ):
+            part_plan = self.plan.partitions[p]
+            window_size = part_plan.size if self.chunk_size is None else self.chunk_size
+            for start in range(0, part_plan.size, window_size):
+                windows.append( (p, start, min(start + window_size, part_plan.size)) )
         
-        root_sequence = [] # This will contain a list for each partition's sequence (which is itself a list of Site() objects)
+        retained = np.nonzero(self._retained)[0]
+        rows = np.zeros( self.plan.num_nodes(), dtype = int ) # node index -> row in matrix
+        rows[retained] = np.arange( len(retained) )
+        if self.site_processes is None:
+            matrix = np.memmap( tempfile.TemporaryFile(), dtype = SEQ_DTYPE, mode = 'w+', shape = (len(retained), self.plan.num_sites) )
+            output = matrix
+        else:
+            output = RawArray( 'b', len(retained) * self.plan.num_sites )
+            matrix = self._shared_matrix(output)
+        factors = None
+        factor_output = None
+        if any( part_plan.root_model.continuous for part_plan in self.plan.partitions ):
+            if self.site_processes is None:
+                factors = np.memmap( tempfile.TemporaryFile(), dtype = float, mode = 'w+', shape = (self.plan.num_sites,) )
+                factor_output = factors
+            else:
+                factor_output = RawArray( 'd', self.plan.num_sites )
+                factors = np.frombuffer( factor_output, dtype = float )
+        
+        self._window_job = (windows, rows, output, factor_output, self._rng.randint(2**31))
+        try:
+            if self.site_processes is None or self.site_processes == 1:
+                for w in range(len(windows)):
+                    self._simulate_window(w)
+            else:
+                pool = Pool( self.site_processes, _init_worker, (self,) )
+                try:
+                    pool.map( _simulate_window, range(len(windows)), chunksize = 1 )
+                finally:
+                    pool.close()
+                    pool.join()
+        finally:
+            self._window_job = None
+        if self.site_processes is None:
+            matrix.flush()
+        
+        offsets = np.cumsum( [0] + [ part_plan.size for part_plan in self.plan.partitions ] )
+        self.site_factors = [ factors[ offsets[p] : offsets[p+1] ] if self.plan.partitions[p].root_model.continuous else None for p in range( len(self.plan.partitions) ) ]
+        self.evolved_seqs = {}
+        for index in retained:
+            self.evolved_seqs[ self.plan.node_names[index] ] = [ matrix[ rows[index], offsets[p] : offsets[p+1] ] for p in range( len(self.plan.partitions) ) ]
+        self.leaf_seqs = {}
+        for index in self.plan.leaves:
+            self.leaf_seqs[ self.plan.node_names[index] ] = self.evolved_seqs[ self.plan.node_names[index] ]
 
-        for part in self.partitions:
-            
-            # Grab model info for this partition to get frequency vector for root simulation
-            root_model = self._obtain_model(part, self.full_tree.model_flag)
-
-            # Generate root_sequence and assign the Site a rate class
-            part_root = []
-            for i in range( root_model.num_classes() ):
-                for j in range( part.size[i] ):
-                    new_site = Site()
-                    new_site.rate = i
-                    new_site.int_seq = self._generate_prob_from_unif( root_model.params['state_freqs'] )
-                    part_root.append( new_site )
-            assert( len(part_root) == sum(part.size) ), "\n\nRoot sequence improperly generated for a partition, evolution cannot happen."
-            root_sequence.append(part_root)
-        return root_sequence
 
+
+    def _simulate_window(self, w):
+        '''
+            Evolve the w-th window of sites (see _simulate_windows) along the whole tree, with a random number generator seeded from (the simulation's seed, w), and write its retained sequences (and any continuous gamma rates, drawn with the same generator or from counter-based blocks) into the output arrays.
+            This Evolver's own random number generator is restored afterwards.
+        '''
+        windows, rows, output, factor_output, seed = self._window_job
+        p, start, end = windows[w]
+        matrix = output if isinstance(output, np.ndarray) else self._shared_matrix(output)
+        part_rates = self._site_rates[p][start : end]
+        blocks = None
+        if self.rng_mode == 'counter':
+            blocks = [ self._counter_blocks(0, start, end) if q == p else [] for q in range( len(self.plan.partitions) ) ]
+        
+        previous = (self._rng, self._sampler.rng)
+        self._rng = np.random.RandomState([seed, w])
+        self._sampler.rng = self._rng
+        try:
+            layout = self._site_layout( [ part_rates if q == p else part_rates[:0] for q in range( len(self.plan.partitions) ) ], blocks )
+            node_seqs = self._simulate_nodes( layout, self._generate_root_seq(layout), self._retained )
+        finally:
+            self._rng, self._sampler.rng = previous
+        first = sum( part_plan.size for part_plan in self.plan.partitions[:p] ) + start
+        for index in np.nonzero(self._retained)[0]:
+            matrix[ rows[index], first : first + end - start ] = node_seqs[index][p]
+        if layout[p][4] is not None:
+            factors = factor_output if isinstance(factor_output, np.ndarray) else np.frombuffer( factor_output, dtype = float )
+            factors[first : first + end - start] = layout[p][4]
+
+
+
+    def _simulate_subtrees(self):
+        '''
+            Simulate full-length sequences, by evolving the top of the tree in this process and handing the disjoint subtrees below it to a pool of worker processes (see _split_subtrees).
+            Subtree root sequences and all retained sequences are written into matrices in shared memory, and the evolved_seqs and leaf_seqs dictionaries then contain views into these matrices.
+        '''
+        layout = self._site_layout()
+        self._site_rates = [ part_rates for (part_size, category_sites, part_rates, part_blocks, part_factors) in layout ]
+        self.site_factors = [ part_factors for (part_size, category_sites, part_rates, part_blocks, part_factors) in layout ]
+        frontier, owner = self._split_subtrees(NUM_SUBTREES)
+        top_groups = []
+        subtree_groups = [ [] for f in frontier ]
+        for group in self.plan.groups:
+            if owner[group.parent] < 0:
+                top_groups.append(group)
+            else:
+                subtree_groups[ owner[group.parent] ].append(group)
         
+        # Evolve the top of the tree, keeping the sequences of subtree roots
+        keep = self._retained.copy()
+        keep[frontier] = True
+        node_seqs = self._simulate_nodes( layout, self._generate_root_seq(layout), keep, groups = top_groups )
         
-    def _sim_subtree(self, current_node, parent_node = None):
-        ''' 
-            Function to traverse a Tree object recursively and simulate sequences.
-            Required positional arguments include,
-                1. **current_node** is the node (either internal node or leaf) TO WHICH we evolving
-                2. **parent_node** is the node we are evolving FROM. Default of None is only called when the root sequence is not yet made.
+        retained = np.nonzero(self._retained)[0]
+        rows = np.zeros( self.plan.num_nodes(), dtype = int ) # node index -> row in the retained matrix
+        rows[retained] = np.arange( len(retained) )
+        retained_buffer = RawArray( 'b', len(retained) * self.plan.num_sites )
+        frontier_buffer = RawArray( 'b', len(frontier) * self.plan.num_sites )
+        retained_matrix = self._shared_matrix(retained_buffer)
+        frontier_matrix = self._shared_matrix(frontier_buffer)
+        for index in retained:
+            if owner[index] < 0:
+                retained_matrix[ rows[index] ] = np.concatenate( node_seqs[index] )
+        for j in range(len(frontier)):
+            frontier_matrix[j] = np.concatenate( node_seqs[ frontier[j] ] )
+        node_seqs = None
+        
+        # Evolve the subtrees, largest first
+        self._subtree_job = (layout, frontier, subtree_groups, rows, retained_buffer, frontier_buffer, self._rng.randint(2**31))
+        order = sorted( range(len(frontier)), key = lambda j: -len(subtree_groups[j]) )
+        try:
+            if self.subtree_processes == 1:
+                for j in order:
+                    self._simulate_subtree(j)
+            else:
+                pool = Pool( self.subtree_processes, _init_worker, (self,) )
+                try:
+                    pool.map( _simulate_subtree, order, chunksize = 1 )
+                finally:
+                    pool.close()
+                    pool.join()
+        finally:
+            self._subtree_job = None
+        
+        offsets = np.cumsum( [0] + [ part_plan.size for part_plan in self.plan.partitions ] )
+        self.evolved_seqs = {}
+        for index in retained:
+            self.evolved_seqs[ self.plan.node_names[index] ] = [ retained_matrix[ rows[index], offsets[p] : offsets[p+1] ] for p in range( len(self.plan.partitions) ) ]
+        self.leaf_seqs = {}
+        for index in self.plan.leaves:
+            self.leaf_seqs[ self.plan.node_names[index] ] = self.evolved_seqs[ self.plan.node_names[index] ]
+
+
+
+    def _simulate_subtree(self, j):
+        '''
+            Evolve the j-th subtree of a parallel subtree simulation (see _simulate_subtrees), with a random number generator seeded from (the simulation's seed, j), and write its retained sequences into shared memory.
+            This Evolver's own random number generator is restored afterwards.
         '''
+        layout, frontier, subtree_groups, rows, retained_buffer, frontier_buffer, seed = self._subtree_job
+        offsets = np.cumsum( [ part_plan.size for part_plan in self.plan.partitions ] )[:-1]
+        root_seq = np.split( self._shared_matrix(frontier_buffer)[j], offsets )
+        retained_matrix = self._shared_matrix(retained_buffer)
         
-        # We are at the base and must generate root sequence
-        if (parent_node is None):
-            current_node.seq = self._generate_root_seq() # the .seq attribute is actually a list of Site() objects.
-            self.evolved_seqs['root'] = current_node.seq
-        else:
-            current_node.seq = self._evolve_branch(current_node, parent_node) 
-            self.evolved_seqs[current_node.name] = current_node.seq
+        previous = (self._rng, self._sampler.rng)
+        self._rng = np.random.RandomState([seed, j])
+        self._sampler.rng = self._rng
+        try:
+            node_seqs = self._simulate_nodes( layout, root_seq, self._retained, groups = subtree_groups[j], root = frontier[j] )
+        finally:
+            self._rng, self._sampler.rng = previous
+        for index in range( self.plan.num_nodes() ):
+            if node_seqs[index] is not None and self._retained[index]:
+                retained_matrix[ rows[index] ] = np.concatenate( node_seqs[index] )
 
-            
-        # We are at an internal node. Keep evolving
-        if len(current_node.children)>0:
-            for child_node in current_node.children:
-                self._sim_subtree(child_node, current_node)
-                
-        # We are at a leaf. Save the final sequence
-        else: 
-            self.leaf_seqs[current_node.name] = current_node.seq
 
+
+    def _split_subtrees(self, num_subtrees):
+        '''
+            Split the tree into disjoint subtrees, by repeatedly replacing the largest subtree with the subtrees of its children, until there are at least num_subtrees (or no subtree can be split).
+            Returns a tuple (list of subtree root indices, array giving the index in that list of the subtree containing each node, or -1 for nodes above all subtrees).
+        '''
+        num_nodes = self.plan.num_nodes()
+        sizes = np.ones( num_nodes, dtype = int )
+        children = [ [] for index in range(num_nodes) ]
+        for group in reversed(self.plan.groups):
+            for child in group.children:
+                sizes[group.parent] += sizes[child]
+                children[group.parent].append(child)
         
-            
-            
-    def _check_parent_branch(self, parent_node, current_node):
+        frontier = [0]
+        while len(frontier) < num_subtrees:
+            largest = max( frontier, key = lambda index: sizes[index] )
+            if sizes[largest] == 1:
+                break
+            frontier.remove(largest)
+            frontier.extend( children[largest] )
+        
+        owner = -np.ones( num_nodes, dtype = int )
+        owner[frontier] = np.arange( len(frontier) )
+        for group in self.plan.groups:
+            if owner[group.parent] >= 0:
+                owner[ list(group.children) ] = owner[group.parent]
+        return frontier, owner
+
+
+
+    def _shared_matrix(self, buffer):
+        '''
+            Return a numpy view of a shared-memory buffer as a matrix with one row of states per sequence (all partitions concatenated).
+        '''
+        return np.frombuffer( buffer, dtype = SEQ_DTYPE ).reshape(-1, self.plan.num_sites)
+
+
+
+    def _simulate_nodes(self, layout, root_seq, keep, store = None, groups = None, root = 0):
         ''' 
-            Function ensures that, for a given node we'd like to evolve to, an appropriate branch length exists. 
-            If the branch length is acceptable, an evolutionary model is then assigned to the node if one has yet been assigned.
+            Simulate sequences for all nodes, following the plan's branch groups from the root towards the leaves, and return a list of each node's sequence (None for nodes which are not kept).
+            Children of a node which share both a branch length and a model are evolved together, in a single batched draw from the parent sequence.
+            Sequences which are not kept are released as soon as all of their node's children have been evolved.
             
             Required positional arguments include,
-                1. **parent_node** is node FROM which we evolve
-                2. **current_node** is the node (either internal node or leaf) TO WHICH we evolve
-        '''
-        assert (parent_node.seq != None), "\n\nThere is no parent sequence from which to evolve!"
-        assert (current_node.branch_length >= 0.), "\n\n Your tree has a negative branch length. I'm going to quit now."
-        if current_node.model_flag is None:
-            current_node.model_flag = parent_node.model_flag
-            
+                1. **layout** gives the sites to simulate (see _site_layout).
+                2. **root_seq** is the root's sequence.
+                3. **keep** is a boolean array giving whether each node's sequence is kept.
             
+            Optional keyword arguments include,
+                1. **store** is a DeltaSequences instance, holding the same root sequence, in which all other sequences are stored (as they are evolved).
+                2. **groups** is the list of BranchGroups to evolve, ordered such that a group's parent is always evolved first. Default is None, in which case all of the plan's groups are evolved.
+                3. **root** is the index of the node whose sequence is root_seq. Default is 0 (the root of the tree).
+        '''
+        node_seqs = [None] * self.plan.num_nodes() # Each node's sequence is a list of integer arrays, one per partition.
+        remaining = list(self.plan.num_children) # Number of each node's children not yet evolved
+        node_seqs[root] = root_seq
+        if groups is None:
+            groups = self.plan.groups
+        
+        for group in groups:
+            sibling_seqs = self._evolve_siblings(group, node_seqs[group.parent], layout)
+            for k in range(len(group.children)):
+                child = group.children[k]
+                if store is not None:
+                    store.add(child, node_seqs[group.parent], sibling_seqs[k])
+                if remaining[child] > 0 or keep[child]:
+                    node_seqs[child] = sibling_seqs[k]
+            remaining[group.parent] -= len(group.children)
+            if remaining[group.parent] == 0 and not keep[group.parent]:
+                node_seqs[group.parent] = None
+        return node_seqs
+        
             
             
             
-    def _evolve_branch(self, current_node, parent_node):
-        ''' 
-            Function to evolve a given sequence during tree traversal.
             
-            Required positional arguments include, 
-                1. **current_node** is the node (either internal node or leaf) we are evolving TO
-                2. **parent_node** is the node we are evolving FROM.
+    def _prob_matrix_key(self, model, category, branch_length):
         '''
-
-        # Ensure parent sequence exists and branch length is acceptable. Return the model flag to use here.
-        self._check_parent_branch(parent_node, current_node)
- 
-        # Evolve only if branch length is greater than 0 (1e-8). 
-        if current_node.branch_length <= ZERO:
-            new_seq = deepcopy(parent_node.seq)
+            Return the key under which a transition matrix is cached.
+        '''
+        return (model._matrix_id, category, model._category_matrix(category)[1], float(branch_length))
+        
+        
         
+    def _precompute_prob_matrices(self):
+        '''
+            Compute every transition matrix needed to evolve along the tree which is not already cached, and store them in the cache.
+            For each model and rate category, matrices for all branch lengths are computed at once (e.g. in closed form for standard nucleotide models), rather than one branch at a time.
+            If num_threads is greater than 1, branch lengths are split into chunks which are computed in a thread pool.
+            All matrices used along the tree, whether computed or found in the cache, are also kept for the whole simulation (in _prob_matrices), so that none is computed again when the tree needs more matrices than the cache holds (or caching is disabled).
+            Also records the number of distinct transition matrices used, and the maximum error induced by branch-length quantization.
+        '''
+        needed = {} # (model matrix id, category) -> [model, list of branch lengths]
+        used   = {} # Key of each transition matrix used along the tree -> (model, category, branch length)
+        self._collect_branch_lengths(needed, used)
+        self.num_prob_matrices = len(used)
+        
+        # Keep cached matrices before any are evicted by those computed below
+        self._prob_matrices = {}
+        self._sampling_tables = {}
+        for key in used:
+            if key in self.cache:
+                model, category, branch_length = used[key]
+                self._prob_matrices[key] = self.cache.get(key, lambda: model.compute_prob_matrix(branch_length, category))
+        
+        tasks = [] # (model, category, branch lengths) to compute in a single call
+        for (matrix_id, category) in needed:
+            model, branch_lengths = needed[(matrix_id, category)]
+            chunk = int( np.ceil( len(branch_lengths) / float(self.num_threads) ) )
+            for start in range(0, len(branch_lengths), chunk):
+                tasks.append( (model, category, branch_lengths[start : start + chunk]) )
+        
+        if self.num_threads > 1 and len(tasks) > 1:
+            pool = ThreadPool( min(self.num_threads, len(tasks)) )
+            try:
+                results = pool.map(self._compute_prob_matrices, tasks)
+            finally:
+                pool.close()
+                pool.join()
         else:
-            new_seq = []            
-            
-            for p in range( len(self.partitions) ):
-                # Obtain current model for this partition at this branch
-                part = self.partitions[p]
-                current_model = self._obtain_model(part, current_node.model_flag)
-                index = 0
-                part_new_seq = []  # will temporarily store this partition's new sequence
+            results = [ self._compute_prob_matrices(task) for task in tasks ]
+        
+        for (model, category, branch_lengths), prob_matrices in zip(tasks, results):
+            for k in range(len(branch_lengths)):
+                key = self._prob_matrix_key(model, category, branch_lengths[k])
+                self.cache.put( key, prob_matrices[k] )
+                self._prob_matrices[key] = prob_matrices[k]
                 
-                for i in range( current_model.num_classes() ):
-                    # Grab instantaneous rate matrix, which is done differently depending if codon (dN/dS) model or not. This is the rate het in the partition.
-                    inst_matrix = None
-                    if part.codon_model():
-                        inst_matrix = current_model.matrices[i]
-                    else:
-                        inst_matrix = current_model.matrix * current_model.rate_factors[i] # note that rate_factors = [1.] if no site heterogeneity, so matrix unchanged
-                    assert( inst_matrix is not None ), "\n\nCouldn't retrieve instantaneous rate matrix."
-                    
-                    # Generate transition matrix and assert correct
-                    prob_matrix = linalg.expm( np.multiply(inst_matrix, float(current_node.branch_length) ) )
-                    assert( np.allclose( np.sum(prob_matrix, axis = 1), np.ones(len(self._code))) ), "Rows in transition matrix do not each sum to 1."
                 
-                    # Evolve branch
-                    part_parent_seq = parent_node.seq[p][index : index + part.size[i]]
-                    for j in range( part.size[i] ):
-                        new_site = deepcopy( part_parent_seq[j] )
-                        new_site.int_seq = self._generate_prob_from_unif( prob_matrix[ new_site.int_seq ] )
-                        part_new_seq.append( new_site )
-                        index += 1
-                new_seq.append( part_new_seq )
-        return new_seq
+                
+    def _compute_prob_matrices(self, task):
+        '''
+            Compute the transition matrices for a single task, a tuple (model, rate category, list of branch lengths).
+        '''
+        model, category, branch_lengths = task
+        return model.compute_prob_matrices(branch_lengths, category)
+                
+                
+                
+    def _collect_branch_lengths(self, needed, used):
+        '''
+            Collect, for each model and rate category, the distinct branch lengths (from the plan's branch groups) whose transition matrices are not yet cached.
+        '''
+        for group in self.plan.groups:
+            if group.branch_length > ZERO:
+                for model in group.models:
+                    if model.continuous:
+                        continue # Per-site transition probabilities are computed along each branch instead (see _sample_sites)
+                    for i in range( model.num_classes() ):
+                        if self._saturated(model, i, group.branch_length):
+                            continue
+                        key = self._prob_matrix_key(model, i, group.branch_length)
+                        if key not in used and key not in self.cache:
+                            needed.setdefault( (model._matrix_id, i), [model, []] )[1].append(group.branch_length)
+                        used[key] = (model, i, group.branch_length)
+
 
+
+    def _saturated(self, model, category, branch_length):
+        '''
+            Return True if sites along a branch may be drawn directly from the model's state frequencies, and False otherwise. Always False unless branch_regimes is True.
+        '''
+        return self.branch_regimes and model.saturation_error(branch_length, category) <= self.saturation_tol
+
+
+
+    def _sample_branch(self, model, category, branch_length, parent_states):
+        '''
+            Sample new states along a branch for all sites (given by their parent states) in a given rate category.
+            If branch_regimes is True, sites along saturated branches are drawn from the stationary frequencies, and along short branches only sites which change are sampled.
+        '''
+        if self._saturated(model, category, branch_length):
+            return self._sampler.sample_freqs( model.params['state_freqs'], len(parent_states) )
+        short, table = self._obtain_sampling_table(model, category, branch_length)
+        if short:
+            return self._sampler.draw_changes(table, parent_states)
+        return self._sampler.draw(table, parent_states)
+
+
+
+    def _sample_sites(self, model, branch_length, parent_states, site_factors):
+        '''
+            Sample new states along a branch for sites with continuous gamma rates, given their parent states and their own rates.
+            Each site's transition probabilities are computed from the model's eigendecomposition, for up to ROW_BLOCK probabilities at once (see ``Model.compute_prob_rows``), and sampled directly. branch_regimes does not apply to these sites.
+        '''
+        new_states = np.empty( len(parent_states), dtype = SEQ_DTYPE )
+        step = max( 1, ROW_BLOCK // model.matrix.shape[0] )
+        for start in range(0, len(parent_states), step):
+            prob_rows = model.compute_prob_rows( branch_length, parent_states[start : start + step], site_factors[start : start + step] )
+            new_states[start : start + step] = self._sampler.sample_rows(prob_rows)
+        return new_states
+
+
+
+    def _obtain_prob_matrix(self, model, category, branch_length):
+        '''
+            Obtain the transition matrix for a given model, rate category, and branch length, either from the matrices kept for this simulation, from the cache, or by computing it from the model.
+        '''
+        key = self._prob_matrix_key(model, category, branch_length)
+        if key in self._prob_matrices:
+            return self._prob_matrices[key]
+        return self.cache.get(key, lambda: model.compute_prob_matrix(branch_length, category))
+        
+        
+        
+    def _obtain_sampling_table(self, model, category, branch_length):
+        '''
+            Obtain the sampling table (see the ``sampler`` module) for a given model, rate category, and branch length. Each table is prepared once per transition matrix, and reused along all branches (and windows of sites) sharing that matrix.
+            Returns a tuple (short, table), where short is True if only sites which change are sampled along the branch (see branch_regimes), in which case the table is prepared by Sampler.prepare_changes.
+        '''
+        key = self._prob_matrix_key(model, category, branch_length)
+        if key not in self._sampling_tables:
+            prob_matrix = self._obtain_prob_matrix(model, category, branch_length)
+            if self.branch_regimes and np.max( 1. - np.diag(prob_matrix) ) <= self.short_branch:
+                self._sampling_tables[key] = (True, self._sampler.prepare_changes(prob_matrix))
+            else:
+                self._sampling_tables[key] = (False, self._sampler.prepare(prob_matrix))
+        return self._sampling_tables[key]
         
         
         
-         
+    def _evolve_siblings(self, group, parent_seq, layout):
+        ''' 
+            Function to evolve sequences for a BranchGroup, i.e. several children of the same parent which share a branch length and model, with a single draw per rate category for all of them.
+            Partitions which share a model along these branches are fused, so that their sites are drawn together as well.
+            Returns a list containing the new sequence of each child.
+            
+            Required positional arguments include, 
+                1. **group** is the BranchGroup (see the ``plan`` module) whose children we are evolving TO
+                2. **parent_seq** is the sequence of the parent node we are evolving FROM.
+                3. **layout** gives the sites to simulate (see _site_layout).
+        '''
+        num_siblings = len(group.children)
+        
+        # Evolve only if branch length is greater than 0 (1e-8). 
+        # Children along zero-length branches share the parent's arrays, which are never modified in place.
+        if group.branch_length <= ZERO:
+            return [ list(parent_seq) for k in range(num_siblings) ]
+        
+        part_new_seqs = [ np.empty( [num_siblings, part_size], dtype = SEQ_DTYPE ) for (part_size, category_sites, part_rates, part_blocks, part_factors) in layout ] # will store each partition's new sequences, one row per sibling
+        for parts in group.fused:
+            # Obtain current model for these partitions at this branch
+            current_model = group.models[ parts[0] ]
+            
+            # With counter-based random numbers, each block of each partition and child is sampled from its own generator
+            if layout[ parts[0] ][3] is not None:
+                for p in parts:
+                    part_size, category_sites, part_rates, part_blocks, part_factors = layout[p]
+                    for k in range(num_siblings):
+                        for (replicate, block, start, end) in part_blocks:
+                            block_factors = None if part_factors is None else part_factors[start:end]
+                            part_new_seqs[p][k, start:end] = self._counter_sample( (replicate, group.children[k], p, block), self._evolve_block, current_model, group.branch_length, parent_seq[p][start:end], part_rates[start:end], block_factors )
+                continue
+            
+            for i in range( current_model.num_classes() ):
+                # Evolve branch. All sites in this rate category are sampled at once, for all fused partitions and all siblings.
+                parent_states = [ parent_seq[p][ layout[p][1][i] ] for p in parts ]
+                sizes = [ len(part_states) for part_states in parent_states ]
+                if sum(sizes) == 0:
+                    continue
+                if current_model.continuous:
+                    site_factors = np.concatenate( [ layout[p][4][ layout[p][1][i] ] for p in parts ] )
+                    new_states = self._sample_sites( current_model, group.branch_length, np.tile(np.concatenate(parent_states), num_siblings), np.tile(site_factors, num_siblings) )
+                else:
+                    new_states = self._sample_branch( current_model, i, group.branch_length, np.tile(np.concatenate(parent_states), num_siblings) )
+                new_states = new_states.reshape(num_siblings, sum(sizes))
+                index = 0
+                for p, size in zip(parts, sizes):
+                    part_new_seqs[p][:, layout[p][1][i]] = new_states[:, index : index + size]
+                    index += size
+        return [ [ part_new_seqs[p][k] for p in range(len(part_new_seqs)) ] for k in range(num_siblings) ]
+
+
+
+    def _evolve_block(self, model, branch_length, parent_states, rates, site_factors = None):
+        '''
+            Sample new states along a branch for a block of sites, given their parent states and rate categories, one rate category at a time.
+            With continuous gamma rates, sites are instead sampled given their own rates, **site_factors**.
+        '''
+        if model.continuous:
+            return self._sample_sites(model, branch_length, parent_states, site_factors)
+        new_states = np.empty( len(parent_states), dtype = SEQ_DTYPE )
+        for i in range( model.num_classes() ):
+            sites = np.flatnonzero(rates == i)
+            if len(sites) > 0:
+                new_states[sites] = self._sample_branch( model, i, branch_length, parent_states[sites] )
+        return new_states
+
+
+
+
+def _init_worker(evolver, seed = None):
+    '''
+        Initialize a worker process which simulates from a given Evolver (and, for replicates, a given master seed).
+    '''
+    _worker_state['evolver'] = evolver
+    _worker_state['seed'] = seed
+
+
+def _simulate_replicate(k):
+    '''
+        Simulate replicate k in a worker process (see _init_worker).
+    '''
+    return _worker_state['evolver']._simulate_replicate( _worker_state['seed'], k )
+
+
+def _simulate_subtree(j):
+    '''
+        Evolve the j-th subtree of a parallel subtree simulation in a worker process (see _init_worker).
+    '''
+    _worker_state['evolver']._simulate_subtree(j)
+
+
+def _simulate_window(w):
+    '''
+        Evolve the w-th window of sites of a site-parallel simulation in a worker process (see _init_worker).
+    '''
+    _worker_state['evolver']._simulate_window(w)
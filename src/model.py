@@ -14,9 +14,13 @@
     The CodonModel() class is used specifically in cases of codon model (dN/dS or omega) rate heterogeneity. Rate heterogeneity is implemented using a set of matrices with distinct dN/dS values, and each matrix has an associated probability. 
 '''
 
+import itertools
 import numpy as np
 from copy import deepcopy
+from scipy import linalg
 from matrix_builder import *
+from transition import *
+MATRIX_IDS = itertools.count() # Unique identifiers for constructed model matrices. Used to key cached transition matrices.
 
 
 class EvoModels(object):
@@ -67,6 +71,9 @@ class EvoModels(object):
         if self.model_type == 'codon':
             self.model_type = 'GY94'
         self.name = None
+        self._matrix_id = None # Unique identifier of the current substitution matrix(ces), reassigned whenever the model is (re)constructed.
+        self._decompositions = None # EigenDecomposition of each substitution matrix, computed by construct_model.
+        self.continuous = False # Whether each site draws its own rate from a continuous gamma distribution (see Model.construct_model)
           
 
     def construct_model(self):
@@ -128,6 +135,102 @@ class EvoModels(object):
                 self.rate_probs /= np.sum(self.rate_probs)
 
 
+    def compute_prob_matrix(self, branch_length, category = 0):
+        '''
+            Compute the transition matrix, P(t) = exp(Q * r * t), for a given branch length, t, and rate category.
+            The rate category determines both Q and the rate scalar, r. For Model(), Q is the model matrix and r is the category's rate factor. For CodonModel(), Q is the category's matrix and r is 1.
+            
+            P(t) is computed in closed form for standard nucleotide models (JC69, K80, F81, HKY85, TN93), and otherwise from the eigendecomposition of Q made when the model was constructed. If the decomposition is ill-conditioned or yields an improper matrix, the matrix exponential is computed directly instead.
+        '''
+        return self.compute_prob_matrices([branch_length], category)[0]
+        
+        
+    def compute_prob_matrices(self, branch_lengths, category = 0):
+        '''
+            Compute transition matrices for an entire array of branch lengths at once, for a given rate category. Returns an array of shape (number of branch lengths, size, size).
+            See compute_prob_matrix for details.
+        '''
+        matrix_index, rate = self._category_matrix(category)
+        scales = rate * np.asarray(branch_lengths, dtype = float)
+        size = self._matrix_list()[matrix_index].shape[0]
+        
+        prob_matrices = None
+        if self._decompositions is not None and self._decompositions[matrix_index].valid:
+            prob_matrices = self._decompositions[matrix_index](scales)
+        else:
+            prob_matrices = np.empty( [len(scales), size, size] )
+            prob_matrices.fill(np.nan)
+        
+        # Fall back to the matrix exponential for any improper matrix, checking all matrices at once
+        proper = np.all( np.isclose( np.sum(prob_matrices, axis = 2), 1. ), axis = 1 ) & ( np.min(prob_matrices, axis = (1,2)) >= -1e-6 )
+        for k in np.nonzero(~proper)[0]:
+            prob_matrices[k] = linalg.expm( np.multiply(self._matrix_list()[matrix_index], scales[k]) )
+        assert( np.allclose( np.sum(prob_matrices, axis = 2), 1. ) ), "Rows in transition matrix do not each sum to 1."
+        
+        # Remove rounding error, so that all probabilities are non-negative and rows sum to 1.
+        prob_matrices = np.maximum(prob_matrices, 0.)
+        prob_matrices /= np.sum(prob_matrices, axis = 2)[:, :, None]
+        return prob_matrices
+
+
+    def saturation_error(self, branch_length, category = 0):
+        '''
+            Return an upper bound on how far any entry of the transition matrix for a given branch length and rate category is from the stationary (state) frequency of its column, i.e. max |P_ij(t) - pi_j|.
+            For a time-reversible matrix with spectral gap g (the smallest magnitude of its non-zero eigenvalues) and rate scalar r, |P_ij(t) - pi_j| <= sqrt(pi_j / pi_i) * exp(-g * r * t).
+            Returns infinity if no bound is available (i.e. the matrix is not reversible, or has more than one zero eigenvalue).
+        '''
+        matrix_index, rate = self._category_matrix(category)
+        if self._decompositions is None or not self._decompositions[matrix_index].reversible:
+            return np.inf
+        rates = -np.real( self._decompositions[matrix_index].eigenvalues )
+        nonzero = rates > ZERO * max(1., np.max(rates))
+        if np.sum(~nonzero) != 1:
+            return np.inf
+        state_freqs = self.params['state_freqs']
+        return np.sqrt( np.max(state_freqs) / np.min(state_freqs) ) * np.exp( -np.min(rates[nonzero]) * rate * branch_length )
+
+
+    def _assign_decompositions(self):
+        '''
+            Compute and store the decomposition of each substitution matrix, used to compute transition matrices.
+            Standard 4-state nucleotide models (JC69, K80, F81, HKY85, TN93) use closed-form transition probabilities. 
+            Otherwise, matrices which are time-reversible with respect to the model's state frequencies are decomposed with the faster and more stable symmetric eigensolver.
+        '''
+        self._decompositions = []
+        for matrix in self._matrix_list():
+            closed_form = NucleotideClosedForm(matrix, self.params['state_freqs'])
+            if closed_form.valid:
+                self._decompositions.append(closed_form)
+            else:
+                self._decompositions.append( EigenDecomposition(matrix, state_freqs = self.params['state_freqs']) )
+
+
+    def _matrix_list(self):
+        '''
+            Return a list of the model's substitution matrices.
+            
+            Parent class method. Not executed.
+        '''
+        print "Parent class method. Not executed."
+
+
+    def _category_matrix(self, category):
+        '''
+            Return a tuple (index of substitution matrix in _matrix_list(), rate scalar) for a given rate category.
+            
+            Parent class method. Not executed.
+        '''
+        print "Parent class method. Not executed."
+
+
+    def reversible(self):
+        '''
+            Return True if all of the model's substitution matrices are time-reversible with respect to the model's state frequencies, and False otherwise.
+        '''
+        assert( self._decompositions is not None ), "\n\nModel must be constructed (construct_model) before checking reversibility."
+        return all( decomp.reversible for decomp in self._decompositions )
+
+
     def num_classes(self):
         ''' 
             Return the number of rate classes associated with a given model.
@@ -167,6 +270,7 @@ class Model(EvoModels):
 
         super(Model, self).__init__(*args, **kwargs)
         self.rate_factors = [1.]  # Default Rate heterogeneity factors (default is site homogeneity).
+        self.alpha = None # Shape parameter of continuous gamma rates
         
         
 
@@ -180,14 +284,21 @@ class Model(EvoModels):
                 2. **rate_probs**, a list/numpy array of probabilities (which sum to 1!) for each rate category. Default: equal.
                 3. **alpha**, the alpha shape parameter which should be used to draw rates from a discrete gamma distribution. Supply this argument to have gamma-distribtued rates.
                 4. **num_categories**, the number of rate categories to create. Supply this argument to draw a certain number of rates from a gamma distribution.               
+                5. **continuous**, a boolean argument (True or False) for whether every site should draw its own rate from a continuous gamma distribution with shape parameter *alpha* (and mean 1), instead of using rate categories. Default is False. Rates are drawn anew for each simulation, and transition probabilities for all sites along a branch are computed at once from the eigendecomposition of the rate matrix (see compute_prob_rows).
                 
         '''
         self.rate_factors = kwargs.get('rate_factors', np.array([1.]))    
         self.rate_probs   = kwargs.get('rate_probs', None )
         alpha = kwargs.get('alpha', None)
         k     = kwargs.get('num_categories', None)
-
-        if alpha is not None:
+        self.continuous = kwargs.get('continuous', False)
+        self.alpha = None
+
+        if self.continuous:
+            assert( alpha is not None and alpha > 0. ), "\n\nYou must specify a positive alpha (argument alpha=...) when constructing model if you want continuous gamma rates."
+            assert( k is None and 'rate_factors' not in kwargs and self.rate_probs is None ), "\n\nContinuous gamma rates cannot be combined with rate categories (arguments rate_factors, rate_probs and num_categories)."
+            self.alpha = float(alpha)
+        elif alpha is not None:
             if k is None:
                 if self.rate_probs is not None:
                     k = len(self.rate_probs)
@@ -198,7 +309,32 @@ class Model(EvoModels):
         self._assign_matrix()
         self._assign_rate_probs(self.rate_factors)
         self._sanity_rate_factors()
+        self._assign_decompositions()
+        assert( not self.continuous or self._decompositions[0].valid ), "\n\nContinuous gamma rates require a diagonalizable rate matrix, but this matrix could not be reliably decomposed."
+        
+        
+        
+    def draw_site_rates(self, size, rng = np.random):
+        '''
+            Draw **size** site rates from the continuous gamma distribution with shape parameter alpha and mean 1, using a given random number generator (either the numpy.random module, default, or a numpy.random.RandomState instance).
+        '''
+        assert( self.continuous ), "\n\nSite rates may only be drawn for models with continuous gamma rates."
+        return rng.gamma(self.alpha, scale = 1. / self.alpha, size = size)
+        
+        
+        
+    def compute_prob_rows(self, branch_length, states, site_rates):
+        '''
+            Compute, for each site, the row of its transition matrix P(t) = exp(Q * r * t) for its parent state, given a branch length, t, an integer array of parent states and an array of the sites' own rate scalars, r.
+            Returns an array of shape (number of sites, size). All rows are computed at once from the single decomposition of Q, with no matrix exponential per site.
+        '''
+        scales = branch_length * np.asarray(site_rates, dtype = float)
+        prob_rows = self._decompositions[0].rows( np.asarray(states, dtype = int), scales )
         
+        # Remove rounding error, so that all probabilities are non-negative and rows sum to 1.
+        prob_rows = np.maximum(prob_rows, 0.)
+        prob_rows /= np.sum(prob_rows, axis = 1)[:, None]
+        return prob_rows
         
         
         
@@ -213,6 +349,7 @@ class Model(EvoModels):
         '''
             Construct the model rate matrix, Q, based on model_type by calling the matrix_builder module. 
         '''
+        self._matrix_id = next(MATRIX_IDS)
         if self.model_type == 'nucleotide':
             self.matrix = nucleotide_Matrix(self.params, self.scale_matrix)()
         
@@ -233,6 +370,20 @@ class Model(EvoModels):
             
     
  
+    def _matrix_list(self):
+        '''
+            Return a list containing the model's single substitution matrix.
+        '''
+        return [self.matrix]
+
+
+    def _category_matrix(self, category):
+        '''
+            All rate categories share the single substitution matrix, scaled by the category's rate factor.
+        '''
+        return (0, float(self.rate_factors[category]))
+
+
     def _sanity_rate_factors(self):
         '''
             Perform sanity checks on rate heterogeneity set-up:
@@ -282,12 +433,28 @@ class CodonModel(EvoModels):
         self._assign_matrix()
         self.rate_probs = kwargs.get('rate_probs', None)
         self._assign_rate_probs( self.matrices )            
+        self._assign_decompositions()
+    
+    
+    def _matrix_list(self):
+        '''
+            Return the list of codon-model substitution matrices.
+        '''
+        return self.matrices
+
+
+    def _category_matrix(self, category):
+        '''
+            Each rate category has its own substitution matrix, which is not scaled.
+        '''
+        return (category, 1.)
     
     
     def _assign_matrix(self):
         '''
             Construct each model rate matrix, Q, to create a list of codon-model matrices.
         '''
+        self._matrix_id = next(MATRIX_IDS)
         self.matrices = []
         assert( len(self.params['beta']) == len(self.params['alpha']) ), "num dn is not same as num ds"
         for i in range(len( self.params['beta'] )):
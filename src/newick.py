@@ -25,7 +25,7 @@ class Tree():
         self.children       = []   # List of children, each of which is a Tree() object itself. If len(children) == 0, this tree is a tip.
         self.branch_length  = None # Branch length leading up to node
         self.model_flag     = None # Flag indicate that this branch evolves according to a distinct model from parent
-        self.seq            = None # Contains sequence (represented by integers) for a given node. EVENTUALLY THIS WILL BE REPLACED BY A LIST OF Site() OBJECTS.
+        self.seq            = None # Not set by Evolver, which never modifies the tree. Simulated sequences are stored in Evolver's leaf_seqs and evolved_seqs dictionaries instead.
 
 
 
@@ -119,30 +119,33 @@ def print_tree(tree, level=0):
                     	0.207 None None                 
                             
     ''' 
-    indent=''
-    for i in range(level):
-        indent+='\t'
-    print indent, tree.name, tree.branch_length, tree.model_flag
-    if len(tree.children) > 0:
-        for node in tree.children:
-            print_tree(node, level+1)    
+    nodes = [ (tree, level) ]
+    while nodes:
+        node, level = nodes.pop()
+        indent=''
+        for i in range(level):
+            indent+='\t'
+        print indent, node.name, node.branch_length, node.model_flag
+        # Push children in reverse, so that they are printed in order
+        for child in reversed(node.children):
+            nodes.append( (child, level+1) )
     
 
 
 def _assign_model_flags_to_nodes(tree, parent_flag = None):
     '''
-        Determine the evolutionary model to be used at each node.
+        Determine the evolutionary model to be used at each node. Nodes without a model flag inherit their parent's flag.
         Note that parent_flag = None means root model!!
     '''
-    
-    # Assign model if there was none in the tree
-    if tree.model_flag is None:
-        tree.model_flag = parent_flag
-
-    if len(tree.children) > 0:
-        for node in tree.children:
-            parent_flag = _assign_model_flags_to_nodes(node, tree.model_flag)
-    return parent_flag
+    nodes = [ (tree, parent_flag) ]
+    while nodes:
+        node, parent_flag = nodes.pop()
+        
+        # Assign model if there was none in the tree
+        if node.model_flag is None:
+            node.model_flag = parent_flag
+        for child in node.children:
+            nodes.append( (child, node.model_flag) )
     
 
 def _read_model_flag(tstring, index):
@@ -202,19 +205,21 @@ def _read_leaf(tstring, index):
 
 def _parse_tree(tstring, flags, internal_node_count, index):
     '''
-        Recursively parse a newick tree string and convert to a Tree object. 
-        Uses the functions _read_branch_length(), _read_leaf(), _read_model_flag() during the recursion.
+        Parse a newick tree string and convert to a Tree object. 
+        Uses the functions _read_branch_length(), _read_leaf(), _read_model_flag() while parsing.
+        Subtrees which are still open are kept on an explicit stack rather than parsed recursively, so that trees of any depth may be parsed.
     '''
     assert(tstring[index]=='(')
     index += 1
     node = Tree()
+    open_nodes = [] # Ancestors of node whose subtrees have not yet been closed
     while True:
         
         # New subtree (node) to parse
         if tstring[index]=='(':
-            subtree, flags, internal_node_count, index=_parse_tree(tstring, flags, internal_node_count, index)
-            node.children.append( subtree ) 
-             
+            open_nodes.append(node)
+            node = Tree()
+            index += 1
         
         # March to sister
         elif tstring[index]==',':
@@ -234,7 +239,11 @@ def _parse_tree(tstring, flags, internal_node_count, index):
                     model_flag, index = _read_model_flag(tstring, index)
                     node.model_flag = model_flag
                     flags.append(model_flag)
-            break
+            if len(open_nodes) == 0:
+                break
+            subtree = node
+            node = open_nodes.pop()
+            node.children.append( subtree )
         # Terminal leaf
         else:
             subtree, index = _read_leaf(tstring, index)
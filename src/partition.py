@@ -35,11 +35,9 @@ class Partition():
         '''
                 
                 
-        self.size              = kwargs.get('size', [])   # List of integers representing partition length. If there is no rate heterogeneity, then the list is length 1. Else, list is length k, where k is the number of rate categories.
+        self.size              = kwargs.get('size', [])   # Integer giving the partition length. Its division among rate categories is determined when the tree and partitions are compiled into a SimulationPlan (see the plan module).
         self.models            = kwargs.get('models', None)  # List of models associated with this partition. When length 1, temporally homogeneous.
         self.root_model_name   = None  # NAME of of Model beginning evolution at root of tree. Used under *branch heterogeneity*, and should be None or False if process is temporally homogeneous. If there is branch heterogeneity, this string *MUST* correspond to one of the Model() object's names and also a corresponding phylogeny flag.
-        self.shuffle           = False # Shuffle sites after evolving? The evolver module will set this up.
-        self._root_model       = None  # The actual root model. Used internally in evolver module.
 
     
     def branch_het(self):
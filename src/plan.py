@@ -0,0 +1,267 @@
+#! /usr/bin/env python
+
+##############################################################################
+##  pyvolve: Python platform for simulating evolutionary sequences.
+##
+##  Written by Stephanie J. Spielman (stephanie.spielman@gmail.com)
+##############################################################################
+
+'''
+    This module compiles a phylogeny and its partitions into a SimulationPlan, an immutable description of everything needed to evolve sequences along the tree.
+    A plan is compiled once and may then be simulated any number of times (e.g. for replicates with different seeds) by the Evolver class, without modifying the tree or partitions it was compiled from.
+'''
+
+from collections import namedtuple
+import numpy as np
+from model import *
+from newick import *
+from genetics import *
+from partition import *
+ZERO      = 1e-8
+MOLECULES = Genetics()
+SEQ_DTYPE = np.int8 # Integer type used to store evolved states and rate categories. Large enough for codons (61 states).
+
+
+class PartitionPlan( namedtuple('PartitionPlan', ['models', 'root_model', 'sizes', 'size', 'shuffle', 'site_rates']) ):
+    '''
+        Compiled set-up of a single partition. Fields are,
+            1. **models**, a tuple of the partition's Model/CodonModel instances
+            2. **root_model**, the model used at the root
+            3. **sizes**, a tuple giving the number of sites in each rate category (sites are ordered by rate category before any shuffling)
+            4. **size**, the total number of sites
+            5. **shuffle**, whether sites are shuffled within the partition (i.e. there is site heterogeneity)
+            6. **site_rates**, a read-only integer array giving the rate category of each (unshuffled) site
+    '''
+    __slots__ = ()
+
+
+class BranchGroup( namedtuple('BranchGroup', ['parent', 'children', 'branch_length', 'models', 'fused']) ):
+    '''
+        Compiled set of sibling branches which share a parent, a branch length and a model, and which are therefore evolved together. Fields are,
+            1. **parent**, the index of the parent node
+            2. **children**, a tuple of the indices of the child nodes
+            3. **branch_length**, the (possibly quantized) branch length leading to each child
+            4. **models**, a tuple giving the model used along these branches for each partition
+            5. **fused**, a tuple of tuples of partition indices, grouping partitions which use the same model along these branches. Sites of fused partitions are evolved together, as a single block per rate category.
+    '''
+    __slots__ = ()
+
+
+
+class SimulationPlan(object):
+    '''
+        Immutable execution plan compiled from a phylogeny and a list of partitions.
+
+        Nodes are numbered such that every parent precedes its children, with the root as node 0. Attributes include,
+            1. **partitions**, a tuple of PartitionPlan, one per partition
+            2. **node_names**, a tuple of the name of each node. The root is always named 'root'.
+            3. **leaves**, a tuple of the indices of leaf nodes
+            4. **groups**, a tuple of BranchGroup, ordered such that a group's parent is always simulated before the group itself
+            5. **code**, the list of states (nucleotides, amino acids or codons) used to write sequences
+            6. **num_sites**, the total number of sites across all partitions
+            7. **quantization_error**, the maximum absolute change to any branch length induced by quantization
+            8. **num_children**, a tuple giving the number of children of each node
+            9. **root_fused**, a tuple of tuples of partition indices, grouping partitions which share a root model (see BranchGroup)
+    '''
+
+    def __init__(self, tree, partitions, **kwargs):
+        '''
+            Compile a plan. Neither the tree nor the partitions are modified.
+
+            Required positional arguments include,
+                1. **tree** is the phylogeny (parsed with the ``newick.read_tree`` function) along which sequences are evolved
+                2. **partitions** is a Partition instance or list of Partition instances to evolve
+
+            Optional keyword arguments include,
+                1. **bl_tolerance** turns on approximate branch-length quantization. Each branch length is snapped to a logarithmic grid such that it changes by at most this relative tolerance (e.g. 1e-4), so that nearly identical branches share a single transition matrix. Default is None (no quantization).
+                2. **bl_grid** turns on approximate branch-length quantization with an absolute grid. Each branch length is rounded to the nearest multiple of this value, so that it changes by at most half a grid step. Branches shorter than half a grid step therefore become zero-length branches, along which no sites change. Default is None (no quantization). Only one of bl_tolerance and bl_grid may be given.
+        '''
+        self.bl_tolerance = kwargs.get('bl_tolerance', None)
+        self.bl_grid      = kwargs.get('bl_grid', None)
+        assert( self.bl_tolerance is None or self.bl_grid is None ), "\n\nProvide only one of bl_tolerance and bl_grid for branch-length quantization."
+        assert( self.bl_tolerance is None or self.bl_tolerance > 0. ), "\n\nbl_tolerance must be positive."
+        assert( self.bl_grid is None or self.bl_grid > 0. ), "\n\nbl_grid must be positive."
+
+        # If partitions is not a list but indeed a Partition, turn into a list. If not a partition, assert.
+        if isinstance(partitions, Partition):
+            partitions = [partitions]
+        else:
+            assert(type(partitions) is list), "\n\nYou must provide either a single Partition object or list of Partition objects to evolver."
+            for p in partitions:
+                assert(isinstance(p, Partition)), "\n\nYou must provide either a single Partition object or list of Partition objects to evolver."
+        assert( isinstance(tree, Tree) ), "\n\nYou must provide a tree, parsed with the read_tree function, to evolver."
+
+        root_flag = tree.model_flag
+        self.partitions = []
+        for part in partitions:
+            part_plan, part_root_flag = self._compile_partition(part)
+            if part_root_flag is not None:
+                root_flag = part_root_flag
+            self.partitions.append(part_plan)
+        self.partitions = tuple(self.partitions)
+        self.num_sites = sum( part_plan.size for part_plan in self.partitions )
+        assert(self.num_sites > 0), "\n\nPartitions have no size!"
+
+        self.code = self._compile_code()
+        self.root_fused = self._fuse( [ part_plan.root_model for part_plan in self.partitions ] )
+        self._compile_tree(tree, root_flag)
+
+
+
+    def num_nodes(self):
+        '''
+            Return the number of nodes in the tree, including the root.
+        '''
+        return len(self.node_names)
+
+
+
+    def branch_length(self, branch_length):
+        '''
+            Return a branch length, quantized if specified with bl_tolerance or bl_grid. Zero-length branches are never changed, and with bl_grid, branches shorter than half a grid step are rounded to zero.
+        '''
+        branch_length = float(branch_length)
+        if branch_length <= ZERO:
+            return branch_length
+        if self.bl_tolerance is not None:
+            step = 2. * np.log1p(self.bl_tolerance) # Rounding changes log(branch_length) by at most half a step, i.e. by a factor of at most (1 + bl_tolerance)
+            return float( np.exp( np.round(np.log(branch_length) / step) * step ) )
+        if self.bl_grid is not None:
+            return float( np.round(branch_length / self.bl_grid) * self.bl_grid )
+        return branch_length
+
+
+
+    def _compile_partition(self, part):
+        '''
+            Sanity-check a partition and compile its set-up. Returns a tuple (PartitionPlan, root model flag), where the root model flag is None unless the partition has branch heterogeneity.
+        '''
+        models = part.models
+        if type(models) is not list:
+            models = [models]
+        assert( len(models) > 0 ), "\n\nPartition has no associated models."
+
+        ############################### Set up branch heterogeneity, if specified ################################
+        # Yes branch heterogeneity -> sanity check the (hopefully) specified root_model, and yell if not assigned or assigned incorrectly.
+        root_flag = None
+        if len(models) > 1:
+            root_model = None
+            for m in models:
+                if m.name == getattr(part, 'root_model', None):
+                    root_model = m
+            assert(root_model is not None), "\n\n Your root_model does not correspond to any of the Model()/CodonModel() objects provided to your Partition() objects."
+            root_flag = root_model.name
+        else:
+            root_model = models[0]
+
+        ################ Sanity-check (branch-)site heterogeneity ################
+        shuffle = root_model.num_classes() > 1
+        for model in models:
+            assert( len(model.rate_probs) == len(root_model.rate_probs) ), "For branch-site models, the number of rate categories must remain constant over the tree in a given partition."
+            assert( model.continuous == root_model.continuous ), "\n\nEither all or none of a partition's models must use continuous gamma rates. Site rates are drawn from the root model's distribution."
+
+        ################ Divide sites among rate categories ################
+        full = int( part.size )
+        sizes = []
+        for i in range(root_model.num_classes() - 1):
+            sizes.append( int( root_model.rate_probs[i] * full ) )
+        sizes.append( full - sum(sizes) )
+        assert( sum(sizes) == full and min(sizes) >= 0 ), "\n\nImproperly divvied up rate heterogeneity."
+
+        site_rates = np.repeat( np.arange(root_model.num_classes(), dtype = SEQ_DTYPE), sizes )
+        site_rates.flags.writeable = False
+        return PartitionPlan(tuple(models), root_model, tuple(sizes), full, shuffle, site_rates), root_flag
+
+
+
+    def _compile_code(self):
+        '''
+            Return the genetic code, based on the number of states of the first partition's model.
+        '''
+        dim = self.partitions[0].root_model.params['state_freqs'].shape[0]
+        if dim == 4:
+            return MOLECULES.nucleotides
+        elif dim == 20:
+            return MOLECULES.amino_acids
+        elif dim == 61:
+            return MOLECULES.codons
+        else:
+            raise AssertionError("This should never be reached.")
+
+
+
+    def _compile_tree(self, tree, root_flag):
+        '''
+            Number the nodes of the tree (parents before children), and group the children of each node into BranchGroups by branch length and model.
+            Nodes without a model flag inherit their parent's flag.
+        '''
+        names   = ['root']
+        leaves  = []
+        groups  = []
+        self.quantization_error = 0.
+        if len(tree.children) == 0:
+            names[0] = tree.name
+            leaves.append(0)
+
+        stack = [ (tree, 0, root_flag) ] # (node, node index, model flag)
+        while stack:
+            node, index, flag = stack.pop()
+            node_groups = {}
+            order = []
+            for child in node.children:
+                assert (child.branch_length >= 0.), "\n\n Your tree has a negative branch length. I'm going to quit now."
+                child_flag = flag if child.model_flag is None else child.model_flag
+                branch_length = self.branch_length(child.branch_length)
+                self.quantization_error = max( self.quantization_error, abs(branch_length - child.branch_length) )
+
+                child_index = len(names)
+                names.append(child.name)
+                if len(child.children) == 0:
+                    leaves.append(child_index)
+
+                key = (branch_length, child_flag)
+                if key not in node_groups:
+                    node_groups[key] = []
+                    order.append(key)
+                node_groups[key].append(child_index)
+                stack.append( (child, child_index, child_flag) )
+
+            for key in order:
+                models = tuple( self._resolve_model(part_plan, key[1]) for part_plan in self.partitions )
+                groups.append( BranchGroup(index, tuple(node_groups[key]), key[0], models, self._fuse(models)) )
+
+        num_children = [0] * len(names)
+        for group in groups:
+            num_children[group.parent] += len(group.children)
+        self.node_names   = tuple(names)
+        self.leaves       = tuple(leaves)
+        self.groups       = tuple(groups)
+        self.num_children = tuple(num_children)
+
+
+
+    def _resolve_model(self, part_plan, flag):
+        '''
+            Obtain the appropriate Model()/CodonModel() for evolution along a branch with a given model flag.
+        '''
+        if len(part_plan.models) == 1:
+            return part_plan.models[0]
+        for m in part_plan.models:
+            if m.name == flag:
+                return m
+        raise AssertionError("\n\nCould not retrieve model a particular branch's evolution.")
+
+
+
+    def _fuse(self, models):
+        '''
+            Group partitions, given the model each uses, into a tuple of tuples of partition indices which use the very same Model()/CodonModel() instance. Groups are ordered by their first partition.
+        '''
+        fused = []
+        indices = {}
+        for p in range(len(models)):
+            if id(models[p]) not in indices:
+                indices[ id(models[p]) ] = len(fused)
+                fused.append([])
+            fused[ indices[id(models[p])] ].append(p)
+        return tuple( tuple(parts) for parts in fused )
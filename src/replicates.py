@@ -0,0 +1,108 @@
+#! /usr/bin/env python
+
+##############################################################################
+##  pyvolve: Python platform for simulating evolutionary sequences.
+##
+##  Written by Stephanie J. Spielman (stephanie.spielman@gmail.com)
+##############################################################################
+
+'''
+    This module splits a study of many replicates into shards, i.e. ranges of replicates [first, last), which may be simulated independently (for instance as separate jobs on a cluster) and then merged.
+    Each replicate is simulated with its own random number generator, seeded from a master seed and the replicate's index, so that a shard file contains exactly the bytes which a single run over all replicates would have written for those replicates.
+
+    A shard file holds two numpy arrays, written one after the other in numpy's .npy format: the shard's header (first replicate, last replicate + 1), followed by the replicates' leaf states, with shape (number of replicates, number of leaves, number of sites). Read it with *read_replicate_shard*.
+'''
+
+import numpy as np
+from evolver import *
+
+
+def write_replicate_shard(evolver, filename, first, last, **kwargs):
+    '''
+        Simulate replicates [first, last) of a study from a given Evolver, and write them to a shard file.
+
+        Required positional arguments include,
+            1. **evolver** is the Evolver instance from which replicates are simulated
+            2. **filename** is the name of the shard file to write
+            3. **first** is the index of the first replicate to simulate
+            4. **last** is the index following the last replicate to simulate
+
+        Optional keyword arguments include,
+            1. **seed** is the study's master seed. Default is None, in which case the Evolver's seed is used.
+            2. **num_processes** is the number of worker processes used to simulate replicates. Default is 1.
+
+        Examples:
+            .. code-block:: python
+
+               >>> # On each of 10 machines, with shard = 0, 1, ... 9
+               >>> my_evolver = Evolver(tree = my_tree, partitions = my_partition_list, seed = 12345)
+               >>> write_replicate_shard(my_evolver, "shard" + str(shard) + ".npy", 1000 * shard, 1000 * (shard + 1))
+
+               >>> # Once all shards are done
+               >>> merge_replicate_shards(["shard" + str(shard) + ".npy" for shard in range(10)], "replicates.npy")
+    '''
+    assert( 0 <= first < last ), "\n\nA shard must contain at least one replicate, with first < last."
+    alignments = evolver.simulate_replicates( last - first, first_replicate = first, seed = kwargs.get('seed', None), num_processes = kwargs.get('num_processes', 1) )
+    with open(filename, 'wb') as shard_h:
+        _write_shard_header(shard_h, first, last, alignments.shape[1:])
+        alignments.tofile(shard_h)
+
+
+
+def read_replicate_shard(filename, mmap = False):
+    '''
+        Read a shard file. Returns a tuple (first replicate, replicates), where replicates is an integer array with shape (number of replicates, number of leaves, number of sites), whose i-th entry is replicate first + i.
+
+        Optional keyword arguments include,
+            1. **mmap** is whether to map the replicates from the file, rather than reading them into memory. Default is False.
+    '''
+    with open(filename, 'rb') as shard_h:
+        first, last, shape = _read_shard_header(shard_h)
+        if not mmap:
+            return first, np.fromfile( shard_h, dtype = SEQ_DTYPE ).reshape(shape)
+        offset = shard_h.tell()
+    return first, np.memmap( filename, dtype = SEQ_DTYPE, mode = 'r', offset = offset, shape = shape )
+
+
+
+def merge_replicate_shards(filenames, outfile):
+    '''
+        Merge shard files, given in any order, into a single shard file. The shards must cover a contiguous range of replicates without overlap, and the merged file is identical to the file which a single shard covering this whole range would give.
+        Shards are copied one at a time, so that at most a single shard is held in memory.
+    '''
+    shards = []
+    for filename in filenames:
+        with open(filename, 'rb') as shard_h:
+            first, last, shape = _read_shard_header(shard_h)
+        shards.append( (first, last, shape[1:], filename) )
+    shards.sort()
+    assert( len(shards) > 0 ), "\n\nNo shards to merge."
+    for i in range(1, len(shards)):
+        assert( shards[i][0] == shards[i-1][1] ), "\n\nShards do not cover a contiguous range of replicates: replicates " + str(shards[i-1][1]) + " to " + str(shards[i][0]) + " are missing or overlapping."
+        assert( shards[i][2] == shards[0][2] ), "\n\nShards were simulated with different numbers of leaves or sites."
+
+    with open(outfile, 'wb') as out_h:
+        _write_shard_header(out_h, shards[0][0], shards[-1][1], shards[0][2])
+        for first, last, shape, filename in shards:
+            read_replicate_shard(filename)[1].tofile(out_h)
+
+
+
+def _write_shard_header(shard_h, first, last, shape):
+    '''
+        Write the header of a shard file (see the module description), followed by the .npy header of the replicates array, whose data must be written next.
+    '''
+    np.save( shard_h, np.array([first, last], dtype = np.int64) )
+    np.lib.format.write_array_header_1_0( shard_h, {'descr': np.lib.format.dtype_to_descr( np.dtype(SEQ_DTYPE) ), 'fortran_order': False, 'shape': (last - first,) + tuple(shape)} )
+
+
+
+def _read_shard_header(shard_h):
+    '''
+        Read the header of a shard file, leaving the file positioned at the start of the replicates' data. Returns a tuple (first replicate, last replicate + 1, shape of the replicates array).
+    '''
+    first, last = np.load(shard_h)
+    np.lib.format.read_magic(shard_h)
+    shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(shard_h)
+    assert( dtype == np.dtype(SEQ_DTYPE) and shape[0] == last - first ), "\n\nImproperly formatted shard file."
+    return int(first), int(last), shape
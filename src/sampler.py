@@ -0,0 +1,318 @@
+#! /usr/bin/env python
+
+##############################################################################
+##  pyvolve: Python platform for simulating evolutionary sequences.
+##
+##  Written by Stephanie J. Spielman (stephanie.spielman@gmail.com)
+##############################################################################
+
+'''
+    This module defines the categorical samplers used to draw new states, both at the root and along each branch.
+    A sampler takes a whole block of parent states plus a transition matrix, and returns every child state from vectorized numpy calls.
+'''
+
+import numpy as np
+ZERO = 1e-8
+
+
+class Sampler(object):
+    '''
+        Parent class for categorical samplers.
+
+        Child classes include the following:
+            1. *InverseCDFSampler*
+                - Inverse-CDF sampling on precomputed cumulative sums of each matrix row. This is the default.
+            2. *AliasSampler*
+                - Walker's alias method, with one alias table per matrix row. Each draw costs constant time regardless of alphabet size, so this is the fastest sampler for large alphabets (e.g. codons).
+            3. *MultinomialSampler*
+                - Groups sites by parent state and draws one multinomial per occupied parent state. Each group is then randomly permuted, so random draws still scale with the number of sites, and sorting sites makes this slower than the other samplers.
+
+        Sampling occurs in two steps. First, the *prepare* method converts a probability matrix (rows sum to 1) into a sampling table. Second, the *draw* method uses that table to sample new states for an array of parent states.
+        Tables may therefore be computed once and reused for any number of draws (e.g. along every branch sharing a transition matrix). Likewise, *prepare_changes* and *draw_changes* split *sample_changes* into these two steps.
+    '''
+
+    def __init__(self, rng = np.random):
+        '''
+            Optional keyword arguments:
+                1. **rng** is the random number generator used for all draws. This should be either the numpy.random module (default, global state) or a numpy.random.RandomState instance.
+        '''
+        self.rng = rng
+
+
+    def __call__(self, prob_matrix, states):
+        '''
+            Sample a new state for each entry in **states**.
+            Arguments *prob_matrix* is a square array of transition probabilities whose rows sum to 1, and *states* is an integer array of parent states (row indices into prob_matrix).
+            Returns an integer array, of the same shape as states, of sampled child states.
+        '''
+        return self.draw( self.prepare(prob_matrix), states )
+
+
+    def sample_freqs(self, freqs, size):
+        '''
+            Draw **size** states from a single vector of probabilities, **freqs** (e.g. stationary frequencies for the root sequence).
+        '''
+        return self.draw( self.prepare( np.atleast_2d(freqs) ), np.zeros(size, dtype = int) )
+
+
+    def sample_rows(self, prob_rows):
+        '''
+            Draw one state from each row of **prob_rows**, an array of shape (number of sites, number of states) giving every site its own probabilities (e.g. per-site transition rows under continuous rate heterogeneity).
+            Rows are sampled by inverse-CDF lookup, whatever the sampler's own strategy, since no table could be reused across sites.
+        '''
+        prob_rows = np.asarray(prob_rows, dtype = float)
+        assert( prob_rows.ndim == 2 ), "\n\nSamplers require a 2D array of probabilities, one row per site."
+        cdf = np.cumsum(prob_rows, axis = 1)
+        unif = self.rng.random_sample( prob_rows.shape[0] ) * cdf[:, -1]
+        return np.minimum( np.sum(cdf <= unif[:, None], axis = 1), prob_rows.shape[1] - 1 )
+
+
+    def sample_changes(self, prob_matrix, states):
+        '''
+            Sample a new state for each entry in **states**, by first choosing which sites change and then drawing new states for those sites only. This is much faster than *__call__* when few sites are expected to change (i.e. along short branches), and yields exactly the same distribution.
+            With q_s = 1 - P_ss the probability of leaving state s and q the largest of these, a Binomial(n, q) number of candidate sites is chosen uniformly, and each candidate with parent state s is kept with probability q_s / q. Kept sites then draw a new state from their row of the matrix, excluding the diagonal and renormalized.
+        '''
+        return self.draw_changes( self.prepare_changes(prob_matrix), states )
+
+
+    def prepare_changes(self, prob_matrix):
+        '''
+            Convert a probability matrix into a table for *draw_changes*, a tuple (leave, max_leave, jump_table). Here leave gives each state's probability of changing, max_leave is the largest of these, and jump_table is the sampling table (see *prepare*) of the jump matrix, whose rows are conditioned on a change.
+        '''
+        prob_matrix = self._sanity_prob_matrix(prob_matrix)
+        leave = np.maximum( 1. - np.diag(prob_matrix), 0. )
+
+        # States which never change keep a (never used) row leading to themselves.
+        jump_matrix = prob_matrix.copy()
+        np.fill_diagonal(jump_matrix, 0.)
+        stay = leave <= 0.
+        jump_matrix[stay] = np.eye( len(leave) )[stay]
+        jump_matrix /= np.sum(jump_matrix, axis = 1)[:, None]
+        return (leave, np.max(leave), self.prepare(jump_matrix))
+
+
+    def draw_changes(self, table, states):
+        '''
+            Sample a new state for each entry in **states**, changing only the sites chosen as described in *sample_changes*, using a table returned by *prepare_changes*.
+        '''
+        leave, max_leave, jump_table = table
+        states = np.asarray(states)
+        new_states = states.copy()
+        if max_leave <= 0. or len(states) == 0:
+            return new_states
+
+        # Choose sites which change
+        candidates = self._choose_sites( len(states), self.rng.binomial(len(states), max_leave) )
+        keep = self.rng.random_sample( len(candidates) ) * max_leave < leave[ states[candidates] ]
+        changed = candidates[keep]
+        if len(changed) == 0:
+            return new_states
+        new_states[changed] = self.draw( jump_table, states[changed] )
+        return new_states
+
+
+    def _choose_sites(self, size, number):
+        '''
+            Return a uniformly random subset of **number** distinct site indices from range(size).
+            When few sites are needed, random indices are drawn (and duplicates redrawn) rather than permuting all sites.
+        '''
+        if 2 * number > size:
+            return self.rng.permutation(size)[:number]
+        chosen = np.unique( self.rng.randint(0, size, size = number) )
+        while len(chosen) < number:
+            chosen = np.unique( np.concatenate([chosen, self.rng.randint(0, size, size = number - len(chosen))]) )
+        return chosen
+
+
+    def prepare(self, prob_matrix):
+        '''
+            Convert a probability matrix into a sampling table.
+
+            Parent class method. Not executed.
+        '''
+        print "Parent class method. Not executed."
+
+
+    def draw(self, table, states):
+        '''
+            Sample new states for an array of parent states, using a table returned by *prepare*.
+
+            Parent class method. Not executed.
+        '''
+        print "Parent class method. Not executed."
+
+
+    def _sanity_prob_matrix(self, prob_matrix):
+        '''
+            Ensure that the probability matrix is a 2D array whose rows each sum to 1. Returns the matrix as a numpy float array.
+        '''
+        prob_matrix = np.asarray(prob_matrix, dtype = float)
+        assert( prob_matrix.ndim == 2 ), "\n\nSamplers require a 2D matrix (or single row) of probabilities."
+        assert( np.all( np.abs(np.sum(prob_matrix, axis = 1) - 1.) < ZERO ) ), "Probabilities do not sum to 1. Cannot generate a new sequence."
+        return prob_matrix
+
+
+
+
+
+class InverseCDFSampler(Sampler):
+    '''
+        Child class of Sampler. Samples by inverse-CDF lookup on precomputed row cumulative sums.
+        All rows are stored in a single flattened, monotonically increasing array (row i is offset by i), so that a single call to numpy.searchsorted samples every site at once, whatever its parent state.
+    '''
+
+    def prepare(self, prob_matrix):
+        '''
+            Return the offset, flattened cumulative sums of each row of **prob_matrix**.
+        '''
+        prob_matrix = self._sanity_prob_matrix(prob_matrix)
+        cdf = np.cumsum(prob_matrix, axis = 1)
+        cdf /= cdf[:, -1][:, None] # Guard against rounding error, so that the last bin of each row ends at exactly 1 and zero-probability states stay empty.
+        dim = cdf.shape[1]
+        return ( (cdf + np.arange(cdf.shape[0])[:, None]).ravel(), dim )
+
+
+    def draw(self, table, states):
+        '''
+            Sample a new state for each parent state, by locating parent_state + u (u ~ U[0,1)) in the offset cumulative sums.
+        '''
+        flat_cdf, dim = table
+        states = np.asarray(states, dtype = int) # Offsets (states * dim) would overflow small integer types, e.g. int8 sequences
+        unif = np.minimum( self.rng.random_sample(states.shape), 1. - 1e-12 ) # Keep parent_state + u strictly within the parent's row once offset.
+        return np.searchsorted(flat_cdf, states + unif, side = 'right') - states * dim
+
+
+
+
+
+class AliasSampler(Sampler):
+    '''
+        Child class of Sampler. Samples using Walker's alias method (Vose's construction).
+        Table construction is more expensive than for the InverseCDFSampler, but each draw requires only constant time. This sampler is therefore most useful when a table is reused for many draws with a large alphabet (e.g. codons).
+    '''
+
+    def prepare(self, prob_matrix):
+        '''
+            Return the per-row alias tables, (accept, alias), for **prob_matrix**. Each is an array of the same shape as prob_matrix.
+            
+            Tables for all rows are built at once, without looping over columns. With scaled probabilities p_i * size, columns below 1 (small) have a deficit and columns above 1 (large) an excess, and both are laid end to end by cumulative sums.
+            Each small column takes all of its deficit from the large column whose excess is being used when the small column's deficit starts. A large column whose excess runs out part-way through a small column's deficit therefore gives that overflow as well, and takes it back from the next large column (as in Vose's construction, where it would then become small).
+        '''
+        prob_matrix = self._sanity_prob_matrix(prob_matrix)
+        nrow, dim = prob_matrix.shape
+        scaled  = prob_matrix / np.sum(prob_matrix, axis = 1)[:, None] * dim
+        small   = scaled < 1.
+        large   = scaled > 1.
+        columns = np.arange(dim)
+        
+        deficit = np.where(small, 1. - scaled, 0.)
+        deficit_end   = np.cumsum(deficit, axis = 1)
+        deficit_start = deficit_end - deficit
+        excess_end    = np.cumsum( np.where(large, scaled - 1., 0.), axis = 1 )
+        
+        # Cumulative sums are at most size, so offsetting row r by 2 * size * r makes each flattened array increasing (as for the InverseCDFSampler)
+        offsets = 2. * dim * np.arange(nrow)[:, None]
+        row_starts = dim * np.arange(nrow)[:, None]
+        last_large = dim - 1 - np.argmax(large[:, ::-1], axis = 1)[:, None]
+        next_large = np.minimum.accumulate( np.where(large, columns, dim)[:, ::-1], axis = 1 )[:, ::-1]
+        next_large = np.concatenate( [next_large[:, 1:], np.repeat(dim, nrow)[:, None]], axis = 1 )
+        
+        # Donor of each small column, i.e. the first large column whose excess ends after the small column's deficit starts
+        donor = np.searchsorted( (excess_end + offsets).ravel(), (deficit_start + offsets).ravel(), side = 'right' ).reshape(nrow, dim) - row_starts
+        donor = np.minimum(donor, last_large) # Guard against rounding error at the end of a row
+        
+        # Overflow of each large column, i.e. the part of the deficit of the small column during which its excess ends
+        taker = np.searchsorted( (deficit_end + offsets).ravel(), (excess_end + offsets).ravel(), side = 'right' ).reshape(nrow, dim) - row_starts
+        within = taker < dim
+        taker  = np.minimum(taker, dim - 1)
+        rows   = np.arange(nrow)[:, None]
+        overflow = np.where( within & (deficit_start[rows, taker] < excess_end), deficit_end[rows, taker] - excess_end, 0. )
+        
+        accept = np.where( small, scaled, np.clip(1. - overflow, 0., 1.) )
+        alias  = np.where( small, donor, np.where( large & (overflow > 0.) & (next_large < dim), next_large, columns ) )
+        return (accept, alias)
+
+
+    def draw(self, table, states):
+        '''
+            Sample a new state for each parent state. Each draw picks a column uniformly and then either accepts it or takes its alias.
+        '''
+        accept, alias = table
+        states = np.asarray(states)
+        column = self.rng.randint(0, accept.shape[1], size = states.shape)
+        unif = self.rng.random_sample(states.shape)
+        return np.where( unif < accept[states, column], column, alias[states, column] )
+
+
+
+
+
+class MultinomialSampler(Sampler):
+    '''
+        Child class of Sampler. Buckets sites by parent state, draws a single multinomial per occupied parent state from that row of the matrix, and scatters the resulting child states back over the bucket's sites with a random permutation.
+        Since sites sharing a parent state are exchangeable, this yields exactly the same distribution as sampling every site independently. The permutation still draws one random number per site, so this sampler is slower than InverseCDFSampler and AliasSampler, even for long codon sequences (see examples/sampler_benchmark.py).
+    '''
+
+    def prepare(self, prob_matrix):
+        '''
+            Return the (sanity-checked) probability matrix itself, as multinomial draws are taken directly from its rows.
+            Rows are renormalized so that rounding error cannot push their sums above 1, which numpy's multinomial rejects.
+        '''
+        prob_matrix = self._sanity_prob_matrix(prob_matrix)
+        return prob_matrix / np.sum(prob_matrix, axis = 1)[:, None]
+
+
+    def draw(self, table, states):
+        '''
+            Sample new states by drawing one multinomial per occupied parent state.
+        '''
+        states = np.asarray(states)
+        flat_states = states.ravel()
+        dim = table.shape[1]
+        new_states = np.empty( len(flat_states), dtype = int )
+
+        # Sort sites by parent state, so that each bucket is a contiguous slice of *order*
+        order = np.argsort(flat_states, kind = 'mergesort')
+        bucket_sizes = np.bincount(flat_states, minlength = table.shape[0])
+        start = 0
+        for parent in np.nonzero(bucket_sizes)[0]:
+            end = start + bucket_sizes[parent]
+            child_counts = self.rng.multinomial(bucket_sizes[parent], table[parent])
+            new_states[ order[start:end] ] = self.rng.permutation( np.repeat(np.arange(dim), child_counts) )
+            start = end
+        return new_states.reshape(states.shape)
+
+
+
+
+
+def counter_rng(key):
+    '''
+        Return a numpy.random.RandomState whose stream is determined entirely by **key**, a sequence of non-negative integers (e.g. (seed, replicate, node, partition, block)).
+        A counter-based Philox generator is used when numpy provides one (numpy 1.17 or later). Otherwise, the Mersenne Twister is seeded with the key as an array, which likewise gives a distinct, reproducible stream for each key. Streams therefore differ between these two cases.
+    '''
+    key = [ int(k) for k in key ]
+    if hasattr(np.random, 'Philox'):
+        return np.random.RandomState( np.random.Philox( np.random.SeedSequence(key) ) )
+    return np.random.RandomState(key)
+
+
+
+
+
+def get_sampler(sampler, rng = np.random):
+    '''
+        Return a Sampler instance given either an existing Sampler instance or the name of a sampling strategy.
+        Accepted names (case-insensitive) are 'cdf' (InverseCDFSampler), 'alias' (AliasSampler) and 'multinomial' (MultinomialSampler).
+    '''
+    if isinstance(sampler, Sampler):
+        return sampler
+    assert( type(sampler) is str ), "\n\nThe sampler argument must be either a Sampler instance or one of the strings 'cdf', 'alias' or 'multinomial'."
+    if sampler.lower() == 'cdf':
+        return InverseCDFSampler(rng = rng)
+    elif sampler.lower() == 'alias':
+        return AliasSampler(rng = rng)
+    elif sampler.lower() == 'multinomial':
+        return MultinomialSampler(rng = rng)
+    else:
+        raise AssertionError("\n\nUnknown sampler specified. Either 'cdf', 'alias' or 'multinomial' are accepted (case-insensitive).")
@@ -0,0 +1,242 @@
+#! /usr/bin/env python
+
+##############################################################################
+##  pyvolve: Python platform for simulating evolutionary sequences.
+##
+##  Written by Stephanie J. Spielman (stephanie.spielman@gmail.com)
+##############################################################################
+
+'''
+    This module defines read-only dictionaries of simulated sequences, which store sequences in one form and rebuild them when accessed.
+    DeltaSequences provides compact storage, in which each node holds only the sites at which it differs from its parent. Along short branches nearly all sites equal the parent's, so keeping every ancestral sequence in this form requires a small fraction of the memory needed for full sequences.
+    PermutedSequences stores full sequences whose sites are permuted only when accessed.
+'''
+
+from collections import Mapping
+import numpy as np
+
+
+class DeltaSequences(Mapping):
+    '''
+        Read-only dictionary of simulated sequences, keyed by node name, in which the root's sequence is stored in full and every other node's sequence is stored as a sparse difference (changed sites and their new states) from its parent's.
+        Each value is a list of numpy integer arrays, one per partition, as for Evolver's *evolved_seqs* dictionary. Full sequences are rebuilt whenever they are accessed. Iterating over items (or values) rebuilds sequences from the root towards the leaves, so that each node requires a single difference to be applied.
+
+        Several DeltaSequences may share the same stored differences, but expose different sets of nodes (see *view*).
+    '''
+
+    def __init__(self, plan, root_seq, names = None):
+        '''
+            Required positional arguments include,
+                1. **plan** is the SimulationPlan along which sequences are simulated
+                2. **root_seq** is the root's sequence, a list of numpy integer arrays, one per partition
+
+            Optional keyword arguments include,
+                1. **names** is a list of the names of nodes to expose. Default is None, in which case all nodes are exposed.
+        '''
+        self._plan    = plan
+        self._root    = [ part_seq.copy() for part_seq in root_seq ]
+        self._diffs   = [None] * plan.num_nodes() # For each non-root node, a list of (sites, states) tuples, one per partition
+        self._parents = [None] * plan.num_nodes()
+        for group in plan.groups:
+            for child in group.children:
+                self._parents[child] = group.parent
+        self._permutations = [None] * len(root_seq) # Site permutation to apply to each partition when rebuilding, if any
+        self._lengths = [ len(part_seq) for part_seq in root_seq ]
+        self._dtype   = root_seq[0].dtype
+        self._set_names(names)
+
+
+    def add(self, node, parent_seq, node_seq):
+        '''
+            Store a node's sequence, given its index in the plan, as its difference from its parent's sequence. Both sequences are lists of numpy integer arrays, one per partition.
+        '''
+        diff = []
+        for p in range(len(node_seq)):
+            sites = np.flatnonzero( node_seq[p] != parent_seq[p] ).astype( np.min_scalar_type(self._lengths[p]) )
+            diff.append( (sites, node_seq[p][sites]) )
+        self._diffs[node] = diff
+
+
+    def view(self, names):
+        '''
+            Return a DeltaSequences which shares these stored differences (and permutations), but exposes only the nodes whose names are given.
+        '''
+        other = DeltaSequences.__new__(DeltaSequences)
+        other.__dict__.update(self.__dict__)
+        other._set_names(names)
+        return other
+
+
+    def permute(self, partition, permutation):
+        '''
+            Permute the sites of a given partition (by index) in all rebuilt sequences, such that new site i is old site permutation[i]. Permutations are shared by all views.
+        '''
+        if self._permutations[partition] is not None:
+            permutation = self._permutations[partition][permutation]
+        self._permutations[partition] = permutation
+
+
+    def num_differences(self):
+        '''
+            Return the total number of sites stored as differences, over all non-root nodes and partitions.
+        '''
+        return sum( len(sites) for diff in self._diffs[1:] if diff is not None for (sites, states) in diff )
+
+
+    def __getitem__(self, name):
+        '''
+            Rebuild the full sequence of a node, by applying the differences along the path from the root.
+        '''
+        path = [ self._indices[name] ]
+        while self._parents[path[-1]] is not None:
+            path.append( self._parents[path[-1]] )
+        seq = [ np.empty(length, dtype = self._dtype) for length in self._lengths ]
+        for node in reversed(path):
+            self._apply(seq, node)
+        return self._permuted(seq)
+
+
+    def __iter__(self):
+        return iter(self._names)
+
+
+    def __len__(self):
+        return len(self._names)
+
+
+    def __contains__(self, name):
+        return name in self._indices
+
+
+    def iteritems(self):
+        '''
+            Rebuild all exposed sequences, from the root towards the leaves. Yields tuples (name, sequence).
+            A node's full sequence is kept only until all of its descendants have been rebuilt.
+        '''
+        exposed = np.zeros( self._plan.num_nodes(), dtype = bool )
+        exposed[ self._indices.values() ] = True
+        needed = exposed.copy() # Nodes which are exposed or have an exposed descendant
+        for node in range(self._plan.num_nodes() - 1, 0, -1):
+            if needed[node]:
+                needed[ self._parents[node] ] = True
+        remaining = [0] * self._plan.num_nodes() # Number of each node's needed children not yet rebuilt
+        for node in range(1, self._plan.num_nodes()):
+            if needed[node]:
+                remaining[ self._parents[node] ] += 1
+
+        full = [None] * self._plan.num_nodes()
+        for node in range(self._plan.num_nodes()):
+            if not needed[node]:
+                continue
+            parent = self._parents[node]
+            if parent is None:
+                seq = [ np.empty(length, dtype = self._dtype) for length in self._lengths ]
+            else:
+                seq = [ part_seq.copy() for part_seq in full[parent] ]
+                remaining[parent] -= 1
+                if remaining[parent] == 0:
+                    full[parent] = None
+            self._apply(seq, node)
+            if remaining[node] > 0:
+                full[node] = seq # Kept until all of its needed children are rebuilt. Leaves are never kept.
+            if exposed[node]:
+                yield self._plan.node_names[node], self._permuted(seq)
+
+
+    def items(self):
+        return list( self.iteritems() )
+
+
+    def itervalues(self):
+        for name, seq in self.iteritems():
+            yield seq
+
+
+    def values(self):
+        return list( self.itervalues() )
+
+
+    def _set_names(self, names):
+        '''
+            Set the names of the exposed nodes.
+        '''
+        if names is None:
+            names = self._plan.node_names
+        all_indices = dict( (self._plan.node_names[i], i) for i in range(self._plan.num_nodes()) )
+        self._names = list(names)
+        self._indices = dict( (name, all_indices[name]) for name in self._names )
+
+
+    def _apply(self, seq, node):
+        '''
+            Apply a node's stored differences, in place, to its parent's sequence. For the root, the stored sequence is copied.
+        '''
+        if node == 0:
+            for p in range(len(seq)):
+                seq[p][:] = self._root[p]
+            return
+        for p in range(len(seq)):
+            sites, states = self._diffs[node][p]
+            seq[p][sites] = states
+
+
+    def _permuted(self, seq):
+        '''
+            Return a sequence with any site permutations applied.
+        '''
+        return [ seq[p] if self._permutations[p] is None else seq[p][ self._permutations[p] ] for p in range(len(seq)) ]
+
+
+
+
+
+class PermutedSequences(Mapping):
+    '''
+        Read-only dictionary of simulated sequences, keyed by node name, whose sites are permuted within each partition whenever a sequence is accessed.
+        Each value is a list of numpy integer arrays, one per partition, as for Evolver's *evolved_seqs* dictionary. Shuffling sites in this way requires no pass over sequences which are never accessed (or written).
+    '''
+
+    def __init__(self, seqs, permutations):
+        '''
+            Required positional arguments include,
+                1. **seqs** is a dictionary of (unpermuted) sequences, keyed by node name
+                2. **permutations** is a list giving, for each partition, either None or a permutation of its sites, such that new site i is old site permutation[i]
+        '''
+        self._seqs = seqs
+        self._permutations = list(permutations)
+
+
+    def __getitem__(self, name):
+        return self._permuted( self._seqs[name] )
+
+
+    def __iter__(self):
+        return iter(self._seqs)
+
+
+    def __len__(self):
+        return len(self._seqs)
+
+
+    def __contains__(self, name):
+        return name in self._seqs
+
+
+    def iteritems(self):
+        '''
+            Permute all sequences, one at a time. Yields tuples (name, sequence).
+        '''
+        for name, seq in self._seqs.iteritems():
+            yield name, self._permuted(seq)
+
+
+    def itervalues(self):
+        for name, seq in self.iteritems():
+            yield seq
+
+
+    def _permuted(self, seq):
+        '''
+            Return a sequence with the site permutations applied.
+        '''
+        return [ seq[p] if self._permutations[p] is None else seq[p][ self._permutations[p] ] for p in range(len(seq)) ]
@@ -0,0 +1,317 @@
+#! /usr/bin/env python
+
+##############################################################################
+##  pyvolve: Python platform for simulating evolutionary sequences.
+##
+##  Written by Stephanie J. Spielman (stephanie.spielman@gmail.com)
+##############################################################################
+
+'''
+    This module handles transition (probability) matrices, P(t), computed from a model's instantaneous rate matrix.
+    It defines the eigendecomposition from which models compute P(t) for any branch length and rate, closed-form P(t) for standard nucleotide models, and a bounded least-recently-used cache of transition matrices which is shared by all Evolver calls in a process.
+'''
+
+import threading
+from collections import OrderedDict
+import numpy as np
+ZERO = 1e-8
+MAX_CONDITION = 1e6 # Eigenvector matrices with a larger condition number are considered ill-conditioned.
+
+
+class EigenDecomposition(object):
+    '''
+        Eigendecomposition, Q = V diag(L) V^-1, of an instantaneous rate matrix Q.
+        Once decomposed, the transition matrix for any scaling of Q (i.e. rate * branch length) requires only a scaled exponential of the eigenvalues and a single matrix product, P(s) = V diag(exp(L*s)) V^-1.
+
+        If stationary frequencies are provided and the matrix is time-reversible with respect to them (pi_i * Q_ij = pi_j * Q_ji), the symmetrized matrix Pi^1/2 Q Pi^-1/2 is decomposed with a symmetric eigensolver, which is both faster and numerically stabler. Otherwise, a general eigensolver is used.
+        If the decomposition fails or the eigenvectors are ill-conditioned (e.g. for a nearly defective matrix), the decomposition is flagged as invalid (attribute *valid* is False), and the matrix exponential should be computed directly instead.
+    '''
+
+    def __init__(self, matrix, state_freqs = None, max_condition = MAX_CONDITION):
+        '''
+            Decompose **matrix**, a square instantaneous rate matrix.
+
+            Optional keyword arguments:
+                1. **state_freqs** are the stationary frequencies of the matrix, used to detect time-reversibility. Default is None, in which case the general eigensolver is always used.
+                2. **max_condition** is the largest condition number of the eigenvector matrix for which the general decomposition is considered reliable. Default is 1e6.
+        '''
+        self.valid = False
+        self.reversible = False
+        self.eigenvalues  = None
+        self.eigenvectors = None
+        self.inv_eigenvectors = None
+        matrix = np.asarray(matrix, dtype = float)
+        
+        if state_freqs is not None and self._is_reversible(matrix, state_freqs):
+            self._decompose_symmetric(matrix, np.asarray(state_freqs, dtype = float))
+        if not self.valid:
+            self._decompose_general(matrix, max_condition)
+
+
+    def __call__(self, scale):
+        '''
+            Return the transition matrix exp(Q * **scale**), where scale is the product of rate and branch length.
+            If scale is an array, a stack of transition matrices (one per scale) is returned.
+        '''
+        assert( self.valid ), "\n\nCannot compute a transition matrix from an invalid eigendecomposition."
+        if np.ndim(scale) == 0:
+            prob_matrix = np.dot( self.eigenvectors * np.exp(self.eigenvalues * scale), self.inv_eigenvectors )
+        else:
+            exp_eigenvalues = np.exp( np.multiply.outer(np.asarray(scale, dtype = float), self.eigenvalues) )
+            prob_matrix = np.matmul( self.eigenvectors[None, :, :] * exp_eigenvalues[:, None, :], self.inv_eigenvectors ) # Stacked BLAS products, which release the GIL
+        return np.real(prob_matrix)
+
+
+    def rows(self, states, scales):
+        '''
+            Return, for each site, the row of the transition matrix exp(Q * scale) for the site's own **scale** and parent state, as an array of shape (number of sites, size).
+            Rows for all sites are computed with a single matrix product, (V[states] * exp(outer(scales, L))) V^-1, so that no full transition matrix is formed.
+        '''
+        assert( self.valid ), "\n\nCannot compute transition probabilities from an invalid eigendecomposition."
+        exp_eigenvalues = np.exp( np.multiply.outer(np.asarray(scales, dtype = float), self.eigenvalues) )
+        return np.real( np.dot( self.eigenvectors[states] * exp_eigenvalues, self.inv_eigenvectors ) )
+
+
+    def _is_reversible(self, matrix, state_freqs):
+        '''
+            Return True if **matrix** satisfies detailed balance with respect to **state_freqs** (all of which must be positive), and False otherwise.
+        '''
+        state_freqs = np.asarray(state_freqs, dtype = float)
+        if state_freqs.shape != (matrix.shape[0],) or np.any(state_freqs <= ZERO):
+            return False
+        flux = state_freqs[:, None] * matrix
+        return np.max( np.abs(flux - flux.T) ) <= ZERO * max(1., np.max(np.abs(flux)))
+
+
+    def _decompose_symmetric(self, matrix, state_freqs):
+        '''
+            Decompose a reversible matrix through its symmetrization, S = Pi^1/2 Q Pi^-1/2 = U diag(L) U^T.
+            Then Q = (Pi^-1/2 U) diag(L) (U^T Pi^1/2), so no matrix inversion is required.
+        '''
+        root_freqs = np.sqrt(state_freqs)
+        sym_matrix = root_freqs[:, None] * matrix / root_freqs[None, :]
+        sym_matrix = 0.5 * (sym_matrix + sym_matrix.T) # Remove rounding asymmetry
+        try:
+            eigenvalues, unitary = np.linalg.eigh(sym_matrix)
+        except np.linalg.LinAlgError:
+            return
+        self.eigenvalues  = eigenvalues
+        self.eigenvectors = unitary / root_freqs[:, None]
+        self.inv_eigenvectors = unitary.T * root_freqs[None, :]
+        self.reversible = True
+        self.valid = True
+
+
+    def _decompose_general(self, matrix, max_condition):
+        '''
+            Decompose an arbitrary matrix with the general eigensolver, Q = V diag(L) V^-1.
+        '''
+        try:
+            eigenvalues, eigenvectors = np.linalg.eig( np.asarray(matrix, dtype = float) )
+            if np.isfinite(eigenvectors).all() and np.linalg.cond(eigenvectors) < max_condition:
+                self.inv_eigenvectors = np.linalg.inv(eigenvectors)
+                self.eigenvalues  = eigenvalues
+                self.eigenvectors = eigenvectors
+                self.valid = True
+        except np.linalg.LinAlgError:
+            pass
+
+
+
+
+
+class NucleotideClosedForm(object):
+    '''
+        Closed-form transition probabilities for the TN93 nucleotide model and all of its nested models (JC69, K80, F81, HKY85).
+        These models are detected directly from a 4x4 instantaneous rate matrix and its state frequencies: the matrix must satisfy Q_ij = e_ij * pi_j with symmetric exchangeabilities e_ij, and all four transversion exchangeabilities must be equal.
+        If the matrix does not correspond to one of these models, the attribute *valid* is False.
+
+        Transition matrices for entire arrays of scales (rate * branch length) are computed at once, without any matrix exponentiation.
+        Uses the same interface (*valid*, *reversible*, *eigenvalues*, *rows*, and calling with a scale) as EigenDecomposition.
+    '''
+
+    def __init__(self, matrix, state_freqs):
+        '''
+            Detect whether **matrix**, with stationary frequencies **state_freqs**, is a TN93-family model, and if so set up its closed form.
+            Nucleotides are ordered A, C, G, T.
+        '''
+        self.valid = False
+        self.reversible = False
+        self.name = None
+        self.eigenvalues = None
+        matrix = np.asarray(matrix, dtype = float)
+        state_freqs = np.asarray(state_freqs, dtype = float)
+        if matrix.shape != (4,4) or state_freqs.shape != (4,) or np.any(state_freqs <= ZERO):
+            return
+
+        # Exchangeabilities must be symmetric, and transversions must share a single exchangeability
+        exch = matrix / state_freqs[None, :]
+        tol = ZERO * max( 1., np.max(np.abs(exch)) )
+        off_diagonal = ~np.eye(4, dtype = bool)
+        if np.max( np.abs(exch - exch.T)[off_diagonal] ) > tol:
+            return
+        transversions = np.array([ exch[0][1], exch[0][3], exch[1][2], exch[2][3] ])
+        if np.max(transversions) - np.min(transversions) > tol:
+            return
+
+        self.freqs    = state_freqs
+        self.beta     = np.mean(transversions)
+        self.alpha_r  = exch[0][2] # A <-> G
+        self.alpha_y  = exch[1][3] # C <-> T
+        self.purine   = np.array([True, False, True, False])
+        self.pi_r     = state_freqs[0] + state_freqs[2]
+        self.pi_y     = state_freqs[1] + state_freqs[3]
+        self.eigenvalues = np.array([ 0., -self.beta, -(self.pi_r * self.alpha_r + self.pi_y * self.beta), -(self.pi_y * self.alpha_y + self.pi_r * self.beta) ])
+        self.name = self._model_name(tol)
+        self.reversible = True
+        self.valid = True
+
+
+    def __call__(self, scale):
+        '''
+            Return the transition matrix for a given **scale** (rate * branch length). If scale is an array, a stack of transition matrices (one per scale) is returned.
+
+            With e2 = exp(-beta*s) and, for the class K (purines or pyrimidines) of states i and j, eK = exp(-(pi_K*alpha_K + pi_notK*beta)*s),
+                - transversions, P_ij = pi_j * (1 - e2)
+                - within class K, P_ij = pi_j + pi_j * (pi_notK/pi_K) * e2 + (delta_ij - pi_j/pi_K) * eK
+        '''
+        assert( self.valid ), "\n\nCannot compute a closed-form transition matrix for this model."
+        scales = np.atleast_1d( np.asarray(scale, dtype = float) )
+        e2 = np.exp( -self.beta * scales )[:, None, None]
+        e_r = np.exp( self.eigenvalues[2] * scales )[:, None, None]
+        e_y = np.exp( self.eigenvalues[3] * scales )[:, None, None]
+
+        same_class = np.equal.outer(self.purine, self.purine)
+        pi_k    = np.where(self.purine, self.pi_r, self.pi_y)[:, None]    # class total of source state
+        pi_notk = np.where(self.purine, self.pi_y, self.pi_r)[:, None]
+        e_k     = np.where(self.purine[:, None], e_r, e_y)                 # class-specific decay, by source state
+
+        within = self.freqs[None, :] + (self.freqs[None, :] * pi_notk / pi_k) * e2 + (np.eye(4) - self.freqs[None, :] / pi_k) * e_k
+        across = self.freqs[None, :] * (1. - e2)
+        prob_matrix = np.where(same_class, within, across)
+        if np.ndim(scale) == 0:
+            return prob_matrix[0]
+        return prob_matrix
+
+
+    def rows(self, states, scales):
+        '''
+            Return, for each site, the row of the transition matrix for the site's own **scale** and parent state, as an array of shape (number of sites, 4).
+        '''
+        return self( np.asarray(scales, dtype = float).reshape(-1) )[ np.arange(len(states)), states ]
+
+
+    def _model_name(self, tol):
+        '''
+            Return the name of the most specific nested model.
+        '''
+        equal_freqs = np.max(self.freqs) - np.min(self.freqs) <= ZERO
+        equal_ti    = abs(self.alpha_r - self.alpha_y) <= tol
+        no_kappa    = equal_ti and abs(self.alpha_r - self.beta) <= tol
+        if no_kappa:
+            return 'JC69' if equal_freqs else 'F81'
+        elif equal_ti:
+            return 'K80' if equal_freqs else 'HKY85'
+        return 'TN93'
+
+
+
+
+
+class TransitionCache(object):
+    '''
+        Bounded least-recently-used (LRU) cache of transition matrices.
+        Matrices are keyed on a model's matrix identity, the rate factor or rate category, and the branch length. Once the cache holds **maxsize** matrices, the least recently used matrix is evicted.
+
+        The cache also counts hits (matrices returned from the cache) and misses (matrices which had to be computed, either upon request or in bulk and then stored with *put*).
+    '''
+
+    def __init__(self, maxsize = 2048):
+        '''
+            Optional keyword arguments:
+                1. **maxsize** is the maximum number of transition matrices held by the cache. Default is 2048. Provide 0 to disable caching (every request is a miss).
+        '''
+        assert( int(maxsize) >= 0 ), "\n\nThe cache size must be a non-negative integer."
+        self.maxsize  = int(maxsize)
+        self.hits     = 0
+        self.misses   = 0
+        self._entries = OrderedDict()
+        self._lock    = threading.Lock()
+
+
+    def __len__(self):
+        return len(self._entries)
+
+
+    def __contains__(self, key):
+        return key in self._entries
+
+
+    def get(self, key, compute):
+        '''
+            Return the transition matrix stored under **key**. If not cached, the matrix is created by calling **compute** (a function which takes no arguments), stored, and returned.
+        '''
+        with self._lock:
+            if key in self._entries:
+                self.hits += 1
+                matrix = self._entries.pop(key)
+                self._entries[key] = matrix # Re-insert as most recently used
+                return matrix
+            self.misses += 1
+
+        matrix = compute()
+        with self._lock:
+            self._store(key, matrix)
+        return matrix
+
+
+    def put(self, key, matrix):
+        '''
+            Store **matrix** under **key**, e.g. when matrices are precomputed in bulk. Counts as a miss, since the matrix had to be computed.
+        '''
+        with self._lock:
+            self.misses += 1
+            self._store(key, matrix)
+
+
+    def resize(self, maxsize):
+        '''
+            Change the maximum number of matrices held by the cache, evicting least recently used matrices as needed.
+        '''
+        assert( int(maxsize) >= 0 ), "\n\nThe cache size must be a non-negative integer."
+        with self._lock:
+            self.maxsize = int(maxsize)
+            self._evict()
+
+
+    def clear(self):
+        '''
+            Remove all matrices from the cache and reset the hit and miss counters.
+        '''
+        with self._lock:
+            self._entries.clear()
+            self.hits   = 0
+            self.misses = 0
+
+
+    def _store(self, key, matrix):
+        '''
+            Store a matrix as the most recently used entry, and evict as needed. Lock must be held.
+        '''
+        if self.maxsize > 0:
+            self._entries.pop(key, None)
+            self._entries[key] = matrix
+            self._evict()
+
+
+    def _evict(self):
+        '''
+            Evict least recently used matrices until the cache is within its size bound. Lock must be held.
+        '''
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last = False)
+
+
+
+# Process-wide cache shared by all Evolver instances (unless they are given their own cache).
+TRANSITION_CACHE = TransitionCache()
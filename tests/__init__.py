@@ -9,6 +9,16 @@ Test modules
 
 * matrix_builder_test
 
+* plan_test
+
+* replicates_test
+
+* sampler_test
+
+* storage_test
+
+* transition_test
+
 * evolver_test 
 
 """
@@ -13,6 +13,8 @@
 '''
 
 import unittest
+import sys
+import subprocess
 from pyvolve import *
 
 
@@ -101,6 +103,198 @@ class evolver_singlepart_nohet_tests(unittest.TestCase):
             os.remove("out.phy")
 
 
+    def test_evolver_singlepart_nohet_cache(self):
+        '''
+            Test evolver with a single partition, no heterogeneity at all.
+            Ensure that transition matrices are computed once per distinct branch length, and reused by a second simulation along the same tree.
+        '''
+        cache = TransitionCache()
+        Evolver(partitions = self.part1, tree = self.tree, seqfile = False, ratefile = False, infofile = False, cache = cache)()
+        self.assertEqual( (cache.misses, cache.hits), (7, 0), msg = "Transition matrices improperly cached during simulation.") # 8 branches of nonzero length, two of which are 0.77. All 7 distinct matrices are precomputed, and kept for the simulation.
+        
+        part = Partition()
+        part.models = self.part1.models
+        part.size = 10
+        Evolver(partitions = part, tree = self.tree, seqfile = False, ratefile = False, infofile = False, cache = cache)()
+        self.assertEqual( (cache.misses, cache.hits), (7, 7), msg = "Transition matrices not reused by a second simulation.")
+
+
+    def test_evolver_singlepart_nohet_sampling_tables(self):
+        '''
+            Test evolver with a single partition, no heterogeneity at all.
+            Ensure that a sampling table is prepared once per transition matrix, and reused along all branches and windows of sites sharing that matrix, with or without branch_regimes.
+        '''
+        part = Partition()
+        part.models = self.part1.models
+        part.size = 10
+        for options, num_windows in [ ({}, 1), ({'chunk_size': 5}, 2), ({'branch_regimes': True}, 1), ({'branch_regimes': True, 'chunk_size': 5}, 2) ]:
+            my_evolver = Evolver(partitions = part, tree = self.tree, seqfile = False, ratefile = False, infofile = False, cache = None, sampler = counting_sampler(), **options)
+            my_evolver()
+            self.assertEqual( my_evolver._sampler.num_tables, my_evolver.num_prob_matrices + num_windows, msg = "Sampling tables prepared more than once per transition matrix (" + str(options) + ").") # One table per distinct matrix, plus the root's table for each window
+
+
+    def test_evolver_singlepart_nohet_cache_disabled(self):
+        '''
+            Test evolver with a single partition, no heterogeneity at all.
+            Ensure that with caching disabled, each distinct transition matrix is computed only once per simulation.
+        '''
+        tree = read_tree( tree = "(" + ",".join( "t" + str(i) + ":" + str(0.01 * (i + 1)) for i in range(40) ) + ");" )
+        my_evolver = Evolver(partitions = self.part1, tree = tree, seqfile = False, ratefile = False, infofile = False, cache = None)
+        my_evolver()
+        self.assertEqual( (my_evolver.num_prob_matrices, my_evolver.cache.misses), (40, 40), msg = "Transition matrices computed more than once without a cache.")
+        my_evolver()
+        self.assertEqual( my_evolver.cache.misses, 80, msg = "Transition matrices computed more than once without a cache.")
+
+
+    def test_evolver_singlepart_nohet_threads(self):
+        '''
+            Test evolver with a single partition, no heterogeneity at all.
+            Ensure that transition matrices computed in a thread pool are identical to those computed serially.
+        '''
+        caches = []
+        for num_threads in [1, 4]:
+            part = Partition()
+            part.models = self.part1.models
+            part.size = 10
+            caches.append( TransitionCache() )
+            Evolver(partitions = part, tree = self.tree, seqfile = False, ratefile = False, infofile = False, cache = caches[-1], num_threads = num_threads)()
+        self.assertEqual( len(caches[0]), 7, msg = "Transition matrices improperly precomputed.")
+        self.assertEqual( sorted(caches[0]._entries.keys()), sorted(caches[1]._entries.keys()), msg = "Threaded precomputation computed different transition matrices.")
+        for key in caches[0]._entries:
+            np.testing.assert_array_equal( caches[0]._entries[key], caches[1]._entries[key], err_msg = "Threaded precomputation computed different transition matrices.")
+        self.assertRaises(AssertionError, Evolver, partitions = self.part1, tree = self.tree, num_threads = 0)
+
+
+    def test_evolver_singlepart_nohet_threads_small_cache(self):
+        '''
+            Test evolver with a single partition and rate categories.
+            Ensure that with threaded precomputation and more distinct transition matrices than the cache holds, each matrix is computed only once.
+        '''
+        tree = read_tree( tree = "(" + ",".join( "t" + str(i) + ":" + str(0.01 * (i + 1)) for i in range(40) ) + ");" )
+        m2 = Model( {'state_freqs':EqualFrequencies(by = 'nuc')(), 'kappa':2.}, "nucleotide" )
+        m2.construct_model(rate_factors = [0.5, 1., 1.5], rate_probs = [0.25, 0.5, 0.25])
+        cache = TransitionCache(maxsize = 8)
+        my_evolver = Evolver(partitions = Partition(models = m2, size = 20), tree = tree, seqfile = False, ratefile = False, infofile = False, cache = cache, num_threads = 4)
+        my_evolver()
+        self.assertEqual( (my_evolver.num_prob_matrices, cache.misses), (120, 120), msg = "Transition matrices evicted from a small cache were computed again.")
+
+
+    def test_evolver_singlepart_nohet_replicates(self):
+        '''
+            Test evolver with a single partition, no heterogeneity at all.
+            Ensure that a single Evolver (or plan) can be called repeatedly with different seeds, without modifying its partition.
+        '''
+        my_evolver = Evolver(partitions = self.part1, tree = self.tree, seqfile = False, ratefile = False, infofile = False)
+        self.assertEqual( self.part1.size, 10, msg = "Evolver modified the partition.")
+        my_evolver(seed = 1)
+        first = dict( (name, my_evolver.leaf_seqs[name][0].copy()) for name in my_evolver.leaf_seqs )
+        my_evolver(seed = 2)
+        self.assertTrue( any( np.any(first[name] != my_evolver.leaf_seqs[name][0]) for name in first ), msg = "Different seeds gave identical replicates.")
+        
+        other_evolver = Evolver(plan = my_evolver.plan, seqfile = False, ratefile = False, infofile = False)
+        other_evolver(seed = 1)
+        for name in first:
+            self.assertTrue( np.all(first[name] == other_evolver.leaf_seqs[name][0]), msg = "Replicates with the same seed differ.")
+        Evolver(partitions = self.part1, tree = self.tree, seqfile = False, ratefile = False, infofile = False)()
+
+
+    def test_evolver_singlepart_nohet_ladder(self):
+        '''
+            Test evolver with a single partition, no heterogeneity at all.
+            Ensure that a ladder tree deeper than Python's recursion limit can be parsed and evolved.
+        '''
+        num_taxa = sys.getrecursionlimit() + 1000
+        tstring = "".join( "(t" + str(i) + ":0.01," for i in range(num_taxa - 1) ) + "t" + str(num_taxa - 1) + ":0.01" + "):0.01" * (num_taxa - 2) + ");"
+        tree = read_tree( tree = tstring )
+        self.assertEqual( tree.children[0].name, "t0", msg = "Ladder tree improperly parsed.")
+        self.assertEqual( tree.children[1].name, "internal_node" + str(num_taxa - 2), msg = "Ladder tree improperly parsed.")
+        part = Partition()
+        part.models = self.part1.models
+        part.size = 10
+        my_evolver = Evolver(partitions = part, tree = tree, seqfile = False, ratefile = False, infofile = False)
+        my_evolver()
+        self.assertEqual( len(my_evolver.leaf_seqs), num_taxa, msg = "Not all leaves of a ladder tree were evolved.")
+        self.assertEqual( len(my_evolver.evolved_seqs), 2 * num_taxa - 1, msg = "Not all nodes of a ladder tree were evolved.")
+
+
+    def test_evolver_singlepart_nohet_retain(self):
+        '''
+            Test evolver with a single partition, no heterogeneity at all.
+            Ensure that only the sequences specified with the retain argument are kept.
+        '''
+        leaves = ['t1', 't2', 't3', 't4', 't5']
+        for retain, kept in [ ('all', 9), ('leaves', 5), (['root', 'internal_node2'], 7) ]:
+            my_evolver = Evolver(partitions = self.part1, tree = self.tree, seqfile = False, ratefile = False, infofile = False, retain = retain)
+            my_evolver()
+            self.assertEqual( len(my_evolver.evolved_seqs), kept, msg = "Wrong number of sequences retained.")
+            self.assertEqual( sorted(my_evolver.leaf_seqs.keys()), leaves, msg = "Leaf sequences not retained.")
+            for name in my_evolver.evolved_seqs:
+                self.assertEqual( len(my_evolver.evolved_seqs[name][0]), 10, msg = "Retained sequence has the wrong length.")
+        self.assertTrue( 'internal_node2' in my_evolver.evolved_seqs and 'internal_node1' not in my_evolver.evolved_seqs, msg = "Named internal node improperly retained.")
+        self.assertRaises( AssertionError, Evolver, partitions = self.part1, tree = self.tree, retain = ['internal_node9'] )
+
+
+    def test_evolver_singlepart_nohet_quantization(self):
+        '''
+            Test evolver with a single partition, no heterogeneity at all.
+            Ensure that branch-length quantization lets nearly identical branches share transition matrices, and reports the induced error.
+        '''
+        tree = read_tree( tree = "((t1:0.2,t2:0.200001):0.2000002,(t3:0.5,t4:0.4999999):0.0);" )
+        my_evolver = Evolver(partitions = self.part1, tree = tree, seqfile = False, ratefile = False, infofile = False, cache = None)
+        my_evolver()
+        self.assertEqual( (my_evolver.num_prob_matrices, my_evolver.quantization_error), (5, 0.), msg = "Distinct transition matrices incorrect without quantization.")
+        
+        for kwargs in [ {'bl_tolerance':1e-4}, {'bl_grid':0.01} ]:
+            part = Partition()
+            part.models = self.part1.models
+            part.size = 10
+            my_evolver = Evolver(partitions = part, tree = tree, seqfile = False, ratefile = False, infofile = False, cache = None, **kwargs)
+            my_evolver()
+            self.assertEqual( my_evolver.num_prob_matrices, 2, msg = "Quantized branch lengths did not share transition matrices.")
+            self.assertTrue( 0. < my_evolver.quantization_error <= 0.5e-4, msg = "Quantization error improperly reported.")
+        self.assertRaises(AssertionError, Evolver, partitions = part, tree = tree, bl_tolerance = 1e-4, bl_grid = 0.01)
+
+
+    def test_evolver_singlepart_nohet_regimes(self):
+        '''
+            Test evolver with a single partition, no heterogeneity at all.
+            Ensure that with branch_regimes, saturated branches need no transition matrix and draw from the state frequencies, while short and intermediate branches still evolve.
+        '''
+        tree = read_tree( tree = "((t1:0.001,t2:0.3):0.01,t3:100.);" )
+        part = Partition()
+        part.models = self.part1.models
+        part.size = 5000
+        my_evolver = Evolver(partitions = part, tree = tree, seqfile = False, ratefile = False, infofile = False, cache = None, seed = 5, branch_regimes = True)
+        my_evolver()
+        self.assertEqual( my_evolver.num_prob_matrices, 3, msg = "Saturated branch should not require a transition matrix.")
+        root = my_evolver.evolved_seqs['root'][0]
+        for name, low, high in [ ('t1', 0.985, 0.995), ('t2', 0.72, 0.78), ('t3', 0.2, 0.3) ]:
+            identity = np.mean( my_evolver.leaf_seqs[name][0] == root )
+            self.assertTrue( low < identity < high, msg = "Sequence identity to the root is incorrect along a branch with regime sampling.")
+        self.assertRaises(AssertionError, Evolver, partitions = part, tree = tree, short_branch = 1.5)
+
+
+    def test_evolver_singlepart_nohet_siblings(self):
+        '''
+            Test evolver with a single partition, no heterogeneity at all.
+            Ensure that siblings sharing a branch length are evolved independently of one another when batched, and that all leaves of a star tree are evolved.
+        '''
+        tree = read_tree( tree = "(t1:0.2,t2:0.2,t3:0.2,(t4:0.1,t5:0.1,t6:0.0):0.2,t7:0.0);" )
+        part = Partition()
+        part.models = self.part1.models
+        part.size = 5000
+        my_evolver = Evolver(partitions = part, tree = tree, seqfile = False, ratefile = False, infofile = False, seed = 3)
+        my_evolver()
+        self.assertEqual( sorted(my_evolver.leaf_seqs.keys()), ['t%d' % i for i in range(1,8)], msg = "Leaf sequences missing after sibling-batched evolution.")
+        root = my_evolver.evolved_seqs['root'][0]
+        self.assertTrue( np.all(my_evolver.leaf_seqs['t7'][0] == root), msg = "Zero-length branch changed the sequence.")
+        self.assertTrue( np.all(my_evolver.leaf_seqs['t6'][0] == my_evolver.evolved_seqs['internal_node1'][0]), msg = "Zero-length branch changed the sequence.")
+        # P_same(0.2) = 0.25 + 0.75 * exp(-0.8/3) ~= 0.824 to the root, and P_same(0.4) ~= 0.690 between siblings
+        for name in ['t1', 't2', 't3']:
+            self.assertTrue( 0.80 < np.mean(my_evolver.leaf_seqs[name][0] == root) < 0.85, msg = "Batched sibling evolved incorrectly.")
+        self.assertTrue( 0.66 < np.mean(my_evolver.leaf_seqs['t1'][0] == my_evolver.leaf_seqs['t2'][0]) < 0.72, msg = "Batched siblings are not independent.")
+        
+
 class evolver_twopart_nohet_tests(unittest.TestCase):
     ''' 
         Suite of tests for evolver under temporally homogeneous conditions (no branch heterogeneity!!)
@@ -129,6 +323,24 @@ class evolver_twopart_nohet_tests(unittest.TestCase):
         self.part2.size = 12
         
         
+    def test_evolver_twopart_nohet_fusion(self):
+        '''
+            Test evolver with partitions sharing a model.
+            Ensure that their sites are drawn together (one draw per rate category and branch, whatever the number of partitions), and split back into partitions of the right sizes.
+        '''
+        model = Model( {'state_freqs':EqualFrequencies(by = 'nuc')()}, 'nucleotide')
+        model.construct_model(rate_factors = [0.05, 1.95], rate_probs = [0.5, 0.5])
+        parts = [ Partition(models = model, size = 400 + 100 * i) for i in range(10) ]
+        sampler = counting_sampler()
+        my_evolver = Evolver(partitions = parts, tree = self.tree, seqfile = False, ratefile = False, infofile = False, sampler = sampler)
+        my_evolver()
+        self.assertEqual( my_evolver._sampler.num_draws, 1 + 2 * len(my_evolver.plan.groups), msg = "Partitions sharing a model were not fused.")
+        self.assertEqual( [ len(part_seq) for part_seq in my_evolver.leaf_seqs['t1'] ], [ 400 + 100 * i for i in range(10) ], msg = "Fused partitions improperly split.")
+        for p in range(10):
+            same = my_evolver.evolved_seqs['root'][p] == my_evolver.leaf_seqs['t4'][p]
+            self.assertTrue( np.mean(same[ my_evolver._site_rates[p] == 0 ]) > 0.85 and np.mean(same[ my_evolver._site_rates[p] == 1 ]) < 0.5, msg = "Fused partitions did not evolve at their category's rate.")
+
+
     def test_evolver_twopart_nohet_ratefile(self):
         '''
             Test evolver with two partitions, no heterogeneity at all.
@@ -179,6 +391,23 @@ class evolver_twopart_nohet_tests(unittest.TestCase):
 
 
 
+class counting_sampler(InverseCDFSampler):
+    '''
+        Sampler which counts its draws, and the tables it prepares.
+    '''
+    num_draws = 0
+    num_tables = 0
+    def prepare(self, prob_matrix):
+        self.num_tables += 1
+        return InverseCDFSampler.prepare(self, prob_matrix)
+
+    def draw(self, table, states):
+        self.num_draws += 1
+        return InverseCDFSampler.draw(self, table, states)
+
+
+
+
 class evolver_sitehet_tests(unittest.TestCase):
     ''' 
         Suite of tests for evolver under temporally homogeneous conditions (no branch heterogeneity!!).
@@ -231,7 +460,7 @@ class evolver_sitehet_tests(unittest.TestCase):
         os.remove("info.txt")
         assert( len(test) == 4), "Infofile improperly written for single partition, site het (wrong num lines)."
         for i in range(1, 4):
-            self.assertRegexpMatches( test[i],  "1\tNone\t" + str(i) + "\t" + str(round(self.part1.models[0].rate_probs[i-1],4)) + "\t" + str(round(self.part1.models[0].rate_factors[i-1],4)), msg = "Infofile improperly written for single partition, site het (wrong line contents).")
+            self.assertRegexpMatches( test[i],  "1\tNone\t" + str(i) + "\t" + str(round(self.part1.models.rate_probs[i-1],4)) + "\t" + str(round(self.part1.models.rate_factors[i-1],4)), msg = "Infofile improperly written for single partition, site het (wrong line contents).")
 
         
         
@@ -266,6 +495,299 @@ class evolver_sitehet_tests(unittest.TestCase):
         assert(len(aln[0]) == 12), "Output alignment incorrect length."
 
 
+    def test_evolver_sitehet_arrays(self):
+        '''
+            Test evolver with one partition, site heterogeneity.
+            Ensure sequences and rate categories are stored as integer arrays, and that each rate category keeps its share of sites.
+        '''
+        my_evolver = Evolver(partitions = self.part1, tree = self.tree, seqfile = False, infofile = False, ratefile = False)
+        my_evolver()
+        assert(len(my_evolver.evolved_seqs) == 9), "Wrong number of evolved sequences stored."
+        for record in my_evolver.evolved_seqs:
+            seq = my_evolver.evolved_seqs[record]
+            assert(len(seq) == 1), "Evolved sequence should contain one array per partition."
+            assert(seq[0].dtype == np.int8 and seq[0].shape == (12,)), "Evolved sequence is not a small-integer array of partition length."
+            assert(seq[0].min() >= 0 and seq[0].max() < 4), "Evolved sequence contains states outside the nucleotide alphabet."
+        self.assertEqual( sorted(np.bincount(my_evolver._site_rates[0], minlength = 3)), [3, 3, 6], msg = "Rate categories improperly assigned to sites.")
+
+
+    def test_evolver_sitehet_seed(self):
+        '''
+            Test evolver with one partition, site heterogeneity.
+            Ensure that, for each sampler (given by name or as a Sampler instance), providing the same seed reproduces the same simulation.
+        '''
+        for sampler in ['cdf', 'alias', AliasSampler, MultinomialSampler]:
+            evolved = []
+            for rep in range(2):
+                part = Partition()
+                part.models = self.part1.models
+                part.size = 12
+                my_evolver = Evolver(partitions = part, tree = self.tree, seqfile = False, infofile = False, ratefile = False, sampler = sampler if type(sampler) is str else sampler(), seed = 42)
+                my_evolver()
+                evolved.append(my_evolver)
+            for record in evolved[0].evolved_seqs:
+                np.testing.assert_array_equal(evolved[0].evolved_seqs[record][0], evolved[1].evolved_seqs[record][0], err_msg = "Same seed did not reproduce the same sequences.")
+            np.testing.assert_array_equal(evolved[0]._site_rates[0], evolved[1]._site_rates[0], err_msg = "Same seed did not reproduce the same rate categories.")
+
+
+    def test_evolver_sitehet_shared_sampler(self):
+        '''
+            Test evolver with one partition, site heterogeneity, with a single Sampler instance shared by two seeded Evolvers.
+            Ensure that each Evolver draws from its own generator, so that it reproduces the simulation it gives when run alone.
+        '''
+        part = Partition()
+        part.models = self.part1.models
+        part.size = 50
+        alone = []
+        for seed in [1, 2]:
+            my_evolver = Evolver(partitions = part, tree = self.tree, seqfile = False, infofile = False, ratefile = False, sampler = AliasSampler(), seed = seed)
+            my_evolver()
+            alone.append(my_evolver)
+        sampler = AliasSampler()
+        shared = [ Evolver(partitions = part, tree = self.tree, seqfile = False, infofile = False, ratefile = False, sampler = sampler, seed = seed) for seed in [1, 2] ]
+        for my_evolver in shared:
+            my_evolver()
+        self.assertTrue( sampler.rng is np.random, msg = "Shared Sampler instance was modified by an Evolver.")
+        for i in range(2):
+            for record in alone[i].evolved_seqs:
+                np.testing.assert_array_equal(alone[i].evolved_seqs[record][0], shared[i].evolved_seqs[record][0], err_msg = "Evolver sharing a Sampler instance did not reproduce its own simulation.")
+
+
+    def test_evolver_sitehet_chunks(self):
+        '''
+            Test evolver with one partition, site heterogeneity, simulated in chunks of sites.
+            Ensure that full-length sequences are assembled from the chunks, and that each site evolves at the rate of its (shuffled) rate category.
+        '''
+        self.assertRaises( AssertionError, Evolver, partitions = self.part1, tree = self.tree, chunk_size = 5, storage = 'delta' )
+        self.assertRaises( AssertionError, Evolver, partitions = self.part1, tree = self.tree, chunk_size = 0 )
+        my_evolver = Evolver(partitions = self.part1, tree = self.tree, seqfile = "out.fasta", write_anc = True, infofile = False, ratefile = False, chunk_size = 5)
+        my_evolver()
+        aln = AlignIO.read("out.fasta", "fasta")
+        os.remove("out.fasta")
+        assert(len(aln) == 9), "Wrong number of sequences were written to file when simulating in chunks."
+        assert(len(aln[0]) == 12), "Output alignment incorrect length when simulating in chunks."
+        self.assertEqual( sorted(np.bincount(my_evolver._site_rates[0], minlength = 3)), [3, 3, 6], msg = "Rate categories improperly assigned to sites when simulating in chunks.")
+
+        part = Partition()
+        part.models = self.part1.models
+        part.size = 3000
+        my_evolver = Evolver(partitions = part, tree = self.tree, seqfile = False, infofile = False, ratefile = False, chunk_size = 700, seed = 11)
+        my_evolver()
+        root = my_evolver.evolved_seqs['root'][0]
+        t1 = my_evolver.leaf_seqs['t1'][0]
+        self.assertEqual( root.shape, (3000,), msg = "Chunked sequence has the wrong length.")
+        identity = [ np.mean( (root == t1)[my_evolver._site_rates[0] == i] ) for i in range(3) ]
+        self.assertTrue( identity[0] < 0.4 and 0.42 < identity[1] < 0.6 and identity[2] > 0.9, msg = "Sites in chunks did not evolve at their category's rate.")
+
+
+    def _chunked_peak_memory(self, seqfile):
+        '''
+            Simulate a long partition in chunks of sites in a separate process, and return the increase in its peak memory use (in bytes) over the simulation and writing of sequences.
+        '''
+        script = "\n".join([ "import sys, resource",
+                              "from Bio import SeqIO",
+                              "from pyvolve import *",
+                              "model = Model( {'state_freqs':EqualFrequencies(by = 'nuc')()}, 'nucleotide')",
+                              "model.construct_model()",
+                              "my_evolver = Evolver(partitions = Partition(models = model, size = 2000000), tree = read_tree( tree = '((t1:0.1,t2:0.2):0.05,(t3:0.3,t4:0.1):0.1);' ), seqfile = " + repr(seqfile) + ", ratefile = False, infofile = False, retain = 'leaves', chunk_size = 50000, seed = 5)",
+                              "before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss",
+                              "my_evolver()",
+                              "print resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before" ])
+        env = dict( os.environ, PYTHONPATH = os.pathsep.join(sys.path) )
+        peak = int( subprocess.check_output([sys.executable, "-c", script], env = env).split()[-1] )
+        return peak if sys.platform == 'darwin' else peak * 1024 # ru_maxrss is given in kilobytes, except on OS X
+
+
+    def test_evolver_sitehet_chunks_memory(self):
+        '''
+            Test evolver with one partition simulated in chunks of sites, writing a seqfile.
+            Ensure that writing sequences does not create a Python object per site, so that memory use remains bounded by the length of a single sequence.
+        '''
+        unwritten = self._chunked_peak_memory(False)
+        written = self._chunked_peak_memory("chunk_memory.fasta")
+        os.remove("chunk_memory.fasta")
+        self.assertTrue( written - unwritten < 25 * 2000000, msg = "Writing sequences used too much memory when simulating in chunks (" + str( (written - unwritten) // 2000000 ) + " bytes per site).")
+
+
+    def test_evolver_sitehet_chunks_small_cache(self):
+        '''
+            Test evolver with one partition, site heterogeneity, simulated in chunks of sites (or subtrees) with a cache smaller than the number of distinct transition matrices.
+            Ensure that transition matrices are computed once per simulation, however many windows of sites are simulated.
+        '''
+        part = Partition()
+        part.models = self.part1.models
+        part.size = 200
+        for options in [ {'chunk_size': 100}, {'chunk_size': 10}, {'chunk_size': 10, 'site_processes': 1}, {'subtree_processes': 1} ]:
+            cache = TransitionCache(maxsize = 4)
+            my_evolver = Evolver(partitions = part, tree = self.tree, seqfile = False, infofile = False, ratefile = False, cache = cache, **options)
+            my_evolver()
+            self.assertEqual( (my_evolver.num_prob_matrices, cache.misses), (21, 21), msg = "Transition matrices computed again for windows of sites or subtrees (" + str(options) + ").") # 7 distinct branch lengths, 3 rate categories
+
+
+    def test_evolver_sitehet_batched_replicates(self):
+        '''
+            Test evolver with one partition, site heterogeneity, simulating many replicates in a single traversal.
+            Ensure that the replicate array is properly shaped and reproducible, and that leaves diverge as expected given the rate categories.
+        '''
+        my_evolver = Evolver(partitions = self.part1, tree = self.tree, seqfile = False, infofile = False, ratefile = False)
+        alignments = my_evolver.simulate_replicates(2000, seed = 5)
+        self.assertEqual( alignments.shape, (2000, 5, 12), msg = "Replicate array improperly shaped.")
+        self.assertTrue( alignments.min() >= 0 and alignments.max() < 4, msg = "Replicate array contains states outside the nucleotide alphabet.")
+        np.testing.assert_array_equal( alignments, my_evolver.simulate_replicates(2000, seed = 5), err_msg = "Same seed did not reproduce the same replicates.")
+        self.assertEqual( my_evolver.simulate_replicates(7, batch_size = 3).shape, (7, 5, 12), msg = "Batched replicate array improperly shaped.")
+        self.assertRaises( AssertionError, my_evolver.simulate_replicates, 0 )
+
+        # Expected identity between t1 and t2 (distance 0.81) under JC, averaged over rate categories of 3, 3 and 6 sites
+        leaves = [ my_evolver.plan.node_names[index] for index in my_evolver.plan.leaves ]
+        expected = np.dot( [0.25, 0.25, 0.5], 0.25 + 0.75 * np.exp( -4./3. * 0.81 * np.array(self.part1.models.rate_factors) ) )
+        identity = np.mean( alignments[:, leaves.index('t1')] == alignments[:, leaves.index('t2')] )
+        self.assertTrue( abs(identity - expected) < 0.02, msg = "Replicates did not diverge as expected.")
+
+
+    def test_evolver_sitehet_independent_replicates(self):
+        '''
+            Test evolver with one partition, site heterogeneity, simulating replicates with independent random streams over several processes.
+            Ensure that each replicate depends only on the master seed and its index, and not on the number of processes or replicates.
+        '''
+        my_evolver = Evolver(partitions = self.part1, tree = self.tree, seqfile = False, infofile = False, ratefile = False)
+        self.assertRaises( AssertionError, my_evolver.simulate_replicates, 4, num_processes = 2 )
+        serial = my_evolver.simulate_replicates(6, seed = 3, num_processes = 1)
+        self.assertEqual( serial.shape, (6, 5, 12), msg = "Replicate array improperly shaped.")
+        np.testing.assert_array_equal( serial, my_evolver.simulate_replicates(6, seed = 3, num_processes = 3), err_msg = "Replicates depend on the number of processes.")
+        np.testing.assert_array_equal( serial[:4], my_evolver.simulate_replicates(4, seed = 3, num_processes = 2), err_msg = "Replicates depend on the number of replicates.")
+        self.assertFalse( np.all( serial[0] == serial[1] ), msg = "Replicates are not independent.")
+        self.assertFalse( np.all( serial == my_evolver.simulate_replicates(6, seed = 4, num_processes = 1) ), msg = "Different master seeds gave identical replicates.")
+
+
+    def test_evolver_sitehet_subtrees(self):
+        '''
+            Test evolver with one partition, site heterogeneity, evolving subtrees in worker processes.
+            Ensure that results do not depend on the number of processes, and that leaves diverge as expected given the rate categories.
+        '''
+        self.assertRaises( AssertionError, Evolver, partitions = self.part1, tree = self.tree, subtree_processes = 2, storage = 'delta' )
+        part = Partition()
+        part.models = self.part1.models
+        part.size = 2000
+        evolved = []
+        for processes in [1, 3]:
+            my_evolver = Evolver(partitions = part, tree = self.tree, seqfile = False, infofile = False, ratefile = False, seed = 8, retain = ['root'], subtree_processes = processes)
+            my_evolver()
+            evolved.append(my_evolver)
+        self.assertEqual( sorted(evolved[0].evolved_seqs.keys()), ['root', 't1', 't2', 't3', 't4', 't5'], msg = "Wrong sequences retained with parallel subtrees.")
+        for name in evolved[0].evolved_seqs:
+            np.testing.assert_array_equal( evolved[0].evolved_seqs[name][0], evolved[1].evolved_seqs[name][0], err_msg = "Parallel subtrees depend on the number of processes.")
+        np.testing.assert_array_equal( evolved[0]._site_rates[0], evolved[1]._site_rates[0], err_msg = "Parallel subtrees depend on the number of processes.")
+
+        # Expected identity between t1 and t2 (distance 0.81) under JC, in each rate category
+        expected = 0.25 + 0.75 * np.exp( -4./3. * 0.81 * np.array(self.part1.models.rate_factors) )
+        same = evolved[1].leaf_seqs['t1'][0] == evolved[1].leaf_seqs['t2'][0]
+        for i in range(3):
+            self.assertTrue( abs( np.mean(same[ evolved[1]._site_rates[0] == i ]) - expected[i] ) < 0.06, msg = "Parallel subtrees did not diverge as expected.")
+
+
+    def test_evolver_sitehet_site_processes(self):
+        '''
+            Test evolver with site heterogeneity, evolving windows of sites in worker processes.
+            Ensure that results do not depend on the number of processes, match site-chunked simulation, and are stitched together in order.
+        '''
+        self.assertRaises( AssertionError, Evolver, partitions = self.part1, tree = self.tree, site_processes = 2, subtree_processes = 2 )
+        part = Partition()
+        part.models = self.part1.models
+        part.size = 3000
+        evolved = []
+        for processes in [None, 1, 3]:
+            my_evolver = Evolver(partitions = [part, self.part1], tree = self.tree, seqfile = False, infofile = False, ratefile = False, seed = 9, chunk_size = 700, site_processes = processes)
+            my_evolver()
+            evolved.append(my_evolver)
+        self.assertEqual( [ len(part_seq) for part_seq in evolved[2].leaf_seqs['t1'] ], [3000, 12], msg = "Site-parallel sequences have the wrong length.")
+        for name in evolved[0].evolved_seqs:
+            for p in range(2):
+                np.testing.assert_array_equal( evolved[0].evolved_seqs[name][p], evolved[1].evolved_seqs[name][p], err_msg = "Site-parallel simulation differs from site-chunked simulation.")
+                np.testing.assert_array_equal( evolved[1].evolved_seqs[name][p], evolved[2].evolved_seqs[name][p], err_msg = "Site-parallel simulation depends on the number of processes.")
+
+        # Each window must evolve its own columns, at the rate of their categories
+        root = evolved[2].evolved_seqs['root'][0]
+        t1 = evolved[2].leaf_seqs['t1'][0]
+        identity = [ np.mean( (root == t1)[evolved[2]._site_rates[0] == i] ) for i in range(3) ]
+        self.assertTrue( identity[0] < 0.4 and 0.42 < identity[1] < 0.6 and identity[2] > 0.9, msg = "Sites in windows did not evolve at their category's rate.")
+
+
+    def test_evolver_sitehet_counter_rng(self):
+        '''
+            Test evolver with site heterogeneity, with counter-based random numbers.
+            Ensure that serial, chunked, site-parallel, subtree-parallel and replicate simulations all give identical alignments for the same seed.
+        '''
+        self.assertRaises( AssertionError, Evolver, partitions = self.part1, tree = self.tree, rng_mode = 'counter' )
+        self.assertRaises( AssertionError, Evolver, partitions = self.part1, tree = self.tree, rng_mode = 'counter', seed = 1, block_size = 8, chunk_size = 12 )
+        part = Partition()
+        part.models = self.part1.models
+        part.size = 50
+        leaves = ['t1', 't2', 't3', 't4', 't5']
+        alignments = []
+        for options in [ {}, {'chunk_size': 16}, {'chunk_size': 24, 'site_processes': 2}, {'subtree_processes': 2}, {'storage': 'delta'} ]:
+            my_evolver = Evolver(partitions = [part, self.part1], tree = self.tree, seqfile = False, infofile = False, ratefile = False, seed = 17, rng_mode = 'counter', block_size = 8, **options)
+            my_evolver()
+            alignments.append( np.array([ np.concatenate(my_evolver.leaf_seqs[name]) for name in leaves ]) )
+        
+        order = [ my_evolver.plan.node_names[index] for index in my_evolver.plan.leaves ]
+        replicates = my_evolver.simulate_replicates(3)[:, [ order.index(name) for name in leaves ]]
+        self.assertFalse( np.all(replicates[0] == replicates[1]), msg = "Counter-based replicates are not independent.")
+        alignments.append( replicates[0] )
+        alignments.append( my_evolver.simulate_replicates(2, batch_size = 1)[0][[ order.index(name) for name in leaves ]] )
+        alignments.append( my_evolver.simulate_replicates(2, num_processes = 2)[0][[ order.index(name) for name in leaves ]] )
+        for i in range(1, len(alignments)):
+            np.testing.assert_array_equal( alignments[0], alignments[i], err_msg = "Counter-based random numbers depend on the simulation mode (" + str(i) + ").")
+
+
+
+    def test_evolver_sitehet_continuous(self):
+        '''
+            Test evolver with continuous gamma rates.
+            Ensure that the fraction of sites which change along a branch matches its expectation over gamma rates, that counter-based random numbers give identical alignments and rates in all simulation modes, and that chunked simulation keeps rates on disk.
+        '''
+        m2 = Model( {'state_freqs':EqualFrequencies(by = 'nuc')()}, 'nucleotide' )
+        m2.construct_model(alpha = 0.5, continuous = True)
+        my_evolver = Evolver(partitions = Partition(models = m2, size = 50000), tree = read_tree(tree = "(t1:0.5,t2:0.5);"), seqfile = False, infofile = False, ratefile = False, seed = 3)
+        my_evolver()
+        self.assertEqual( my_evolver.num_prob_matrices, 0, msg = "Transition matrices computed for continuous gamma rates.")
+        rate_evolver = Evolver(partitions = [Partition(models = m2, size = 20), self.part1], tree = self.tree, seqfile = False, infofile = False, ratefile = "rates.txt", chunk_size = 8, seed = 3)
+        rate_evolver()
+        with open('rates.txt', 'r') as test_h:
+            test = [ line.rstrip("\n").split("\t") for line in test_h ]
+        os.remove("rates.txt")
+        self.assertEqual( test[0], ["Site_Index", "Partition_Index", "Rate_Category", "Rate_Factor"], msg = "Ratefile header lacks continuous gamma rates.")
+        self.assertEqual( len(test), 33, msg = "Ratefile improperly written with continuous gamma rates (wrong num lines).")
+        np.testing.assert_array_almost_equal( [ float(line[3]) for line in test[1:21] ], rate_evolver.site_factors[0], decimal = 10, err_msg = "Continuous gamma rates improperly written to ratefile.")
+        self.assertEqual( set( line[3] for line in test[21:] ), set(["NA"]), msg = "Rate factors written for a partition with rate categories.")
+        self.assertTrue( abs(np.mean(my_evolver.site_factors[0]) - 1.) < 0.03, msg = "Continuous gamma rates improperly drawn.")
+        changed = np.mean( my_evolver.evolved_seqs['root'][0] != my_evolver.evolved_seqs['t1'][0] )
+        self.assertTrue( abs(changed - 0.75 * (1. - (1. + 4./3. * 0.5 / 0.5)**-0.5)) < 0.01, msg = "Sites with continuous gamma rates evolved incorrectly.")
+
+        part = Partition(models = m2, size = 50)
+        alignments = []
+        factors = []
+        for options in [ {}, {'chunk_size': 16}, {'chunk_size': 16, 'site_processes': 2}, {'subtree_processes': 2}, {'storage': 'delta'} ]:
+            my_evolver = Evolver(partitions = [part, self.part1], tree = self.tree, seqfile = False, infofile = False, ratefile = False, seed = 17, rng_mode = 'counter', block_size = 8, **options)
+            my_evolver()
+            alignments.append( np.array([ np.concatenate(my_evolver.leaf_seqs[name]) for name in ['t1', 't3', 't5'] ]) )
+            factors.append( my_evolver.site_factors[0] )
+            self.assertTrue( my_evolver.site_factors[1] is None, msg = "Continuous gamma rates kept for a partition with rate categories.")
+        for i in range(1, len(alignments)):
+            np.testing.assert_array_equal( alignments[0], alignments[i], err_msg = "Continuous gamma rates depend on the simulation mode (" + str(i) + ").")
+            np.testing.assert_array_equal( factors[0], factors[i], err_msg = "Continuous gamma rates drawn differently in simulation mode " + str(i) + ".")
+        self.assertTrue( isinstance(factors[1], np.memmap), msg = "Continuous gamma rates of a chunked simulation not stored on disk.")
+
+        # Without counter-based random numbers, each window draws its rates from its own seed, so serial and site-parallel windows agree.
+        runs = []
+        for options in [ {'chunk_size': 16}, {'chunk_size': 16, 'site_processes': 2} ]:
+            my_evolver = Evolver(partitions = part, tree = self.tree, seqfile = False, infofile = False, ratefile = False, seed = 17, **options)
+            my_evolver()
+            runs.append( (np.array(my_evolver.site_factors[0]), np.array([ my_evolver.leaf_seqs[name][0] for name in ['t1', 't3', 't5'] ])) )
+        np.testing.assert_array_equal( runs[0][0], runs[1][0], err_msg = "Windowed continuous gamma rates depend on site parallelism.")
+        np.testing.assert_array_equal( runs[0][1], runs[1][1], err_msg = "Windowed alignments with continuous gamma rates depend on site parallelism.")
+        self.assertEqual( len( np.unique(runs[0][0]) ), 50, msg = "Windowed continuous gamma rates repeat across windows.")
+
+
 
 
 
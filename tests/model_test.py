@@ -115,6 +115,24 @@ class model_gammahet_tests(unittest.TestCase):
         self.assertTrue( abs(1. - np.sum(self.nuc_model.rate_probs)) < ZERO, msg = "rate probabilities don't sum to 1 for gamma hetereogenity with user-provided probabilties.")
         self.assertTrue( abs(1. - np.sum(self.nuc_model.rate_probs * self.nuc_model.rate_factors)) < ZERO, msg = "rate probabilities and factors improperly normalized for gamma hetereogenity with user-provided probabilties.")
 
+
+
+    def test_model_het_gamma_rates_continuous(self):
+        '''
+            Are continuous gamma rates set up correctly, drawn with mean 1, and are per-site transition probabilities correct?"
+        '''
+        self.nuc_model.construct_model(alpha = 0.5, continuous = True)
+        
+        self.assertTrue( self.nuc_model.continuous and self.nuc_model.num_classes() == 1, msg = "continuous gamma rates should use a single rate class.")
+        site_rates = self.nuc_model.draw_site_rates(100000, np.random.RandomState(5))
+        self.assertTrue( abs(np.mean(site_rates) - 1.) < 0.02 and abs(np.var(site_rates) - 2.) < 0.1, msg = "continuous gamma rates improperly drawn.")
+        states = np.array([0, 3, 1, 2, 0])
+        prob_rows = self.nuc_model.compute_prob_rows(0.3, states, site_rates[:5])
+        for i in range(5):
+            np.testing.assert_array_almost_equal( prob_rows[i], linalg.expm(self.nuc_model.matrix * site_rates[i] * 0.3)[states[i]], decimal = DECIMAL, err_msg = "per-site transition probabilities incorrect.")
+        self.assertRaises( AssertionError, self.nuc_model.construct_model, continuous = True )
+        self.assertRaises( AssertionError, self.nuc_model.construct_model, alpha = 0.5, num_categories = 4, continuous = True )
+
  
 
 
@@ -224,6 +242,66 @@ class model_codonmodel_tests(unittest.TestCase):
         self.assertRaises(AssertionError, self.gy_model.construct_model(), rate_probs = [0.5, 0.25, 0.5], msg = "Assertion not raised when user-specified CodonModel rate_probs size diff from number of dN/dS values.")
     
         
+class model_prob_matrix_tests(unittest.TestCase):
+    ''' 
+        Suite of tests for computing transition matrices from models.
+    ''' 
+    
+    def setUp(self):
+        
+        mu_dict     = {'AC':1, 'AG':2.5, 'AT':1, 'CG':0.5, 'CT':2.5, 'GT':1}
+        nuc_freqs   = np.array([0.1, 0.2, 0.3, 0.4])
+        codon_freqs = np.repeat(1./61., 61)
+        self.nuc_model = Model( {'state_freqs':nuc_freqs, 'mu':mu_dict}, "nucleotide")
+        self.nuc_model.construct_model(rate_factors = [0.5, 1.5], rate_probs = [0.5, 0.5])
+        self.gy_model = CodonModel( {'state_freqs':codon_freqs, 'mu':mu_dict, 'beta':[2.5, 0.5], 'alpha':[1.0, 0.75]}, "GY94")
+        self.gy_model.construct_model()
+
+
+    def test_model_prob_matrix_decomposition(self):
+        '''
+            Do transition matrices computed from the eigendecomposition match the matrix exponential, for each rate category?
+        '''
+        for t in [0.001, 0.3, 5.]:
+            for i in range(2):
+                np.testing.assert_array_almost_equal( self.nuc_model.compute_prob_matrix(t, i), linalg.expm(self.nuc_model.matrix * self.nuc_model.rate_factors[i] * t), decimal = DECIMAL, err_msg = "Model transition matrix incorrect.")
+                np.testing.assert_array_almost_equal( self.gy_model.compute_prob_matrix(t, i), linalg.expm(self.gy_model.matrices[i] * t), decimal = DECIMAL, err_msg = "CodonModel transition matrix incorrect.")
+
+
+    def test_model_reversible(self):
+        '''
+            Is time-reversibility properly detected?
+        '''
+        self.assertTrue( self.nuc_model.reversible(), msg = "GTR model not detected as reversible.")
+        self.assertTrue( self.gy_model.reversible(), msg = "GY94 CodonModel not detected as reversible.")
+        mg_model = Model( {'state_freqs':RandomFrequencies(by = 'codon')(), 'omega':0.5}, "MG94")
+        mg_model.construct_model()
+        self.assertFalse( mg_model.reversible(), msg = "MG94 model with unequal frequencies detected as reversible with respect to codon frequencies.")
+
+
+    def test_model_saturation_error(self):
+        '''
+            Does saturation_error bound the distance between transition probabilities and stationary frequencies, and is no bound given for non-reversible models?
+        '''
+        for t in [0.1, 5., 50.]:
+            for i in range(2):
+                prob_matrix = self.nuc_model.compute_prob_matrix(t, i)
+                self.assertTrue( np.max(np.abs(prob_matrix - self.nuc_model.params['state_freqs'])) <= self.nuc_model.saturation_error(t, i) + ZERO, msg = "Saturation error does not bound transition probabilities.")
+        self.assertTrue( self.nuc_model.saturation_error(50., 1) < 1e-8, msg = "Long branch not detected as saturated.")
+        mg_model = Model( {'state_freqs':RandomFrequencies(by = 'codon')(), 'omega':0.5}, "MG94")
+        mg_model.construct_model()
+        self.assertEqual( mg_model.saturation_error(50.), np.inf, msg = "Saturation error given for a non-reversible model.")
+
+
+    def test_model_prob_matrix_fallback(self):
+        '''
+            Is the matrix exponential used when the eigendecomposition is invalid?
+        '''
+        self.nuc_model._decompositions[0].valid = False
+        np.testing.assert_array_almost_equal( self.nuc_model.compute_prob_matrix(0.3, 1), linalg.expm(self.nuc_model.matrix * self.nuc_model.rate_factors[1] * 0.3), decimal = DECIMAL, err_msg = "Model transition matrix incorrect without decomposition.")
+
+        
+        
 def run_models_test():
        
     run_tests = unittest.TextTestRunner()
@@ -243,6 +321,10 @@ def run_models_test():
     print "Testing CodonModel construction."
     test_suite_call = unittest.TestLoader().loadTestsFromTestCase(model_codonmodel_tests)
     run_tests.run(test_suite_call)
+
+    print "Testing transition matrix computation."
+    test_suite_call = unittest.TestLoader().loadTestsFromTestCase(model_prob_matrix_tests)
+    run_tests.run(test_suite_call)
         
          
         
@@ -0,0 +1,140 @@
+#! /usr/bin/env python
+
+##############################################################################
+##  pyvolve: Python platform for simulating evolutionary sequences.
+##
+##  Written by Stephanie J. Spielman (stephanie.spielman@gmail.com)
+##############################################################################
+
+''' Suite of unit tests for plan module.'''
+
+import unittest
+from pyvolve import *
+ZERO=1e-8
+
+
+
+class plan_tests(unittest.TestCase):
+    '''
+        Suite of tests for compiling a SimulationPlan from a tree and partitions.
+    '''
+
+    def setUp(self):
+        self.tree = read_tree( tree = "((t1:0.1,t2:0.1,t3:0.2#m2#):0.05,t4:0.3);" )
+        f = EqualFrequencies(by = 'nuc')()
+        self.m1 = Model( {'state_freqs':f}, 'nucleotide')
+        self.m1.construct_model(rate_factors = [0.5, 1.5], rate_probs = [0.25, 0.75])
+        self.m1.assign_name('m1')
+        self.m2 = Model( {'state_freqs':f, 'kappa':3.}, 'nucleotide')
+        self.m2.construct_model(rate_factors = [0.2, 1.8], rate_probs = [0.5, 0.5])
+        self.m2.assign_name('m2')
+        self.part = Partition()
+        self.part.models = [self.m1, self.m2]
+        self.part.root_model = 'm1'
+        self.part.size = 10
+
+
+    def test_plan_partitions_unchanged(self):
+        '''
+            Ensure that compiling a plan does not modify the partition or the tree, and that partition set-up is correct.
+        '''
+        attributes = dict( vars(self.part) )
+        plan = SimulationPlan(self.tree, self.part)
+        self.assertEqual( vars(self.part), attributes, msg = "Partition modified by compiling a plan.")
+        self.assertEqual( self.part.models, [self.m1, self.m2], msg = "Partition models modified by compiling a plan.")
+        self.assertTrue( self.tree.model_flag is None and self.tree.children[0].model_flag is None, msg = "Tree modified by compiling a plan.")
+
+        part_plan = plan.partitions[0]
+        self.assertTrue( part_plan.root_model is self.m1, msg = "Root model incorrect.")
+        self.assertEqual( (part_plan.sizes, part_plan.size, part_plan.shuffle), ((2, 8), 10, True), msg = "Rate categories improperly divided among sites.")
+        self.assertEqual( list(part_plan.site_rates), [0]*2 + [1]*8, msg = "Site rates incorrect.")
+        self.assertRaises( ValueError, part_plan.site_rates.fill, 0 )
+        self.assertEqual( plan.code, Genetics().nucleotides, msg = "Genetic code incorrect.")
+        self.assertEqual( plan.num_sites, 10, msg = "Number of sites incorrect.")
+
+
+    def test_plan_groups(self):
+        '''
+            Ensure that nodes are ordered parents first, siblings sharing a branch length and model are grouped, and model flags are inherited.
+        '''
+        plan = SimulationPlan(self.tree, [self.part])
+        self.assertEqual( plan.num_nodes(), 6, msg = "Wrong number of nodes.")
+        self.assertEqual( plan.node_names[0], 'root', msg = "Root improperly named.")
+        self.assertEqual( sorted( plan.node_names[i] for i in plan.leaves ), ['t1', 't2', 't3', 't4'], msg = "Leaves incorrect.")
+
+        simulated = set([0])
+        for group in plan.groups:
+            self.assertTrue( group.parent in simulated, msg = "Group is ordered before its parent.")
+            simulated.update(group.children)
+        self.assertEqual( len(simulated), 6, msg = "Not all nodes are evolved by the plan.")
+
+        by_names = dict( (tuple(sorted(plan.node_names[c] for c in group.children)), group) for group in plan.groups )
+        self.assertEqual( sorted(by_names.keys()), [('internal_node1',), ('t1', 't2'), ('t3',), ('t4',)], msg = "Siblings improperly grouped.")
+        self.assertTrue( by_names[('t1', 't2')].models[0] is self.m1, msg = "Model flag not inherited from the root.")
+        self.assertTrue( by_names[('t3',)].models[0] is self.m2, msg = "Model flag not used.")
+
+
+    def test_plan_fusion(self):
+        '''
+            Ensure that partitions are fused along branches where they use the same model, and at the root.
+        '''
+        other = Partition()
+        other.models = self.m1
+        other.size = 5
+        plan = SimulationPlan(self.tree, [self.part, other, Partition(models = self.m2, size = 5)])
+        self.assertEqual( plan.root_fused, ((0, 1), (2,)), msg = "Partitions sharing a root model not fused.")
+        by_names = dict( (tuple(sorted(plan.node_names[c] for c in group.children)), group) for group in plan.groups )
+        self.assertEqual( by_names[('t1', 't2')].fused, ((0, 1), (2,)), msg = "Partitions sharing a model not fused.")
+        self.assertEqual( by_names[('t3',)].fused, ((0, 2), (1,)), msg = "Partitions improperly fused along a flagged branch.")
+
+
+    def test_plan_quantization(self):
+        '''
+            Ensure that branch lengths are quantized, and the quantization error reported.
+        '''
+        tree = read_tree( tree = "(t1:0.2,t2:0.2000001,t3:0.0);" )
+        part = Partition()
+        part.models = self.m1
+        part.size = 10
+        self.assertEqual( len(SimulationPlan(tree, part).groups), 3, msg = "Distinct branch lengths improperly grouped.")
+        plan = SimulationPlan(tree, part, bl_tolerance = 1e-4)
+        self.assertEqual( len(plan.groups), 2, msg = "Quantized branch lengths not grouped.")
+        self.assertTrue( 0. < plan.quantization_error <= 2e-5, msg = "Quantization error improperly reported.")
+        self.assertEqual( plan.branch_length(0.), 0., msg = "Zero branch length quantized.")
+
+        # The coarsest grid allowed by the tolerance: a branch just above the midpoint between grid points changes by almost exactly the tolerance
+        tol = 1e-3
+        branch_length = np.exp( 2. * np.log1p(tol) * 1000.5 ) * (1. + 1e-12)
+        plan = SimulationPlan( read_tree( tree = "(t1:" + repr(branch_length) + ",t2:0.0);" ), part, bl_tolerance = tol )
+        self.assertTrue( 0.999 * tol <= plan.quantization_error / branch_length <= tol * (1. + 1e-8), msg = "Quantization grid does not match the tolerance.")
+        branch_lengths = np.exp( np.linspace(np.log(1e-3), np.log(10.), 20001) )
+        errors = np.abs( np.array([ plan.branch_length(b) for b in branch_lengths ]) / branch_lengths - 1. )
+        self.assertTrue( 0.95 * tol <= np.max(errors) <= tol * (1. + 1e-8), msg = "Quantized branch lengths exceed the tolerance.")
+
+        # An absolute grid rounds to the nearest multiple, so that branches shorter than half a grid step become zero-length branches
+        plan = SimulationPlan( read_tree( tree = "(t1:0.00001,t2:0.0049,t3:0.0051,t4:0.0149);" ), part, bl_grid = 0.01 )
+        self.assertEqual( [ plan.branch_length(b) for b in [1e-5, 0.0049, 0.0051, 0.0149, 0.] ], [0., 0., 0.01, 0.01, 0.], msg = "Branch lengths not rounded to the nearest grid point.")
+        self.assertEqual( len(plan.groups), 2, msg = "Branch lengths on the same grid point improperly grouped.")
+        self.assertTrue( abs(plan.quantization_error - 0.0049) < 1e-12, msg = "Quantization error improperly reported for an absolute grid.")
+        self.assertRaises( AssertionError, SimulationPlan, tree, part, bl_tolerance = 1e-4, bl_grid = 0.01 )
+
+
+    def test_plan_bad_input(self):
+        '''
+            Ensure that improper input is rejected.
+        '''
+        self.part.root_model = 'm3'
+        self.assertRaises( AssertionError, SimulationPlan, self.tree, self.part )
+        self.assertRaises( AssertionError, SimulationPlan, self.tree, [self.tree] )
+        self.assertRaises( AssertionError, SimulationPlan, read_tree( tree = "(t1:-0.1,t2:0.1);" ), Partition(models = self.m1, size = 10) )
+
+
+
+
+def run_plan_test():
+
+    run_tests = unittest.TextTestRunner()
+
+    print "Testing the compilation of simulation plans"
+    test_suite = unittest.TestLoader().loadTestsFromTestCase(plan_tests)
+    run_tests.run(test_suite)
@@ -0,0 +1,85 @@
+#! /usr/bin/env python
+
+##############################################################################
+##  pyvolve: Python platform for simulating evolutionary sequences.
+##
+##  Written by Stephanie J. Spielman (stephanie.spielman@gmail.com)
+##############################################################################
+
+''' Suite of unit tests for replicates module.'''
+
+import os
+import unittest
+from pyvolve import *
+ZERO=1e-8
+
+
+
+class replicates_tests(unittest.TestCase):
+    '''
+        Suite of tests for simulating replicates in shards, and merging shard files.
+    '''
+
+    def setUp(self):
+        tree = read_tree( tree = "((t1:0.1,t2:0.2):0.05,t3:0.3);" )
+        model = Model( {'state_freqs':EqualFrequencies(by = 'nuc')()}, 'nucleotide')
+        model.construct_model(rate_factors = [0.5, 1.5], rate_probs = [0.5, 0.5])
+        part = Partition()
+        part.models = model
+        part.size = 20
+        self.evolver = Evolver(tree = tree, partitions = part, seqfile = False, ratefile = False, infofile = False, seed = 31)
+        self.files = []
+
+
+    def tearDown(self):
+        for filename in self.files:
+            if os.path.exists(filename):
+                os.remove(filename)
+
+
+    def _write(self, filename, first, last, **kwargs):
+        self.files.append(filename)
+        write_replicate_shard(self.evolver, filename, first, last, **kwargs)
+
+
+    def test_replicates_shards(self):
+        '''
+            Ensure that each shard holds exactly the corresponding replicates of a single run, and that merged shards are byte-identical to a single shard over all replicates.
+        '''
+        self._write("all.npy", 0, 10)
+        self._write("shard1.npy", 4, 10, num_processes = 2)
+        self._write("shard0.npy", 0, 4)
+        first, replicates = read_replicate_shard("all.npy")
+        self.assertEqual( (first, replicates.shape), (0, (10, 3, 20)), msg = "Shard file improperly read.")
+        np.testing.assert_array_equal( replicates, self.evolver.simulate_replicates(10, first_replicate = 0), err_msg = "Shard does not hold the study's replicates.")
+        first, shard = read_replicate_shard("shard1.npy", mmap = True)
+        self.assertEqual( first, 4, msg = "Shard file improperly read.")
+        np.testing.assert_array_equal( shard, replicates[4:], err_msg = "Shard differs from the corresponding replicates of a single run.")
+
+        self.files.append("merged.npy")
+        merge_replicate_shards(["shard1.npy", "shard0.npy"], "merged.npy")
+        with open("all.npy", "rb") as all_h, open("merged.npy", "rb") as merged_h:
+            self.assertEqual( all_h.read(), merged_h.read(), msg = "Merged shards differ from a single run.")
+
+
+    def test_replicates_bad_shards(self):
+        '''
+            Ensure that improper shards are rejected.
+        '''
+        self.assertRaises( AssertionError, write_replicate_shard, self.evolver, "bad.npy", 3, 3 )
+        self._write("shard0.npy", 0, 3)
+        self._write("shard1.npy", 4, 6)
+        self.files.append("merged.npy")
+        self.assertRaises( AssertionError, merge_replicate_shards, ["shard0.npy", "shard1.npy"], "merged.npy" )
+        self.assertRaises( AssertionError, merge_replicate_shards, ["shard0.npy", "shard0.npy"], "merged.npy" )
+
+
+
+
+def run_replicates_test():
+
+    run_tests = unittest.TextTestRunner()
+
+    print "Testing the simulation of replicates in shards"
+    test_suite = unittest.TestLoader().loadTestsFromTestCase(replicates_tests)
+    run_tests.run(test_suite)
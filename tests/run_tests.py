@@ -12,6 +12,11 @@ import unittest
 from model_test import *
 from matrix_builder_test import *
 from state_freqs_test import *
+from plan_test import *
+from replicates_test import *
+from sampler_test import *
+from storage_test import *
+from transition_test import *
 from evolver_test import *
 
 
@@ -25,5 +30,15 @@ if __name__ == '__main__':
     run_matrix_builder_test() 
     print "\n\nRunning tests for models module"
     run_models_test()
+    print "\n\nRunning tests for plan module"
+    run_plan_test()
+    print "\n\nRunning tests for replicates module"
+    run_replicates_test()
+    print "\n\nRunning tests for sampler module"
+    run_sampler_test()
+    print "\n\nRunning tests for storage module"
+    run_storage_test()
+    print "\n\nRunning tests for transition module"
+    run_transition_test()
     print "\n\nRunning tests for evolver module"
     run_evolver_test()
\ No newline at end of file
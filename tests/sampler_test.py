@@ -0,0 +1,159 @@
+#! /usr/bin/env python
+
+##############################################################################
+##  pyvolve: Python platform for simulating evolutionary sequences.
+##
+##  Written by Stephanie J. Spielman (stephanie.spielman@gmail.com)
+##############################################################################
+
+''' Suite of unit tests for sampler module.'''
+
+import unittest
+from pyvolve import *
+ZERO=1e-8
+
+
+
+class sampler_tests(unittest.TestCase):
+    '''
+        Suite of tests for the Sampler child classes. Since sampling is random, draws are checked against expected frequencies with a generous tolerance.
+    '''
+
+    def setUp(self):
+        self.prob_matrix = np.array([[0.7, 0.1, 0.2, 0.0],
+                                     [0.0, 0.5, 0.0, 0.5],
+                                     [0.25, 0.25, 0.25, 0.25],
+                                     [0.0, 0.0, 0.0, 1.0]])
+        self.states = np.repeat( np.arange(4), 20000 )
+        self.samplers = [ InverseCDFSampler(rng = np.random.RandomState(11)), AliasSampler(rng = np.random.RandomState(11)), MultinomialSampler(rng = np.random.RandomState(11)) ]
+
+
+    def test_sampler_row_frequencies(self):
+        '''
+            Ensure that the child states drawn for each parent state match that row of the matrix, and that zero-probability states are never drawn.
+        '''
+        for sampler in self.samplers:
+            new_states = sampler(self.prob_matrix, self.states)
+            self.assertEqual( new_states.shape, self.states.shape, msg = "Sampler returned the wrong number of states.")
+            for s in range(4):
+                counts = np.bincount( new_states[self.states == s], minlength = 4 ) / 20000.
+                np.testing.assert_allclose( counts, self.prob_matrix[s], atol = 0.015, err_msg = "Sampled frequencies do not match transition probabilities.")
+                self.assertTrue( np.all( counts[self.prob_matrix[s] == 0.] == 0. ), msg = "Sampler drew a state with probability zero.")
+
+
+    def test_sampler_small_integer_states(self):
+        '''
+            Ensure that parent states given as small integers (e.g. int8, as stored by Evolver) are sampled correctly with a large alphabet, and that alias tables reproduce the rows of a codon-sized matrix.
+        '''
+        states = np.tile( np.arange(61, dtype = np.int8), 100 )
+        for sampler in self.samplers:
+            np.testing.assert_array_equal( sampler(np.eye(61), states), states, err_msg = "Sampler failed with int8 parent states.")
+        prob_matrix = np.random.RandomState(3).dirichlet( np.repeat(0.5, 61), size = 61 )
+        accept, alias = self.samplers[1].prepare(prob_matrix)
+        rebuilt = accept / 61.
+        for r in range(61):
+            rebuilt[r] += np.bincount( alias[r], weights = (1. - accept[r]) / 61., minlength = 61 )
+        np.testing.assert_array_almost_equal( rebuilt, prob_matrix, decimal = 10, err_msg = "Alias tables do not reproduce matrix rows.")
+
+
+    def test_sampler_sample_freqs(self):
+        '''
+            Ensure that draws from a single frequency vector (as for the root) match those frequencies.
+        '''
+        freqs = np.array([0.1, 0.2, 0.3, 0.4])
+        for sampler in self.samplers:
+            new_states = sampler.sample_freqs(freqs, 50000)
+            self.assertEqual( len(new_states), 50000, msg = "Sampler returned the wrong number of states.")
+            np.testing.assert_allclose( np.bincount(new_states, minlength = 4) / 50000., freqs, atol = 0.015, err_msg = "Sampled frequencies do not match state frequencies.")
+
+
+    def test_sampler_multinomial_scatter(self):
+        '''
+            Ensure that the MultinomialSampler scatters child states back to the correct sites when parent states are interleaved.
+        '''
+        states = np.tile( np.arange(4), 5000 )
+        new_states = self.samplers[2](self.prob_matrix, states)
+        self.assertTrue( np.all(new_states[states == 3] == 3), msg = "Multinomial sampler did not scatter draws to the correct sites.")
+        self.assertTrue( np.all( (new_states[states == 1] == 1) | (new_states[states == 1] == 3) ), msg = "Multinomial sampler did not scatter draws to the correct sites.")
+        self.assertTrue( 0.45 < np.mean(new_states[states == 1] == 1) < 0.55, msg = "Multinomial sampler frequencies incorrect.")
+
+
+    def test_sampler_sample_changes(self):
+        '''
+            Ensure that sampling only the sites which change (as along short branches) yields the same frequencies as sampling every site, and that states which cannot change never do.
+        '''
+        short_matrix = 0.9 * np.eye(4) + 0.1 * self.prob_matrix
+        for sampler in self.samplers:
+            new_states = sampler.sample_changes(short_matrix, self.states)
+            self.assertEqual( new_states.shape, self.states.shape, msg = "Sampler returned the wrong number of states.")
+            for s in range(4):
+                counts = np.bincount( new_states[self.states == s], minlength = 4 ) / 20000.
+                np.testing.assert_allclose( counts, short_matrix[s], atol = 0.01, err_msg = "Sampled frequencies do not match transition probabilities.")
+            self.assertTrue( np.all(new_states[self.states == 3] == 3), msg = "Sampler changed a state which cannot change.")
+            self.assertTrue( np.all(sampler.sample_changes(np.eye(4), self.states) == self.states), msg = "Sampler changed states under the identity matrix.")
+
+
+    def test_sampler_prepare_changes(self):
+        '''
+            Ensure that a table prepared for sampling only the sites which change may be reused, and gives the same draws as sample_changes.
+        '''
+        short_matrix = 0.9 * np.eye(4) + 0.1 * self.prob_matrix
+        for sampler in self.samplers:
+            direct = type(sampler)(rng = np.random.RandomState(5))
+            prepared = type(sampler)(rng = np.random.RandomState(5))
+            table = prepared.prepare_changes(short_matrix)
+            for rep in range(2):
+                np.testing.assert_array_equal( prepared.draw_changes(table, self.states), direct.sample_changes(short_matrix, self.states), err_msg = "Prepared table does not reproduce sample_changes.")
+            self.assertTrue( np.all(sampler.draw_changes(sampler.prepare_changes(np.eye(4)), self.states) == self.states), msg = "Prepared table changed states under the identity matrix.")
+
+
+    def test_sampler_bad_probabilities(self):
+        '''
+            Ensure that a matrix whose rows do not sum to 1 is rejected.
+        '''
+        for sampler in self.samplers:
+            self.assertRaises( AssertionError, sampler.prepare, self.prob_matrix * 0.5 )
+
+
+    def test_sampler_get_sampler(self):
+        '''
+            Ensure that samplers are properly retrieved from their names.
+        '''
+        self.assertTrue( isinstance(get_sampler('cdf'), InverseCDFSampler) )
+        self.assertTrue( isinstance(get_sampler('Alias'), AliasSampler) )
+        self.assertTrue( isinstance(get_sampler('multinomial'), MultinomialSampler) )
+        self.assertTrue( get_sampler(self.samplers[0]) is self.samplers[0] )
+
+
+    def test_sampler_sample_rows(self):
+        '''
+            Ensure that drawing from per-site rows matches each row's probabilities, and that zero-probability states are never drawn.
+        '''
+        for sampler in self.samplers:
+            new_states = sampler.sample_rows( self.prob_matrix[self.states] )
+            for s in range(4):
+                counts = np.bincount( new_states[self.states == s], minlength = 4 ) / 20000.
+                np.testing.assert_allclose( counts, self.prob_matrix[s], atol = 0.015, err_msg = "Frequencies sampled from per-site rows do not match probabilities.")
+                self.assertTrue( np.all( counts[self.prob_matrix[s] == 0.] == 0. ), msg = "Sampler drew a state with probability zero from per-site rows.")
+
+
+    def test_sampler_counter_rng(self):
+        '''
+            Ensure that keyed generators are reproducible, and differ between keys.
+        '''
+        first = counter_rng( (1, 0, 3, 0, 2) ).random_sample(5)
+        np.testing.assert_array_equal( first, counter_rng( (1, 0, 3, 0, 2) ).random_sample(5), err_msg = "Keyed generator is not reproducible.")
+        for key in [ (1, 0, 3, 0, 3), (1, 0, 3, 1, 2), (2, 0, 3, 0, 2) ]:
+            self.assertFalse( np.all( first == counter_rng(key).random_sample(5) ), msg = "Different keys gave identical streams.")
+        self.assertRaises( AssertionError, get_sampler, 'loop' )
+
+
+
+
+def run_sampler_test():
+
+    run_tests = unittest.TextTestRunner()
+
+    print "Testing the Sampler child classes"
+    test_suite = unittest.TestLoader().loadTestsFromTestCase(sampler_tests)
+    run_tests.run(test_suite)
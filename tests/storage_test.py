@@ -0,0 +1,137 @@
+#! /usr/bin/env python
+
+##############################################################################
+##  pyvolve: Python platform for simulating evolutionary sequences.
+##
+##  Written by Stephanie J. Spielman (stephanie.spielman@gmail.com)
+##############################################################################
+
+''' Suite of unit tests for storage module.'''
+
+import unittest
+import weakref
+from pyvolve import *
+ZERO=1e-8
+
+
+
+class storage_tests(unittest.TestCase):
+    '''
+        Suite of tests for DeltaSequences, comparing sequences simulated with full and delta storage under the same seed.
+    '''
+
+    def setUp(self):
+        self.tree = read_tree( tree = "(((t2:0.01,t1:0.02):0.0,t3:0.03):0.01,(t5:0.02,t4:0.0):0.05);" )
+        model = Model( {'state_freqs':EqualFrequencies(by = 'nuc')()}, 'nucleotide')
+        model.construct_model(rate_factors = [0.5, 1.5], rate_probs = [0.5, 0.5])
+        part1 = Partition()
+        part1.models = model
+        part1.size = 500
+        part2 = Partition()
+        part2.models = model
+        part2.size = 300
+        self.plan = SimulationPlan(self.tree, [part1, part2])
+
+
+    def _simulate(self, **kwargs):
+        my_evolver = Evolver(plan = self.plan, seqfile = False, ratefile = False, infofile = False, seed = 7, **kwargs)
+        my_evolver()
+        return my_evolver
+
+
+    def test_storage_matches_full(self):
+        '''
+            Ensure that sequences rebuilt from differences (after shuffling sites) are identical to fully stored sequences, whether accessed individually or iterated over.
+        '''
+        full  = self._simulate()
+        delta = self._simulate(storage = 'delta')
+        self.assertTrue( isinstance(delta.evolved_seqs, DeltaSequences), msg = "Delta storage not used.")
+        self.assertEqual( sorted(delta.evolved_seqs.keys()), sorted(full.evolved_seqs.keys()), msg = "Delta storage has the wrong nodes.")
+        self.assertEqual( sorted(delta.leaf_seqs.keys()), sorted(full.leaf_seqs.keys()), msg = "Delta storage has the wrong leaves.")
+        for name, seq in delta.evolved_seqs.items():
+            for p in range(2):
+                np.testing.assert_array_equal( seq[p], full.evolved_seqs[name][p], err_msg = "Sequence rebuilt from differences is incorrect.")
+                np.testing.assert_array_equal( delta.evolved_seqs[name][p], full.evolved_seqs[name][p], err_msg = "Sequence rebuilt from differences is incorrect.")
+        for name in delta.leaf_seqs:
+            np.testing.assert_array_equal( delta.leaf_seqs[name][1], full.leaf_seqs[name][1], err_msg = "Leaf sequence rebuilt from differences is incorrect.")
+
+
+    def _max_alive_when_written(self, my_evolver, seqs):
+        '''
+            Write sequences to file, and return the largest number of sequences rebuilt (by the seqs dictionary's _permuted method) which were alive at once. This is the number of sequences written if they are all rebuilt before writing.
+        '''
+        rebuilt = []
+        alive = [0]
+        permuted = seqs._permuted
+        def tracked(seq):
+            seq = permuted(seq)
+            rebuilt.append( weakref.ref(seq[0]) )
+            alive[0] = max( alive[0], sum( ref() is not None for ref in rebuilt ) )
+            return seq
+        seqs._permuted = tracked
+        my_evolver.seqfile = 'storage_test.fasta'
+        my_evolver._write_sequences(seqs)
+        with open('storage_test.fasta', 'r') as seq_h:
+            self.assertEqual( seq_h.read().count('>'), len(seqs), msg = "Not all sequences written.")
+        os.remove('storage_test.fasta')
+        self.assertEqual( len(rebuilt), len(seqs), msg = "Sequences rebuilt more than once when written.")
+        return alive[0]
+
+
+    def test_storage_write_lazily(self):
+        '''
+            Ensure that sequences stored as differences are rebuilt one at a time when written, rather than all at once, and that leaf sequences are released once written.
+        '''
+        def balanced(first, last):
+            if last - first == 1:
+                return "t" + str(first) + ":0.01"
+            return "(" + balanced(first, (first + last) // 2) + "," + balanced((first + last) // 2, last) + "):0.01"
+        model = Model( {'state_freqs':EqualFrequencies(by = 'nuc')()}, 'nucleotide')
+        model.construct_model()
+        delta = Evolver(tree = read_tree( tree = "(" + balanced(0, 32) + "," + balanced(32, 64) + ");" ), partitions = Partition(models = model, size = 100), seqfile = False, ratefile = False, infofile = False, seed = 7, storage = 'delta')
+        delta()
+        alive = self._max_alive_when_written(delta, delta.evolved_seqs)
+        self.assertTrue( alive <= 12, msg = "Rebuilt sequences kept in memory while writing.") # Ancestors along the current path, the sequence being written, and the one before it
+
+
+    def test_storage_differences(self):
+        '''
+            Ensure that only changed sites are stored, that zero-length branches store nothing, and that retention still applies.
+        '''
+        delta = self._simulate(storage = 'delta', retain = ['internal_node1'])
+        self.assertTrue( 0 < delta.evolved_seqs.num_differences() < 800, msg = "Too many differences stored along short branches.")
+        self.assertEqual( sum( len(sites) for (sites, states) in delta.evolved_seqs._diffs[ self.plan.node_names.index('t4') ] ), 0, msg = "Zero-length branch stored differences.")
+        self.assertEqual( sorted(delta.evolved_seqs.keys()), ['internal_node1', 't1', 't2', 't3', 't4', 't5'], msg = "Retention not applied with delta storage.")
+        self.assertRaises( KeyError, delta.evolved_seqs.__getitem__, 'root' )
+        self.assertRaises( AssertionError, Evolver, plan = self.plan, storage = 'sparse' )
+
+
+    def test_storage_permuted(self):
+        '''
+            Ensure that sites are shuffled lazily with full storage, consistently with the rate categories, and that permutations apply to every access, one sequence at a time when written.
+        '''
+        full = self._simulate()
+        self.assertTrue( isinstance(full.evolved_seqs, PermutedSequences) and isinstance(full.leaf_seqs, PermutedSequences), msg = "Sites not shuffled lazily.")
+        self.assertEqual( sorted(full.leaf_seqs.keys()), ['t1', 't2', 't3', 't4', 't5'], msg = "Permuted sequences have the wrong leaves.")
+        self.assertEqual( len(full.evolved_seqs), 9, msg = "Permuted sequences have the wrong nodes.")
+        np.testing.assert_array_equal( full.leaf_seqs['t4'][1], full.evolved_seqs['t4'][1], err_msg = "Leaf and evolved sequences permuted differently.")
+        self.assertTrue( np.all( full.leaf_seqs['t4'][0] == full.evolved_seqs['internal_node3'][0] ), msg = "Zero-length branch changed a permuted sequence.")
+
+        self.assertTrue( self._max_alive_when_written(full, full.evolved_seqs) <= 2, msg = "Permuted sequences kept in memory while writing.") # The sequence being written, and the one before it
+
+        seqs = { 'a': [ np.arange(4), np.arange(3) ] }
+        permuted = PermutedSequences( seqs, [ np.array([2, 0, 3, 1]), None ] )
+        self.assertEqual( [ list(part_seq) for part_seq in permuted['a'] ], [ [2, 0, 3, 1], [0, 1, 2] ], msg = "Sites improperly permuted.")
+        self.assertTrue( 'a' in permuted and 'b' not in permuted and len(permuted) == 1, msg = "Permuted sequences improperly keyed.")
+        self.assertEqual( [ (name, list(seq[0])) for name, seq in permuted.iteritems() ], [ ('a', [2, 0, 3, 1]) ], msg = "Sites improperly permuted when iterating.")
+
+
+
+
+def run_storage_test():
+
+    run_tests = unittest.TextTestRunner()
+
+    print "Testing the delta storage of sequences"
+    test_suite = unittest.TestLoader().loadTestsFromTestCase(storage_tests)
+    run_tests.run(test_suite)
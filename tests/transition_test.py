@@ -0,0 +1,222 @@
+#! /usr/bin/env python
+
+##############################################################################
+##  pyvolve: Python platform for simulating evolutionary sequences.
+##
+##  Written by Stephanie J. Spielman (stephanie.spielman@gmail.com)
+##############################################################################
+
+''' Suite of unit tests for transition module.'''
+
+import unittest
+from pyvolve import *
+ZERO=1e-8
+
+
+
+class transition_eigen_tests(unittest.TestCase):
+    '''
+        Suite of tests for the EigenDecomposition class.
+    '''
+
+    def test_transition_eigen_prob_matrix(self):
+        '''
+            Ensure that transition matrices computed from the decomposition match the matrix exponential.
+        '''
+        matrix = nucleotide_Matrix({'state_freqs':np.array([0.1, 0.2, 0.3, 0.4]), 'kappa':3.})()
+        decomp = EigenDecomposition(matrix)
+        self.assertTrue( decomp.valid, msg = "Decomposition of a GTR matrix flagged as invalid.")
+        for scale in [0., 0.01, 1., 25.]:
+            np.testing.assert_array_almost_equal( decomp(scale), linalg.expm(matrix * scale), decimal = 8, err_msg = "Transition matrix from eigendecomposition incorrect.")
+
+
+    def test_transition_eigen_reversible(self):
+        '''
+            Ensure that reversibility is detected, and that both the symmetric and general paths match the matrix exponential.
+        '''
+        freqs  = np.array([0.1, 0.2, 0.3, 0.4])
+        matrix = nucleotide_Matrix({'state_freqs':freqs, 'mu':{'AC':1., 'AG':2., 'AT':0.5, 'CG':1.5, 'CT':3., 'GT':1.}})()
+        decomp = EigenDecomposition(matrix, state_freqs = freqs)
+        self.assertTrue( decomp.valid and decomp.reversible, msg = "Reversible GTR matrix not detected as reversible.")
+        for scale in [0.01, 1., 100.]:
+            np.testing.assert_array_almost_equal( decomp(scale), linalg.expm(matrix * scale), decimal = 8, err_msg = "Transition matrix from symmetric eigendecomposition incorrect.")
+        
+        # Cyclic matrix is not reversible with respect to its (equal) stationary frequencies
+        cyclic = np.array([[-1., 1., 0.], [0., -1., 1.], [1., 0., -1.]])
+        decomp = EigenDecomposition(cyclic, state_freqs = np.repeat(1./3., 3))
+        self.assertTrue( decomp.valid and not decomp.reversible, msg = "Non-reversible matrix detected as reversible.")
+        np.testing.assert_array_almost_equal( decomp(0.7), linalg.expm(cyclic * 0.7), decimal = 8, err_msg = "Transition matrix from general eigendecomposition incorrect.")
+        
+        # Zero frequencies cannot be symmetrized
+        self.assertFalse( EigenDecomposition(matrix, state_freqs = np.array([0., 0.2, 0.4, 0.4])).reversible, msg = "Matrix symmetrized with zero frequencies.")
+
+
+    def test_transition_eigen_defective(self):
+        '''
+            Ensure that a defective matrix is flagged as an invalid decomposition.
+        '''
+        matrix = np.array([[-1., 1., 0.], [0., -1., 1.], [0., 0., 0.]])
+        decomp = EigenDecomposition(matrix)
+        self.assertFalse( decomp.valid, msg = "Decomposition of a defective matrix flagged as valid.")
+        self.assertRaises( AssertionError, decomp, 1. )
+
+
+    def test_transition_eigen_rows(self):
+        '''
+            Ensure that per-site rows, each with its own scale and parent state, match the corresponding transition matrices, for both the eigendecomposition and closed form.
+        '''
+        freqs  = np.array([0.1, 0.2, 0.3, 0.4])
+        states = np.array([0, 1, 2, 3, 2])
+        scales = np.array([0., 0.01, 0.5, 2., 30.])
+        for matrix in [ nucleotide_Matrix({'state_freqs':freqs, 'mu':{'AC':1., 'AG':2., 'AT':0.5, 'CG':1.5, 'CT':3., 'GT':1.}})(), nucleotide_Matrix({'state_freqs':freqs, 'kappa':3.})() ]:
+            for decomp in [ EigenDecomposition(matrix, state_freqs = freqs), NucleotideClosedForm(matrix, freqs) ]:
+                if not decomp.valid:
+                    continue
+                rows = decomp.rows(states, scales)
+                for i in range(len(states)):
+                    np.testing.assert_array_almost_equal( rows[i], linalg.expm(matrix * scales[i])[states[i]], decimal = 8, err_msg = "Per-site transition rows incorrect.")
+
+
+
+
+class transition_closed_form_tests(unittest.TestCase):
+    '''
+        Suite of tests for the NucleotideClosedForm class.
+    '''
+
+    def setUp(self):
+        self.equal   = np.repeat(0.25, 4)
+        self.unequal = np.array([0.1, 0.2, 0.3, 0.4])
+
+
+    def _check_model(self, freqs, mu, name):
+        ''' Ensure that the closed form is detected with the correct name, and matches the matrix exponential for single and arrays of scales. '''
+        matrix = nucleotide_Matrix({'state_freqs':freqs, 'mu':mu})()
+        closed_form = NucleotideClosedForm(matrix, freqs)
+        self.assertTrue( closed_form.valid, msg = "Closed form not detected for " + name)
+        self.assertEqual( closed_form.name, name, msg = "Wrong nucleotide model detected.")
+        scales = np.array([0., 0.001, 0.5, 3., 40.])
+        prob_matrices = closed_form(scales)
+        self.assertEqual( prob_matrices.shape, (5,4,4) )
+        for k in range(len(scales)):
+            np.testing.assert_array_almost_equal( prob_matrices[k], linalg.expm(matrix * scales[k]), decimal = 10, err_msg = "Closed-form transition matrix incorrect for " + name)
+        np.testing.assert_array_almost_equal( closed_form(0.5), prob_matrices[2], decimal = 12 )
+
+
+    def test_transition_closed_form_models(self):
+        '''
+            Ensure that each nested TN93 model is detected and computed correctly.
+        '''
+        self._check_model(self.equal,   {'AC':1., 'AG':1., 'AT':1., 'CG':1., 'CT':1., 'GT':1.}, 'JC69')
+        self._check_model(self.equal,   {'AC':1., 'AG':3., 'AT':1., 'CG':1., 'CT':3., 'GT':1.}, 'K80')
+        self._check_model(self.unequal, {'AC':1., 'AG':1., 'AT':1., 'CG':1., 'CT':1., 'GT':1.}, 'F81')
+        self._check_model(self.unequal, {'AC':1., 'AG':3., 'AT':1., 'CG':1., 'CT':3., 'GT':1.}, 'HKY85')
+        self._check_model(self.unequal, {'AC':0.5, 'AG':3., 'AT':0.5, 'CG':0.5, 'CT':1.5, 'GT':0.5}, 'TN93')
+
+
+    def test_transition_closed_form_gtr(self):
+        '''
+            Ensure that a GTR model with unequal transversion rates does not have a closed form, but is still properly computed by its model.
+        '''
+        mu = {'AC':1., 'AG':3., 'AT':0.2, 'CG':1., 'CT':3., 'GT':1.}
+        matrix = nucleotide_Matrix({'state_freqs':self.unequal, 'mu':mu})()
+        self.assertFalse( NucleotideClosedForm(matrix, self.unequal).valid, msg = "Closed form detected for GTR model.")
+        model = Model({'state_freqs':self.unequal, 'mu':mu}, 'nucleotide')
+        model.construct_model()
+        prob_matrices = model.compute_prob_matrices([0.1, 1.], 0)
+        np.testing.assert_array_almost_equal( prob_matrices[1], linalg.expm(model.matrix), decimal = 8, err_msg = "GTR transition matrix incorrect.")
+
+
+    def test_transition_improper_fallback(self):
+        '''
+            Ensure that only improper matrices in a batch (rows not summing to 1, or negative entries) are recomputed with the matrix exponential.
+        '''
+        class Decomposition(object):
+            valid = True
+            def __call__(self, scales):
+                prob_matrices = np.empty( [len(scales), 4, 4] )
+                prob_matrices.fill(0.25)
+                prob_matrices[1] *= 2.
+                prob_matrices[2, 0] = [1.5, -0.5, 0., 0.]
+                return prob_matrices
+        model = Model({'state_freqs':self.unequal}, 'nucleotide')
+        model.construct_model()
+        model._decompositions = [Decomposition()]
+        prob_matrices = model.compute_prob_matrices([0.1, 1., 2.], 0)
+        np.testing.assert_array_almost_equal( prob_matrices[0], np.ones([4,4]) / 4., decimal = 12, err_msg = "Proper transition matrix recomputed.")
+        for k, branch_length in [ (1, 1.), (2, 2.) ]:
+            np.testing.assert_array_almost_equal( prob_matrices[k], linalg.expm(model.matrix * branch_length), decimal = 8, err_msg = "Improper transition matrix not recomputed.")
+
+
+
+
+class transition_cache_tests(unittest.TestCase):
+    '''
+        Suite of tests for the TransitionCache class.
+    '''
+
+    def setUp(self):
+        self.cache = TransitionCache(maxsize = 2)
+        self.computed = []
+
+    def _compute(self, value):
+        ''' Return a function which records that it was called and returns value. '''
+        def compute():
+            self.computed.append(value)
+            return value
+        return compute
+
+
+    def test_transition_cache_hits_misses(self):
+        '''
+            Ensure that cached matrices are returned without recomputation, and that hits and misses are counted.
+        '''
+        self.assertEqual( self.cache.get('a', self._compute(1)), 1 )
+        self.assertEqual( self.cache.get('a', self._compute(2)), 1, msg = "Cache did not return the stored matrix.")
+        self.assertEqual( self.computed, [1], msg = "Cached matrix was recomputed.")
+        self.assertEqual( (self.cache.hits, self.cache.misses), (1, 1), msg = "Hits and misses improperly counted.")
+
+
+    def test_transition_cache_lru_eviction(self):
+        '''
+            Ensure that the least recently used matrix is evicted once the cache is full.
+        '''
+        self.cache.get('a', self._compute(1))
+        self.cache.get('b', self._compute(2))
+        self.cache.get('a', self._compute(1)) # 'b' is now least recently used
+        self.cache.get('c', self._compute(3))
+        self.assertEqual( len(self.cache), 2 )
+        self.assertTrue( 'a' in self.cache and 'c' in self.cache and 'b' not in self.cache, msg = "Cache did not evict the least recently used matrix.")
+        self.cache.resize(1)
+        self.assertTrue( 'c' in self.cache and 'a' not in self.cache, msg = "Cache did not evict upon resizing.")
+        self.cache.clear()
+        self.assertEqual( (len(self.cache), self.cache.hits, self.cache.misses), (0, 0, 0), msg = "Cache was not cleared.")
+
+
+    def test_transition_cache_disabled(self):
+        '''
+            Ensure that a cache of size 0 never stores matrices.
+        '''
+        cache = TransitionCache(maxsize = 0)
+        cache.get('a', self._compute(1))
+        cache.get('a', self._compute(1))
+        self.assertEqual( (len(cache), cache.misses), (0, 2), msg = "Disabled cache stored a matrix.")
+
+
+
+
+def run_transition_test():
+
+    run_tests = unittest.TextTestRunner()
+
+    print "Testing the EigenDecomposition class"
+    test_suite = unittest.TestLoader().loadTestsFromTestCase(transition_eigen_tests)
+    run_tests.run(test_suite)
+
+    print "Testing the NucleotideClosedForm class"
+    test_suite = unittest.TestLoader().loadTestsFromTestCase(transition_closed_form_tests)
+    run_tests.run(test_suite)
+
+    print "Testing the TransitionCache class"
+    test_suite = unittest.TestLoader().loadTestsFromTestCase(transition_cache_tests)
+    run_tests.run(test_suite)